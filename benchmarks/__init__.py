@@ -0,0 +1 @@
+"""Benchmarks of jujulib's client against a fake Juju API server."""
@@ -0,0 +1,564 @@
+"""Run the client benchmarks and report, or compare, the results.
+
+    $ python -m benchmarks.run --output after.json --compare before.json
+
+Each benchmark times an operation a number of times against a fake API
+server (see benchmarks.server) and reports the median, mean, 95th
+percentile, minimum and maximum seconds it took. A report saved with
+--output can be compared with a later run using --compare, which lists the
+change in each benchmark's median and exits with status 1 if any got slower
+by more than --threshold.
+
+"""
+import argparse
+import collections
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import yaml
+
+from juju import configstore, tls
+from juju.apiclient import Connection
+from juju.codec import default_codec
+from juju.deploy import DeploymentPlan
+from juju.logincache import LoginCache
+from juju.retry import RetryPolicy
+from juju.status import iter_status
+from juju.metrics import Metrics
+from juju.transport import (
+    RecordingTransport, ReplayTransport, WebsocketTransport)
+
+from .server import CERT_FILE, FakeAPIServer
+
+
+BENCHMARKS = collections.OrderedDict()
+
+
+def benchmark(fn):
+    """Register a benchmark, called with the scale of its iterations.
+
+    A benchmark returns a dict of results from summarize, by name.
+
+    """
+    BENCHMARKS[fn.__name__] = fn
+    return fn
+
+
+def measure(fn, iterations, warmup=1):
+    """Return the seconds each of iterations calls to fn took."""
+    iterations = max(1, int(iterations))
+    for _ in range(warmup):
+        fn()
+    timings = []
+    for _ in range(iterations):
+        start = time.time()
+        fn()
+        timings.append(time.time() - start)
+    return timings
+
+
+def peak_memory(fn):
+    """Return the most memory fn allocated at once, if it can be traced."""
+    try:
+        import tracemalloc
+    except ImportError:
+        return None
+    tracemalloc.start()
+    try:
+        fn()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def run_threads(fn, count):
+    """Call fn from count threads at once, raising the first error raised.
+    """
+    errors = []
+
+    def call():
+        try:
+            fn()
+        except Exception as e:
+            errors.append(e)
+
+    workers = [threading.Thread(target=call) for _ in range(count)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    if errors:
+        raise errors[0]
+
+
+def summarize(timings, **extra):
+    timings = sorted(timings)
+    n = len(timings)
+    summary = {
+        'iterations': n,
+        'median': timings[n // 2],
+        'mean': sum(timings) / n,
+        'p95': timings[min(n - 1, int(n * 0.95))],
+        'min': timings[0],
+        'max': timings[-1],
+    }
+    summary.update(extra)
+    return summary
+
+
+class running(object):
+    """A context manager running a FakeAPIServer."""
+
+    def __init__(self, **kwargs):
+        self.server = FakeAPIServer(**kwargs)
+
+    def __enter__(self):
+        self.server.start()
+        return self.server
+
+    def __exit__(self, *exc_info):
+        self.server.stop()
+
+
+def connect(server, **kwargs):
+    return Connection(
+        server.address, server.cacert, 'user-admin', 'sekrit', **kwargs)
+
+
+@benchmark
+def connect_time(scale):
+    """Connecting and logging in, with and without TLS session resumption."""
+    results = {}
+    with running() as server:
+        def cold():
+            tls.clear_cache()
+            connect(server).close()
+        results['connect_cold'] = summarize(measure(cold, 20 * scale))
+        results['connect_resumed'] = summarize(
+            measure(lambda: connect(server).close(), 20 * scale))
+    return results
+
+
+@benchmark
+def login_fallback(scale):
+    """Logging in to a server that only knows Admin.Login version 0."""
+    results = {}
+    tmpdir = tempfile.mkdtemp()
+    try:
+        with running(login_versions=(0,)) as server:
+            results['login_fallback'] = summarize(
+                measure(lambda: connect(server).close(), 20 * scale))
+            cache = LoginCache(os.path.join(tmpdir, 'login-cache.json'))
+            results['login_fallback_cached'] = summarize(measure(
+                lambda: connect(server, login_cache=cache).close(),
+                20 * scale))
+    finally:
+        shutil.rmtree(tmpdir)
+    return results
+
+
+@benchmark
+def rpc_latency(scale):
+    """Sequential calls on one connection, with no added latency."""
+    with running() as server:
+        conn = connect(server)
+        try:
+            timings = measure(
+                lambda: conn.rpc('Client', 'AgentVersion'), 500 * scale)
+        finally:
+            conn.close()
+    return {'rpc_latency': summarize(
+        timings, calls_per_second=len(timings) / sum(timings))}
+
+
+@benchmark
+def rpc_throughput(scale):
+    """Many threads calling on one connection, with 2ms server latency."""
+    results = {}
+    threads, calls = 8, int(25 * scale) or 1
+    with running(latency=0.002) as server:
+        for pipelined in (False, True):
+            conn = connect(server, pipelined=pipelined)
+
+            def work():
+                for _ in range(calls):
+                    conn.rpc('Client', 'AgentVersion')
+
+            try:
+                timings = measure(lambda: run_threads(work, threads), 3,
+                                  warmup=0)
+            finally:
+                conn.close()
+            name = 'rpc_throughput_{}'.format(
+                'pipelined' if pipelined else 'serial')
+            results[name] = summarize(
+                timings,
+                calls_per_second=threads * calls * len(timings) / sum(
+                    timings))
+    return results
+
+
+@benchmark
+def fullstatus(scale):
+    """Client.FullStatus calls, and decoding or streaming them, by size."""
+    results = {}
+    codec = default_codec()
+    with running() as server:
+        conn = connect(server)
+        try:
+            for units in (100, 1000, 10000):
+                server.set_status_units(units)
+                raw = conn.rpc('Client', 'FullStatus', lazy=True).raw
+                iterations = max(3, 2000 * scale / units)
+                results['fullstatus_{}'.format(units)] = summarize(
+                    measure(lambda: conn.rpc('Client', 'FullStatus'),
+                            iterations),
+                    bytes=len(raw))
+
+                def decode():
+                    codec.decode(raw)
+
+                def stream():
+                    for record in iter_status(raw):
+                        pass
+
+                results['fullstatus_decode_{}'.format(units)] = summarize(
+                    measure(decode, iterations), bytes=len(raw),
+                    codec=codec.name, peak_bytes=peak_memory(decode))
+                results['fullstatus_stream_{}'.format(units)] = summarize(
+                    measure(stream, iterations), bytes=len(raw),
+                    peak_bytes=peak_memory(stream))
+        finally:
+            conn.close()
+    return results
+
+
+@benchmark
+def compression(scale):
+    """Client.FullStatus of 1000 units over a 2MB/s link, compressed or not.
+    """
+    results = {}
+    with running(status_units=1000, bandwidth=2000000,
+                 compression=True) as server:
+        for compressed in (False, True):
+            metrics = Metrics()
+            conn = connect(
+                server, metrics=metrics,
+                transport=WebsocketTransport(compression=compressed))
+            try:
+                timings = measure(
+                    lambda: conn.rpc('Client', 'FullStatus'), 5 * scale)
+            finally:
+                conn.close()
+            stats = metrics.snapshot()['Client.FullStatus']
+            name = 'fullstatus_wan_{}'.format(
+                'deflate' if compressed else 'plain')
+            results[name] = summarize(
+                timings, bytes=stats['response_wire_bytes'] // stats['count'],
+                ratio=stats['compression_ratio'])
+    return results
+
+
+@benchmark
+def upgrade_retry(scale):
+    """Calls retried past three "upgrade in progress" errors."""
+    policy = RetryPolicy(base_delay=0.001, jitter=0, budget=None)
+    with running() as server:
+        conn = connect(server, retry_policy=policy)
+
+        def call():
+            server.upgrade_errors = 3
+            conn.rpc('Client', 'AgentVersion')
+
+        try:
+            timings = measure(call, 20 * scale)
+        finally:
+            conn.close()
+    return {'upgrade_retry': summarize(timings)}
+
+
+@benchmark
+def replay(scale):
+    """Replaying recorded traffic, at the recorded and at full speed.
+
+    Calls from several threads are recorded against a server with 2ms of
+    latency, then replayed with no server, so only the client's own costs
+    count at full speed.
+
+    """
+    results = {}
+    threads, calls = 4, int(50 * scale) or 1
+    tmpdir = tempfile.mkdtemp()
+    path = os.path.join(tmpdir, 'session.jsonl.gz')
+
+    def work(conn):
+        def calls_():
+            for _ in range(calls):
+                conn.rpc('Client', 'AgentVersion')
+
+        run_threads(calls_, threads)
+
+    try:
+        with running(latency=0.002) as server:
+            address, cacert = server.address, server.cacert
+            with RecordingTransport(path) as recorder:
+                conn = connect(server, pipelined=True, transport=recorder)
+                try:
+                    work(conn)
+                finally:
+                    conn.close()
+        for name, speed in (('replay_recorded', 1), ('replay_full', None)):
+            def run():
+                conn = Connection(
+                    address, cacert, 'user-admin', 'sekrit', pipelined=True,
+                    transport=ReplayTransport(path, speed))
+                try:
+                    work(conn)
+                finally:
+                    conn.close()
+            timings = measure(run, 3, warmup=0)
+            results[name] = summarize(
+                timings,
+                calls_per_second=threads * calls * len(timings) / sum(
+                    timings))
+    finally:
+        shutil.rmtree(tmpdir)
+    return results
+
+
+def _topology(services):
+    machines = dict((str(i), {'series': 'trusty'}) for i in range(services))
+    topology = {'machines': machines, 'services': {}, 'relations': []}
+    for i in range(services):
+        topology['services']['svc-{}'.format(i)] = {
+            'charm': 'cs:trusty/svc-{}'.format(i), 'num_units': 3,
+            'to': [str(i)], 'expose': i % 2 == 0}
+        if i:
+            topology['relations'].append(
+                ['svc-{}:db'.format(i), 'svc-0:db'])
+    return topology
+
+
+@benchmark
+def deploy_plan(scale):
+    """Deploying 20 services with 5ms latency, a call or all at a time."""
+    results = {}
+    plan_topology = _topology(20)
+    with running(latency=0.005) as server:
+        conn = connect(server, pipelined=True)
+        try:
+            for name, in_flight in (('serial', 1), ('parallel', 64)):
+                def run():
+                    report = DeploymentPlan(plan_topology).execute(
+                        conn, max_in_flight=in_flight)
+                    if not report.ok:
+                        raise RuntimeError(report.format())
+                results['deploy_plan_{}'.format(name)] = summarize(
+                    measure(run, 3 * scale, warmup=0),
+                    calls=len(DeploymentPlan(plan_topology).steps))
+        finally:
+            conn.close()
+    return results
+
+
+def _write_cache_yaml(directory, environments):
+    servers = {}
+    envs = {}
+    with open(CERT_FILE) as f:
+        cacert = f.read()
+    for i in range(environments):
+        server_uuid = 'server-{}'.format(i // 10)
+        envs['env-{}'.format(i)] = {
+            'env-uuid': 'env-uuid-{}'.format(i),
+            'server-uuid': server_uuid,
+            'user': 'admin',
+        }
+        servers[server_uuid] = {
+            'api-endpoints': ['10.0.0.{}:17070'.format(i % 250)],
+            'ca-cert': cacert,
+            'identities': {'admin': 'sekrit'},
+        }
+    with open(os.path.join(directory, 'cache.yaml'), 'w') as f:
+        yaml.safe_dump({'environment': envs, 'server-data': servers}, f)
+
+
+@benchmark
+def configstore_load(scale):
+    """Looking an environment up in a cache.yaml of 500 environments."""
+    results = {}
+    tmpdir = tempfile.mkdtemp()
+    try:
+        _write_cache_yaml(tmpdir, 500)
+        store = configstore.ConfigStore(tmpdir)
+
+        def cold():
+            configstore.clear_cache()
+            store.connection_info('env-250')
+        results['configstore_cold'] = summarize(measure(cold, 5 * scale))
+        results['configstore_warm'] = summarize(measure(
+            lambda: store.connection_info('env-250'), 500 * scale))
+    finally:
+        shutil.rmtree(tmpdir)
+        configstore.clear_cache()
+    return results
+
+
+_IMPORT_SCRIPT = """
+import json, sys, time
+before = set(sys.modules)
+start = time.time()
+{}
+seconds = time.time() - start
+sys.stdout.write(json.dumps([seconds, sorted(set(sys.modules) - before)]))
+"""
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def time_import(code):
+    """Return the seconds code took in a fresh interpreter, and the modules
+    it imported."""
+    # Run from the root, so that it's this tree's juju that's imported.
+    output = subprocess.check_output(
+        [sys.executable, '-c', _IMPORT_SCRIPT.format(code)], cwd=ROOT)
+    seconds, modules = json.loads(output.decode('utf-8'))
+    return seconds, modules
+
+
+@benchmark
+def import_time(scale):
+    """Importing juju, and looking up an environment, in a new process."""
+    results = {}
+    tmpdir = tempfile.mkdtemp()
+    try:
+        _write_cache_yaml(tmpdir, 1)
+        cases = [
+            ('import_juju', 'import juju'),
+            ('import_apiclient', 'import juju.apiclient'),
+            ('import_connection_info',
+             'import juju.apiclient\n'
+             'from juju.configstore import ConfigStore\n'
+             'ConfigStore({!r}).connection_info("env-0")'.format(tmpdir)),
+        ]
+        for name, code in cases:
+            timings = []
+            for _ in range(max(3, int(10 * scale))):
+                seconds, modules = time_import(code)
+                timings.append(seconds)
+            results[name] = summarize(timings, modules=len(modules))
+    finally:
+        shutil.rmtree(tmpdir)
+    return results
+
+
+def run(names=None, scale=1, out=sys.stdout):
+    """Run the named benchmarks, or all of them, and return the report."""
+    report = {
+        'python': platform.python_version(),
+        'implementation': platform.python_implementation(),
+        'platform': platform.platform(),
+        'codec': default_codec().name,
+        'time': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'results': {},
+    }
+    for name in names or BENCHMARKS:
+        if out is not None:
+            out.write('{}...\n'.format(name))
+            out.flush()
+        report['results'].update(BENCHMARKS[name](scale))
+    return report
+
+
+def format_report(report):
+    lines = ['{:<32} {:>10} {:>10} {:>10} {:>6}'.format(
+        'benchmark', 'median ms', 'p95 ms', 'max ms', 'n')]
+    for name in sorted(report['results']):
+        result = report['results'][name]
+        line = '{:<32} {:>10.3f} {:>10.3f} {:>10.3f} {:>6}'.format(
+            name, result['median'] * 1000, result['p95'] * 1000,
+            result['max'] * 1000, result['iterations'])
+        if 'calls_per_second' in result:
+            line += '  {:.0f} calls/s'.format(result['calls_per_second'])
+        if 'bytes' in result:
+            line += '  {} bytes'.format(result['bytes'])
+        if result.get('peak_bytes') is not None:
+            line += ', peak {} KB'.format(result['peak_bytes'] // 1024)
+        if (result.get('ratio') or 1) > 1:
+            line += ' ({:.1f}x compressed)'.format(result['ratio'])
+        if 'modules' in result:
+            line += '  {} modules'.format(result['modules'])
+        lines.append(line)
+    return '\n'.join(lines)
+
+
+def compare(baseline, report, threshold=0.1):
+    """Return the comparison lines, and the names of any regressions.
+
+    A benchmark has regressed if its median is more than threshold (a
+    fraction) slower than in the baseline.
+
+    """
+    lines = ['{:<32} {:>10} {:>10} {:>8}'.format(
+        'benchmark', 'before ms', 'after ms', 'change')]
+    regressions = []
+    for name in sorted(report['results']):
+        if name not in baseline['results']:
+            continue
+        before = baseline['results'][name]['median']
+        after = report['results'][name]['median']
+        change = (after - before) / before if before else 0
+        line = '{:<32} {:>10.3f} {:>10.3f} {:>+7.1f}%'.format(
+            name, before * 1000, after * 1000, change * 100)
+        if change > threshold:
+            regressions.append(name)
+            line += '  REGRESSION'
+        lines.append(line)
+    return lines, regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument(
+        'benchmarks', nargs='*', metavar='BENCHMARK',
+        help='the benchmarks to run, by default all of them: {}'.format(
+            ', '.join(BENCHMARKS)))
+    parser.add_argument(
+        '--scale', type=float, default=1,
+        help='multiply the iterations of each benchmark by this')
+    parser.add_argument('--output', help='save the report as JSON here')
+    parser.add_argument(
+        '--compare', metavar='BASELINE',
+        help='compare with a report saved by an earlier run')
+    parser.add_argument(
+        '--threshold', type=float, default=0.1,
+        help='the slowdown, as a fraction, counted as a regression')
+    args = parser.parse_args(argv)
+    unknown = set(args.benchmarks) - set(BENCHMARKS)
+    if unknown:
+        parser.error('unknown benchmarks: {}'.format(
+            ', '.join(sorted(unknown))))
+    report = run(args.benchmarks, args.scale)
+    print(format_report(report))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        lines, regressions = compare(baseline, report, args.threshold)
+        print('')
+        print('\n'.join(lines))
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
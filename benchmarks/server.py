@@ -0,0 +1,333 @@
+"""A fake Juju API server, for benchmarking the client against.
+
+The server speaks just enough of the websocket protocol, over TLS, to
+answer the client: Admin.Login with a facade table (optionally only for some
+login versions, to exercise the login fallback), Client.FullStatus with a
+status of a chosen size, Client.AddMachines with machine ids, and an empty
+response to anything else. It can add
+latency to each response, limit its bandwidth, compress messages with
+permessage-deflate and answer the first calls with "upgrade in progress"
+errors.
+
+    >>> server = FakeAPIServer(latency=0.001)
+    >>> server.start()
+    >>> conn = Connection(server.address, server.cacert, "user-admin", "pw")
+    >>> server.stop()
+
+"""
+import base64
+import hashlib
+import json
+import os
+import socket
+import ssl
+import struct
+import threading
+import time
+import zlib
+
+import websocket
+
+
+DATA_DIR = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    'tests', 'data')
+CERT_FILE = os.path.join(DATA_DIR, 'server-cert.pem')
+KEY_FILE = os.path.join(DATA_DIR, 'server-key.pem')
+
+_GUID = '258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+
+FACADES = [
+    {'Name': 'Admin', 'Versions': [0, 1, 2]},
+    {'Name': 'AllWatcher', 'Versions': [0]},
+    {'Name': 'Client', 'Versions': [0]},
+    {'Name': 'Pinger', 'Versions': [0]},
+]
+
+
+def make_status(units, units_per_machine=4, units_per_service=10):
+    """Return a Client.FullStatus response with the given number of units.
+
+    The units are spread over services and machines, as in a real
+    environment, so that the size of the response grows with them.
+
+    """
+    machines = {}
+    services = {}
+    for i in range(units):
+        machine_id = str(i // units_per_machine)
+        service = 'service-{}'.format(i // units_per_service)
+        if machine_id not in machines:
+            machines[machine_id] = {
+                'Id': machine_id,
+                'InstanceId': 'i-{:08x}'.format(int(machine_id)),
+                'DNSName': '10.0.{}.{}'.format(
+                    int(machine_id) // 250, int(machine_id) % 250),
+                'Series': 'trusty',
+                'AgentState': 'started',
+                'AgentVersion': '1.25.0',
+                'Hardware': 'arch=amd64 cpu-cores=4 mem=16384M',
+                'Jobs': ['JobHostUnits'],
+                'HasVote': False,
+                'WantsVote': False,
+                'Containers': {},
+            }
+        if service not in services:
+            services[service] = {
+                'Charm': 'cs:trusty/{}-7'.format(service),
+                'Exposed': False,
+                'Life': '',
+                'Relations': {'peer': [service]},
+                'Networks': {'Enabled': [], 'Disabled': []},
+                'SubordinateTo': [],
+                'Units': {},
+            }
+        unit = '{}/{}'.format(service, i % units_per_service)
+        services[service]['Units'][unit] = {
+            'AgentState': 'started',
+            'AgentVersion': '1.25.0',
+            'Machine': machine_id,
+            'OpenedPorts': ['80/tcp'],
+            'PublicAddress': machines[machine_id]['DNSName'],
+            'Charm': '',
+            'Subordinates': {},
+            'Workload': {'Status': 'active', 'Info': 'ready'},
+        }
+    return {
+        'EnvironmentName': 'bench',
+        'Machines': machines,
+        'Services': services,
+        'Networks': {},
+        'Relations': [],
+    }
+
+
+class FakeAPIServer(object):
+    """A threaded fake of a Juju API server, listening on localhost.
+
+    login_versions: the Admin.Login versions the server answers; others get
+    a "not implemented" error, as from older servers.
+
+    latency: seconds to wait before sending each response. Responses are
+    sent from timers, so that pipelined requests overlap.
+
+    status_units: the number of units in the FullStatus response.
+
+    upgrade_errors: how many calls (after logging in) are answered with an
+    "upgrade in progress" error before the server starts answering them.
+
+    bandwidth: if given, the bytes per second each connection sends at, to
+    stand in for a slow link.
+
+    compression: whether to accept permessage-deflate, compressing
+    responses of at least 256 bytes when the client asks for it.
+
+    """
+
+    def __init__(self, login_versions=(2, 1, 0), latency=0, status_units=10,
+                 upgrade_errors=0, bandwidth=None, compression=False):
+        self.login_versions = login_versions
+        self.latency = latency
+        self.upgrade_errors = upgrade_errors
+        self.bandwidth = bandwidth
+        self.compression = compression
+        self.set_status_units(status_units)
+        with open(CERT_FILE) as f:
+            self.cacert = f.read()
+        self._context = ssl.SSLContext(
+            getattr(ssl, 'PROTOCOL_TLS_SERVER', ssl.PROTOCOL_SSLv23))
+        self._context.load_cert_chain(CERT_FILE, KEY_FILE)
+        self._lock = threading.Lock()
+        self._sock = None
+        self._stopping = False
+        self.requests = 0
+
+    def set_status_units(self, units):
+        self.status_units = units
+        self._status = make_status(units)
+
+    @property
+    def address(self):
+        return '{}:{}'.format(*self._sock.getsockname()[:2])
+
+    def start(self):
+        self._sock = socket.socket()
+        self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._sock.bind(('127.0.0.1', 0))
+        self._sock.listen(128)
+        thread = threading.Thread(target=self._serve, name="fake-api-server")
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        self._stopping = True
+        try:
+            # Wake the accept call up.
+            socket.create_connection(self._sock.getsockname()[:2]).close()
+        except socket.error:
+            pass
+        self._sock.close()
+
+    def _serve(self):
+        while not self._stopping:
+            try:
+                sock, _ = self._sock.accept()
+            except socket.error:
+                return
+            if self._stopping:
+                sock.close()
+                return
+            thread = threading.Thread(target=self._handle, args=(sock,))
+            thread.daemon = True
+            thread.start()
+
+    def _handle(self, sock):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        try:
+            sock = self._context.wrap_socket(sock, server_side=True)
+            stream = _Stream(sock, self.bandwidth)
+            stream.handshake(self.compression)
+            while True:
+                message = stream.read_message()
+                if message is None:
+                    return
+                self._respond(stream, json.loads(message))
+        except (socket.error, ssl.SSLError, ValueError):
+            pass
+        finally:
+            sock.close()
+
+    def _respond(self, stream, request):
+        frame = {'RequestId': request['RequestId']}
+        frame.update(self.handle(request))
+        data = json.dumps(frame)
+        if self.latency:
+            timer = threading.Timer(self.latency, stream.send, (data,))
+            timer.daemon = True
+            timer.start()
+        else:
+            stream.send(data)
+
+    def handle(self, request):
+        """Return the Response (or Error) fields of the reply to a request."""
+        facade, method = request['Type'], request['Request']
+        if facade == 'Admin' and method == 'Login':
+            if request.get('Version', 0) not in self.login_versions:
+                return {'Error': 'no such request - method Admin.Login',
+                        'ErrorCode': 'not implemented'}
+            return {'Response': {'facades': FACADES}}
+        with self._lock:
+            self.requests += 1
+            if self.upgrade_errors > 0:
+                self.upgrade_errors -= 1
+                return {'Error': 'upgrade in progress',
+                        'ErrorCode': 'upgrade in progress'}
+        if facade == 'Client' and method == 'FullStatus':
+            return {'Response': self._status}
+        if facade == 'Client' and method == 'AddMachines':
+            params = request['Params']['MachineParams']
+            return {'Response': {'Machines': [
+                {'Machine': str(i)} for i in range(len(params))]}}
+        return {'Response': {}}
+
+
+class _Stream(object):
+    """The server's side of a websocket."""
+
+    def __init__(self, sock, bandwidth=None):
+        self.sock = sock
+        self.bandwidth = bandwidth
+        self.deflate = False
+        self._buffer = b''
+        self._send_lock = threading.Lock()
+        self._compressor = zlib.compressobj(6, zlib.DEFLATED, -15)
+        self._decompressor = zlib.decompressobj(-15)
+
+    def _read(self, n):
+        while len(self._buffer) < n:
+            data = self.sock.recv(65536)
+            if not data:
+                raise socket.error("connection closed")
+            self._buffer += data
+        data, self._buffer = self._buffer[:n], self._buffer[n:]
+        return data
+
+    def handshake(self, compression=False):
+        request = b''
+        while b'\r\n\r\n' not in request:
+            data = self.sock.recv(4096)
+            if not data:
+                raise socket.error("connection closed")
+            request += data
+        request, self._buffer = request.split(b'\r\n\r\n', 1)
+        headers = {}
+        for line in request.decode('latin-1').split('\r\n')[1:]:
+            name, _, value = line.partition(':')
+            headers[name.strip().lower()] = value.strip()
+        accept = base64.b64encode(hashlib.sha1(
+            (headers['sec-websocket-key'] + _GUID).encode('ascii')).digest())
+        extensions = b''
+        if compression and 'permessage-deflate' in headers.get(
+                'sec-websocket-extensions', ''):
+            self.deflate = True
+            extensions = b'Sec-WebSocket-Extensions: permessage-deflate\r\n'
+        self.sock.sendall(
+            b'HTTP/1.1 101 Switching Protocols\r\n'
+            b'Upgrade: websocket\r\n'
+            b'Connection: Upgrade\r\n' + extensions +
+            b'Sec-WebSocket-Accept: ' + accept + b'\r\n\r\n')
+
+    def read_message(self):
+        """Return the next text message, or None once the client closes."""
+        message = b''
+        compressed = False
+        while True:
+            first, second = struct.unpack('!BB', self._read(2))
+            fin, opcode = first & 0x80, first & 0x0f
+            if opcode in (websocket.ABNF.OPCODE_TEXT,
+                          websocket.ABNF.OPCODE_BINARY):
+                compressed = bool(first & 0x40)
+            length = second & 0x7f
+            if length == 126:
+                length = struct.unpack('!H', self._read(2))[0]
+            elif length == 127:
+                length = struct.unpack('!Q', self._read(8))[0]
+            mask = self._read(4) if second & 0x80 else None
+            payload = self._read(length)
+            if mask is not None:
+                payload = websocket.ABNF.mask(mask, payload)
+            if opcode == websocket.ABNF.OPCODE_CLOSE:
+                self._send_frame(payload, websocket.ABNF.OPCODE_CLOSE)
+                return None
+            if opcode == websocket.ABNF.OPCODE_PING:
+                self._send_frame(payload, websocket.ABNF.OPCODE_PONG)
+                continue
+            if opcode == websocket.ABNF.OPCODE_PONG:
+                continue
+            message += payload
+            if fin:
+                if compressed:
+                    message = self._decompressor.decompress(
+                        message + b'\x00\x00\xff\xff')
+                return message.decode('utf-8')
+
+    def send(self, text):
+        try:
+            self._send_frame(text.encode('utf-8'), websocket.ABNF.OPCODE_TEXT)
+        except (socket.error, ssl.SSLError):
+            pass
+
+    def _send_frame(self, payload, opcode):
+        with self._send_lock:
+            rsv1 = 0
+            if (self.deflate and opcode == websocket.ABNF.OPCODE_TEXT and
+                    len(payload) >= 256):
+                # Compressed under the lock, as the context carries over.
+                payload = (self._compressor.compress(payload) +
+                           self._compressor.flush(zlib.Z_SYNC_FLUSH))[:-4]
+                rsv1 = 1
+            frame = websocket.ABNF(
+                1, rsv1, 0, 0, opcode, 0, payload).format()
+            if self.bandwidth:
+                time.sleep(len(frame) / float(self.bandwidth))
+            self.sock.sendall(frame)
@@ -1,3 +1,29 @@
-__all__ = ["Environment"]
+import sys
 
-from .environment import Environment
+__all__ = ["Environment", "System"]
+
+# The modules the public names come from, imported when a name is first
+# used so that importing juju stays cheap.
+_LAZY = {
+    "Environment": "environment",
+    "System": "system",
+}
+
+if sys.version_info >= (3, 7):
+    import importlib
+
+    def __getattr__(name):
+        module = _LAZY.get(name)
+        if module is None:
+            raise AttributeError(
+                "module {!r} has no attribute {!r}".format(__name__, name))
+        value = getattr(importlib.import_module("." + module, __name__), name)
+        globals()[name] = value
+        return value
+
+    def __dir__():
+        return sorted(set(globals()) | set(_LAZY))
+else:
+    # Module __getattr__ (PEP 562) needs Python 3.7.
+    from .environment import Environment  # noqa
+    from .system import System  # noqa
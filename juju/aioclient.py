@@ -0,0 +1,351 @@
+"""An asyncio counterpart to the blocking juju.apiclient module.
+
+AsyncConnection speaks the same RPC protocol as apiclient.Connection, but
+over a websocket implemented on asyncio streams, so any number of calls can
+be outstanding on one connection without a thread per call:
+
+    >>> conn = await open_environment("local")
+    >>> client = conn.get_facade("Client")
+    >>> statuses = await asyncio.gather(*[
+    ...     client.FullStatus() for _ in range(100)])
+
+This module requires Python 3.5 or later.
+
+"""
+import asyncio
+import base64
+import functools
+import hashlib
+import logging
+import os
+import struct
+import time
+from urllib.parse import urlparse
+
+import websocket
+
+from .apiclient import (
+    Connection,
+    ConnectionClosed,
+    FacadeVersionNotSupported,
+    NotImplementedError,
+    UnknownFacade,
+    new_error,
+)
+from .codec import LogFrame, default_codec
+from .configstore import ConfigStore
+from .retry import RetryPolicy
+from . import tls
+
+
+logger = logging.getLogger("juju")
+
+_WEBSOCKET_GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+
+
+class AsyncWebSocket(object):
+    """A minimal client side websocket on top of asyncio streams.
+
+    Only what the Juju API needs is supported: text messages, fragmented
+    messages, ping replies and close.
+
+    """
+
+    def __init__(self, reader, writer):
+        self._reader = reader
+        self._writer = writer
+        self._write_lock = asyncio.Lock()
+        self.closed = False
+
+    @classmethod
+    async def open(cls, endpoint, ssl_context=None):
+        """Open a websocket to the endpoint and perform the handshake.
+
+        If ssl_context is None a plain TCP connection is used.
+
+        """
+        url = urlparse(endpoint)
+        port = url.port or (443 if ssl_context is not None else 80)
+        reader, writer = await asyncio.open_connection(
+            url.hostname, port, ssl=ssl_context,
+            server_hostname=url.hostname if ssl_context else None)
+        key = base64.b64encode(os.urandom(16)).decode('ascii')
+        request = (
+            "GET {resource} HTTP/1.1\r\n"
+            "Host: {host}\r\n"
+            "Upgrade: websocket\r\n"
+            "Connection: Upgrade\r\n"
+            "Sec-WebSocket-Key: {key}\r\n"
+            "Sec-WebSocket-Version: 13\r\n"
+            "Origin: {origin}\r\n"
+            "\r\n").format(
+                resource=url.path or "/", host=url.netloc, key=key,
+                origin=endpoint)
+        writer.write(request.encode('ascii'))
+        await writer.drain()
+        head = await reader.readuntil(b"\r\n\r\n")
+        lines = head.decode('latin-1').split("\r\n")
+        status = lines[0].split(" ", 2)
+        if len(status) < 2 or status[1] != "101":
+            writer.close()
+            raise ConnectionClosed(
+                "websocket handshake failed: {}".format(lines[0]))
+        headers = dict(
+            (k.strip().lower(), v.strip())
+            for k, _, v in (line.partition(":") for line in lines[1:] if line))
+        expected = base64.b64encode(hashlib.sha1(
+            (key + _WEBSOCKET_GUID).encode('ascii')).digest()).decode('ascii')
+        if headers.get("sec-websocket-accept") != expected:
+            writer.close()
+            raise ConnectionClosed("websocket handshake failed: bad accept")
+        return cls(reader, writer)
+
+    async def send(self, data):
+        await self._write_frame(data, websocket.ABNF.OPCODE_TEXT)
+
+    async def _write_frame(self, data, opcode):
+        if self.closed:
+            raise ConnectionClosed("connection closed")
+        frame = websocket.ABNF.create_frame(data, opcode).format()
+        async with self._write_lock:
+            self._writer.write(frame)
+            await self._writer.drain()
+
+    async def recv(self):
+        """Return the next text message, answering pings along the way."""
+        message = []
+        while True:
+            fin, opcode, payload = await self._read_frame()
+            if opcode == websocket.ABNF.OPCODE_PING:
+                await self._write_frame(payload, websocket.ABNF.OPCODE_PONG)
+            elif opcode == websocket.ABNF.OPCODE_PONG:
+                pass
+            elif opcode == websocket.ABNF.OPCODE_CLOSE:
+                await self.close()
+                raise ConnectionClosed("connection closed by server")
+            else:
+                message.append(payload)
+                if fin:
+                    return b"".join(message).decode('utf-8')
+
+    async def _read_frame(self):
+        try:
+            b1, b2 = await self._reader.readexactly(2)
+            length = b2 & 0x7f
+            if length == 126:
+                length, = struct.unpack(
+                    "!H", await self._reader.readexactly(2))
+            elif length == 127:
+                length, = struct.unpack(
+                    "!Q", await self._reader.readexactly(8))
+            mask_key = None
+            if b2 & 0x80:
+                mask_key = await self._reader.readexactly(4)
+            payload = await self._reader.readexactly(length)
+        except (asyncio.IncompleteReadError, OSError) as e:
+            self.closed = True
+            raise ConnectionClosed(str(e) or "connection closed")
+        if mask_key is not None:
+            payload = websocket.ABNF.mask(mask_key, payload)
+        return bool(b1 & 0x80), b1 & 0x0f, payload
+
+    async def close(self):
+        if self.closed:
+            return
+        try:
+            await self._write_frame(
+                struct.pack("!H", websocket.STATUS_NORMAL),
+                websocket.ABNF.OPCODE_CLOSE)
+        except (ConnectionClosed, OSError):
+            pass
+        self.closed = True
+        self._writer.close()
+
+
+class AsyncFacade(object):
+    """The asyncio equivalent of apiclient.Facade.
+
+    Method calls on the facade return coroutines for the RPC call:
+
+        >>> client = AsyncFacade(connection, "Client")
+        >>> result = await client.FullStatus()
+
+    """
+
+    def __init__(self, connection, name, version=None):
+        self.connection = connection
+        self.name = name
+        self.version = version
+
+    def __getattr__(self, attr):
+        return functools.partial(
+            self.connection.rpc, self.name, attr, version=self.version)
+
+
+class AsyncConnection(object):
+    """An open, authenticated API connection driven by an asyncio loop.
+
+    Use the connect coroutine rather than constructing these directly. Every
+    connection is pipelined: a reader task matches responses to requests by
+    their RequestId.
+
+    """
+
+    def __init__(self, websocket, retry_policy=None, codec=None):
+        self._websocket = websocket
+        if codec is None:
+            codec = default_codec()
+        self._codec = codec
+        if retry_policy is None:
+            retry_policy = RetryPolicy()
+        self._retry_policy = retry_policy
+        self._retry_budget = retry_policy.new_budget()
+        self._request_id = 0
+        self._pending = {}
+        self._info = None
+        self._facade_versions = {}
+        self._reader = asyncio.ensure_future(self._read_loop())
+
+    @classmethod
+    async def connect(cls, address, cacert, auth_tag, credentials,
+                      nonce="", env_uuid="", retry_policy=None, codec=None):
+        """Open and authenticate a connection.
+
+        The parameters are the same as for apiclient.Connection.
+
+        """
+        endpoint = Connection._endpoint(address, env_uuid)
+        ws = await AsyncWebSocket.open(endpoint, tls.ssl_context(cacert))
+        connection = cls(ws, retry_policy, codec)
+        try:
+            connection._info = await connection._authenticate(
+                auth_tag, credentials, nonce)
+        except Exception:
+            await connection.close()
+            raise
+        connection._generate_facades()
+        return connection
+
+    async def _authenticate(self, auth_tag, credentials, nonce):
+        # Start with version 2 of admin facade and work our way back.
+        for version in (2, 1, 0):
+            try:
+                self._auth_creds = Connection._login_args(
+                    version, auth_tag, credentials, nonce)
+                return await self.rpc(
+                    "Admin", "Login", self._auth_creds, version=version)
+            except NotImplementedError:
+                # do nothing and try the previous version
+                pass
+        raise RuntimeError("unexpected missing login command")
+
+    async def rpc(self, facade, func, params=None, version=None):
+        if params is None:
+            params = {}
+        op = {
+            'Type': facade,
+            'Request': func,
+            'Params': params,
+            'RequestId': self._request_id
+        }
+        if version is not None:
+            op['Version'] = version
+        self._request_id += 1
+        result = await self._rpc_with_retries(op)
+        if 'Error' in result:
+            raise new_error(result)
+        return result['Response']
+
+    async def _rpc_with_retries(self, op):
+        """Make the call, retrying it as the retry policy says."""
+        start = time.time()
+        attempt = 0
+        while True:
+            result = await self._send_request(op)
+            delay = self._retry_policy.retry_delay(
+                result, attempt, time.time() - start, self._retry_budget)
+            if delay is None:
+                return result
+            logger.info(
+                "retrying %s.%s in %.2fs: %s", op['Type'], op['Request'],
+                delay, result['Error'])
+            attempt += 1
+            await asyncio.sleep(delay)
+
+    async def _send_request(self, op):
+        if self._reader.done():
+            raise ConnectionClosed("connection closed")
+        data = self._codec.encode(op)
+        logger.debug("rpc request: %s", LogFrame(data))
+        future = asyncio.get_event_loop().create_future()
+        self._pending[op['RequestId']] = future
+        try:
+            await self._websocket.send(data)
+            return await future
+        finally:
+            self._pending.pop(op['RequestId'], None)
+
+    async def _read_loop(self):
+        try:
+            while True:
+                raw = await self._websocket.recv()
+                logger.debug("rpc response: %s", LogFrame(raw))
+                result = self._codec.decode(raw)
+                future = self._pending.pop(result.get('RequestId'), None)
+                if future is None or future.done():
+                    logger.warning(
+                        "discarding response to unknown request %s",
+                        result.get('RequestId'))
+                    continue
+                future.set_result(result)
+        except Exception as e:
+            logger.debug("rpc reader stopping: %s", e)
+            error = e if isinstance(e, ConnectionClosed) else \
+                ConnectionClosed(str(e))
+            pending, self._pending = self._pending, {}
+            for future in pending.values():
+                if not future.done():
+                    future.set_exception(error)
+
+    async def close(self):
+        await self._websocket.close()
+        self._reader.cancel()
+        pending, self._pending = self._pending, {}
+        for future in pending.values():
+            if not future.done():
+                future.set_exception(ConnectionClosed("connection closed"))
+
+    def _generate_facades(self):
+        self._facade_versions = dict([
+            (facade['Name'], facade['Versions'])
+            for facade in self._info['facades']
+        ])
+
+    def get_facade(self, name, version=None):
+        try:
+            versions = self._facade_versions[name]
+            if version is None:
+                version = max(versions)
+            if version in versions:
+                return AsyncFacade(self, name, version)
+            raise FacadeVersionNotSupported(
+                "{} version {}".format(name, version))
+        except KeyError:
+            raise UnknownFacade(name)
+
+
+async def open_environment(env_name):
+    """Return an AsyncConnection to a named environment.
+
+    This is the asyncio equivalent of apiclient.open_environment.
+
+    """
+    store = ConfigStore()
+    info = store.connection_info(env_name)
+    auth_tag = "user-{}".format(info['user'])
+    credentials = info['password']
+    return await AsyncConnection.connect(
+        info['state-servers'][0],
+        info['ca-cert'],
+        auth_tag, credentials,
+        env_uuid=info['environ-uuid'])
@@ -1,28 +1,26 @@
+import collections
 import functools
-import json
 import logging
-import ssl
-import tempfile
+import threading
 import time
 
-import websocket
+try:
+    import queue
+except ImportError:
+    import Queue as queue
 
+from .cache import is_mutating
+from .codec import LogFrame, decode_envelope, default_codec
 from .configstore import ConfigStore
+from .retry import RetryPolicy, scheduler
+from .transport import WebsocketTransport, import_websocket
 
 
-# There are two pypi modules with the name websocket (python-websocket
-# and websocket) We utilize python-websocket, sniff and error if we
-# find the wrong one.
-try:
-    websocket.create_connection
-except AttributeError:
-    raise RuntimeError(
-        "Expected 'python-websocket' package or 'websocket-client' from pypi, "
-        "found incompatible gevent 'websocket'")
+logger = logging.getLogger("juju")
 
 
-websocket.logger = logging.getLogger("websocket")
-logger = logging.getLogger("juju")
+# The timeout of calls that don't give one, meaning the connection's.
+_DEFAULT_TIMEOUT = object()
 
 
 class UnknownFacade(Exception):
@@ -39,6 +37,18 @@ class FacadeVersionNotSupported(Exception):
     """Raised if the requested facade version isn't supported."""
 
 
+class ConnectionClosed(Exception):
+    """Raised for calls that can't complete because the connection is gone."""
+
+
+class RPCTimeout(RuntimeError):
+    """Raised for calls that don't complete within their timeout."""
+
+
+class RPCCancelled(Exception):
+    """Raised for calls that were cancelled before they completed."""
+
+
 class ServerError(Exception):
     """Base exception class for particular server side errors.
 
@@ -73,6 +83,16 @@ class NotImplementedError(ServerError):
         super(NotImplementedError, self).__init__(*args)
 
 
+def is_idempotent(op):
+    """Return whether a request can safely be sent more than once.
+
+    Calls on server side objects, such as watchers, and calls that may
+    change the environment (see cache.is_mutating) are not.
+
+    """
+    return 'Id' not in op and not is_mutating(op['Type'], op['Request'])
+
+
 def new_error(response):
     """Constructs a specific exception type based on the ErrorCode."""
     err_code = response.get("ErrorCode")
@@ -82,6 +102,177 @@ def new_error(response):
     return ServerError(err_code, message)
 
 
+def new_result_error(error):
+    """Constructs the exception for an error in a bulk call's results.
+
+    Bulk calls report errors per entity as {"Message": ..., "Code": ...}
+    rather than in the response itself.
+
+    """
+    return new_error({"Error": error.get("Message"),
+                      "ErrorCode": error.get("Code")})
+
+
+class RPCFuture(object):
+    """The eventual result of an RPC call made on a pipelined connection.
+
+    Futures are returned by Connection.submit. The result method blocks until
+    the response has arrived and either returns the response or raises the
+    error the call resulted in. Callbacks added with add_done_callback are
+    called with the future as the only argument once it is done, from the
+    thread that completed it.
+
+    cancel fails the call with RPCCancelled, if it isn't already done, and
+    has the connection discard the response when it arrives.
+
+    """
+
+    def __init__(self, request_id=None, on_cancel=None):
+        self.request_id = request_id
+        self._on_cancel = on_cancel
+        self._done = threading.Event()
+        self._lock = threading.Lock()
+        self._callbacks = []
+        self._result = None
+        self._exception = None
+
+    def done(self):
+        return self._done.is_set()
+
+    def result(self, timeout=None):
+        self._wait(timeout)
+        if self._exception is not None:
+            raise self._exception
+        return self._result
+
+    def exception(self, timeout=None):
+        self._wait(timeout)
+        return self._exception
+
+    def _wait(self, timeout):
+        if not self._done.wait(timeout):
+            raise RPCTimeout(
+                "request {} not done after {}s".format(
+                    self.request_id, timeout))
+
+    def cancel(self):
+        """Cancel the call, returning False if it was already done."""
+        if not self._complete(None, RPCCancelled(
+                "request {} cancelled".format(self.request_id))):
+            return False
+        if self._on_cancel is not None:
+            self._on_cancel()
+        return True
+
+    def add_done_callback(self, fn):
+        with self._lock:
+            if not self._done.is_set():
+                self._callbacks.append(fn)
+                return
+        fn(self)
+
+    def set_result(self, result):
+        self._complete(result, None)
+
+    def set_exception(self, exception):
+        self._complete(None, exception)
+
+    def _complete(self, result, exception):
+        with self._lock:
+            if self._done.is_set():
+                return False
+            self._result = result
+            self._exception = exception
+            self._done.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for fn in callbacks:
+            try:
+                fn(self)
+            except Exception:
+                logger.exception("exception calling rpc callback")
+        return True
+
+
+BatchResult = collections.namedtuple("BatchResult", "item result error")
+
+
+class Batch(object):
+    """Collects per-entity calls to a bulk facade method.
+
+    Many facade methods take a list of entities and return a list of results
+    in the same order. A batch collects the items, sends them in as few calls
+    as possible, at most chunk_size items at a time, and hands back a
+    BatchResult for each item, holding either the result or the error for
+    that item:
+
+        >>> batch = client.batch("Life")
+        >>> for tag in unit_tags:
+        ...     batch.add({"Tag": tag})
+        >>> for r in batch.execute():
+        ...     print(r.item["Tag"], r.error or r.result["Life"])
+
+    When the connection is pipelined all the chunks are in flight at once.
+
+    """
+    default_chunk_size = 500
+
+    def __init__(self, facade, method, key="Entities", chunk_size=None):
+        self.facade = facade
+        self.method = method
+        self.key = key
+        if chunk_size is None:
+            chunk_size = self.default_chunk_size
+        if chunk_size < 1:
+            raise ValueError("chunk_size must be positive")
+        self.chunk_size = chunk_size
+        self.items = []
+
+    def __len__(self):
+        return len(self.items)
+
+    def add(self, item):
+        """Add an item to the batch, returning its index in the results."""
+        self.items.append(item)
+        return len(self.items) - 1
+
+    def execute(self):
+        """Make the calls and return a BatchResult for each item."""
+        items, self.items = self.items, []
+        chunks = [
+            items[i:i + self.chunk_size]
+            for i in range(0, len(items), self.chunk_size)]
+        futures = [
+            self.facade.connection.submit(
+                self.facade.name, self.method, {self.key: chunk},
+                version=self.facade.version)
+            for chunk in chunks]
+        results = []
+        for chunk, future in zip(chunks, futures):
+            results.extend(self._chunk_results(chunk, future))
+        return results
+
+    def _chunk_results(self, chunk, future):
+        try:
+            response = future.result()
+        except ServerError as e:
+            return [BatchResult(item, None, e) for item in chunk]
+        chunk_results = response.get("Results") or []
+        if len(chunk_results) != len(chunk):
+            raise RuntimeError(
+                "{}.{} returned {} results for {} items".format(
+                    self.facade.name, self.method, len(chunk_results),
+                    len(chunk)))
+        results = []
+        for item, result in zip(chunk, chunk_results):
+            error = result.get("Error")
+            if error:
+                results.append(
+                    BatchResult(item, None, new_result_error(error)))
+            else:
+                results.append(BatchResult(item, result, None))
+        return results
+
+
 class Facade(object):
     """The Facade instances provide convenient syntactic sugar for API calls.
 
@@ -106,18 +297,97 @@ class Facade(object):
         self.version = version
 
     def __getattr__(self, attr):
-        return functools.partial(
+        if attr.startswith('__'):
+            raise AttributeError(attr)
+        method = functools.partial(
             self.connection.rpc, self.name, attr, version=self.version)
+        # Keep the method, so it's found without calling __getattr__ again.
+        setattr(self, attr, method)
+        return method
+
+    def batch(self, method, key="Entities", chunk_size=None):
+        """Return a Batch collecting items for the bulk method."""
+        return Batch(self, method, key, chunk_size)
+
+    def bulk(self, method, items, key="Entities", chunk_size=None):
+        """Call the bulk method for all the items, in chunks.
+
+        Returns a BatchResult for each item, in the same order.
+
+        """
+        batch = self.batch(method, key, chunk_size)
+        for item in items:
+            batch.add(item)
+        return batch.execute()
+
+
+class EndpointStats(object):
+    """Remembers how long connecting to each API server address took.
+
+    Addresses that have connected are ordered fastest first, followed by
+    addresses not tried yet, then those that failed last time.
+
+    """
+
+    def __init__(self, smoothing=0.5):
+        self.smoothing = smoothing
+        self._lock = threading.Lock()
+        self._latency = {}
+        self._failed = set()
+
+    def record(self, address, seconds):
+        with self._lock:
+            self._failed.discard(address)
+            previous = self._latency.get(address)
+            if previous is not None:
+                seconds = (self.smoothing * seconds +
+                           (1 - self.smoothing) * previous)
+            self._latency[address] = seconds
+
+    def record_failure(self, address):
+        with self._lock:
+            self._latency.pop(address, None)
+            self._failed.add(address)
+
+    def latency(self, address):
+        """The smoothed connection time for the address, if known."""
+        with self._lock:
+            return self._latency.get(address)
+
+    def order(self, addresses):
+        with self._lock:
+            def key(indexed):
+                index, address = indexed
+                if address in self._latency:
+                    return (0, self._latency[address], index)
+                if address in self._failed:
+                    return (2, 0, index)
+                return (1, 0, index)
+            return [a for _, a in sorted(enumerate(addresses), key=key)]
+
+
+endpoint_stats = EndpointStats()
 
 
 class Connection(object):
-    """A connection represents an open, authenticated API connection."""
+    """A connection represents an open, authenticated API connection.
+
+    By default each call sends its request and then waits for the response
+    before the next request can use the websocket. A pipelined connection
+    instead has a background reader thread that matches responses to their
+    requests using the RequestId, so any number of calls, from any number of
+    threads, can be outstanding at once.
+
+    """
     _request_id = 0
-    _upgrade_retry_count = 60
-    _upgrade_retry_delay_secs = 1
+    # Seconds between starting to connect to each address when failing over.
+    reconnect_stagger = 0.25
 
     def __init__(self, address, cacert, auth_tag, credentials,
-                 nonce="", env_uuid=""):
+                 nonce="", env_uuid="", pipelined=False, login_cache=None,
+                 failover_addresses=(), retry_policy=None, codec=None,
+                 response_cache=None, metrics=None, timeout=None,
+                 keepalive=None, auto_reconnect=False, transport=None):
         """The constructor expects the following parameters:
 
         address: an string representing <host>:<port> where the host is either
@@ -141,27 +411,146 @@ class Connection(object):
         for modern Juju systems will be a connection to the System, but not an
         Environment.
 
+        pipelined: if true, start a reader thread once logged in so that
+        multiple requests can be in flight on the connection at once.
+
+        login_cache: a LoginCache remembering the login version and facades
+        for the endpoint, so the login can skip versions the server is known
+        not to support.
+
+        failover_addresses: the addresses of other API servers for the same
+        environment. If the websocket breaks, the connection reconnects and
+        logs in to the fastest of these (or the original address) that
+        works. Calls that were waiting for a response are sent again if they
+        are idempotent (see is_idempotent), and fail otherwise.
+
+        retry_policy: the RetryPolicy deciding which failed calls are retried
+        and when, such as those made while Juju is upgrading. Defaults to
+        RetryPolicy(). Retries of one call don't hold up others on a
+        pipelined connection.
+
+        codec: the codec used to encode requests and decode responses.
+        Defaults to the fastest JSON library installed.
+
+        response_cache: a ResponseCache for the responses of calls that
+        rarely change. There is no caching by default.
+
+        metrics: a Metrics recording the count, latency, sizes, retries and
+        errors of the calls made. Nothing is recorded by default.
+
+        timeout: the default number of seconds calls have to complete in,
+        including any retries, after which they raise RPCTimeout. By default
+        calls wait as long as they take.
+
+        keepalive: if given, a background thread pings the server whenever
+        the connection has been idle this many seconds, and treats the
+        websocket as dead if the ping gets no response in as long.
+
+        auto_reconnect: if true, a broken websocket is replaced by
+        reconnecting and logging in again, as with failover_addresses, even
+        if there are none. Reconnecting is retried with the retry policy's
+        backoff until its deadline passes.
+
+        transport: the Transport opening the websocket, such as a
+        RecordingTransport or ReplayTransport. Defaults to a
+        WebsocketTransport, connecting to the API server.
+
         """
-        self._cert_file = self._write_cert(cacert)
+        # The lock guards the request ids and the pending calls, the io lock
+        # stops concurrent callers interleaving their sends (and, when not
+        # pipelined, stealing each other's responses). The io lock is also
+        # held while reconnecting, which logs in again through rpc, so it
+        # must be reentrant.
+        self._lock = threading.Lock()
+        self._io_lock = threading.RLock()
+        self._pending = {}
+        # The ids of requests given up on, whose responses are discarded.
+        self._abandoned = set()
+        self._reader = None
+        # The AllWatcher shared by wait_for calls, started when first needed.
+        self._watcher = None
+        self._watcher_lock = threading.Lock()
+        self._closed = False
+        self._closing = False
+        self._reconnecting = False
+        self._auto_reconnect = auto_reconnect
+        self._last_recv = time.time()
+        self._login_cache = login_cache
+        self._address = address
+        self._addresses = [address] + [
+            a for a in failover_addresses if a != address]
+        self._env_uuid = env_uuid
+        self._auth_args = (auth_tag, credentials, nonce)
+        if retry_policy is None:
+            retry_policy = RetryPolicy()
+        self._retry_policy = retry_policy
+        self._retry_budget = retry_policy.new_budget()
+        if codec is None:
+            codec = default_codec()
+        self._codec = codec
+        self.response_cache = response_cache
+        self.metrics = metrics
+        self.timeout = timeout
+        self._cacert = cacert
+        if transport is None:
+            transport = WebsocketTransport()
+        self._transport = transport
         endpoint = self._endpoint(address, env_uuid)
-        cert_path = self._cert_file.name
-        self._connection = self._connect(endpoint, cert_path)
+        self._login_key = endpoint
+        self._connection = self._connect(endpoint, cacert)
         self._info = self._authenticate(auth_tag, credentials, nonce)
         self._generate_facades()
+        if pipelined:
+            self.start_pipelining()
+        self._keepalive = None
+        self._stop_keepalive = threading.Event()
+        if keepalive is not None:
+            self._keepalive = threading.Thread(
+                target=self._keepalive_loop, args=(keepalive,),
+                name="juju-keepalive")
+            self._keepalive.daemon = True
+            self._keepalive.start()
 
     def _authenticate(self, auth_tag, credentials, nonce):
-        # Start with version 2 of admin facade and work our way back.
-        for version in (2, 1, 0):
+        # Start with version 2 of admin facade and work our way back, unless
+        # the cache knows which version the server wants.
+        versions = (2, 1, 0)
+        cached = None
+        if self._login_cache is not None:
+            cached = self._login_cache.get(self._login_key)
+        if cached is not None:
+            versions = (cached['version'],) + tuple(
+                v for v in versions if v != cached['version'])
+        for version in versions:
             try:
                 self._auth_creds = self._login_args(
                     version, auth_tag, credentials, nonce)
-                return self.rpc(
+                info = self.rpc(
                     "Admin", "Login", self._auth_creds, version=version)
             except NotImplementedError:
+                if cached is not None and version == cached['version']:
+                    self._login_cache.invalidate(self._login_key)
+                    cached = None
                 # do nothing and try the previous version
-                pass
+                continue
+            self._update_login_cache(cached, version, info)
+            return info
         raise RuntimeError("unexpected missing login command")
 
+    def _update_login_cache(self, cached, version, info):
+        if self._login_cache is None:
+            return
+        facades = info.get('facades')
+        if facades is None:
+            # Old servers don't always list their facades, so remember the
+            # ones seen last time.
+            if cached is not None and cached['version'] == version:
+                info['facades'] = cached['facades']
+            return
+        if (cached is None or cached['version'] != version or
+                cached['facades'] != facades):
+            self._login_cache.put(self._login_key, version, facades)
+
     @staticmethod
     def _login_args(version, auth_tag, credentials, nonce):
         if version == 0:
@@ -175,15 +564,8 @@ class Connection(object):
             args['nonce'] = nonce
         return args
 
-    @staticmethod
-    def _connect(endpoint, cert_path):
-        sslopt = {
-            'ssl_version': ssl.PROTOCOL_TLSv1,
-            'ca_certs': cert_path,
-            'check_hostname': False,
-        }
-        return websocket.create_connection(
-            endpoint, origin=endpoint, sslopt=sslopt)
+    def _connect(self, endpoint, cacert):
+        return self._transport.connect(endpoint, cacert)
 
     @staticmethod
     def _endpoint(address, env_uuid):
@@ -192,60 +574,630 @@ class Connection(object):
             endpoint += "/environment/%s/api" % env_uuid
         return endpoint
 
-    @staticmethod
-    def _write_cert(cert):
-        """Write ssl CA cert into a temp file, and return the filename."""
-        # Note: we purposefully don't close the file as the temp file will be
-        # deleted as soon as it is closed. Since we leave it open, the file
-        # will be closed as the process finishes, and it removes the temporary
-        # file. Also we have a reference to the temporary file that exists for
-        # the lifetime of the connection instance. This way we are sure that
-        # the temporary file is around for the duration of its use.
-        f = tempfile.NamedTemporaryFile(suffix='.pem')
-        f.write(cert)
-        f.flush()
-        return f
-
-    def rpc(self, facade, func, params=None, version=None):
+    @property
+    def pipelined(self):
+        return self._reader is not None
+
+    @property
+    def address(self):
+        """The address of the API server currently connected to."""
+        return self._address
+
+    @property
+    def closed(self):
+        """True once the connection has been closed or the socket broken."""
+        return self._closed
+
+    def start_pipelining(self):
+        """Start the reader thread that dispatches responses to callers.
+
+        Waits for any call being made without it, which reads its own
+        response, to finish first.
+
+        """
+        with self._io_lock, self._lock:
+            if self._reader is not None:
+                return
+            self._reader = threading.Thread(
+                target=self._read_loop, name="juju-rpc-reader")
+            self._reader.daemon = True
+            self._reader.start()
+
+    def close(self):
+        """Close the websocket, failing any calls still waiting on it."""
+        self._closing = True
+        self._closed = True
+        self._stop_keepalive.set()
+        if self._watcher is not None:
+            self._watcher.abandon()
+        self._connection.close()
+        self._fail_pending(ConnectionClosed("connection closed"))
+
+    def _new_op(self, facade, func, params, version, object_id=None):
         if params is None:
             params = {}
+        with self._lock:
+            request_id = self._request_id
+            self._request_id += 1
         op = {
             'Type': facade,
             'Request': func,
             'Params': params,
-            'RequestId': self._request_id
+            'RequestId': request_id
         }
         if version is not None:
             op['Version'] = version
-        self._request_id += 1
-        result = self._rpc_retry_if_upgrading(op)
+        if object_id is not None:
+            op['Id'] = object_id
+        return op
+
+    def rpc(self, facade, func, params=None, version=None, lazy=False,
+            object_id=None, timeout=_DEFAULT_TIMEOUT):
+        """Make an API call and return the response.
+
+        If lazy is true the response is returned as a LazyResponse, which is
+        only decoded when it is first looked at. object_id identifies the
+        server side object for facades, such as watchers, that have them.
+
+        timeout is the seconds the call, including any retries, has to
+        complete in before raising RPCTimeout, overriding the connection's
+        timeout. None waits as long as the call takes. The connection stays
+        usable after a timeout, discarding the response if it comes later.
+
+        Responses in the connection's response cache are returned from it,
+        unless lazy is set.
+
+        """
+        cache = self.response_cache
+        key = None
+        if cache is not None:
+            cache.note_call(facade, func)
+            if (not lazy and object_id is None and
+                    cache.is_cacheable(facade, func)):
+                key = cache.key(facade, func, version, params)
+                response = cache.get(key)
+                if response is not None:
+                    return response
+        op = self._new_op(facade, func, params, version, object_id)
+        deadline = self._deadline(timeout)
+        metrics = self.metrics
+        if metrics is None:
+            result = self._rpc_with_retries(op, deadline)
+        else:
+            start = time.time()
+            try:
+                result = self._rpc_with_retries(op, deadline)
+            except Exception as e:
+                self._record_call(op, start, error=e)
+                raise
+            self._record_call(op, start, result)
+        if cache is not None:
+            # Invalidate again, in case a concurrent call cached a response
+            # from before this call took effect.
+            cache.note_call(facade, func)
         if 'Error' in result:
             raise new_error(result)
-        return result['Response']
-
-    def _rpc_retry_if_upgrading(self, op):
-        """If Juju is upgrading when the specified rpc call is made,
-        retry the call."""
-        retry_count = 0
-        while retry_count <= self._upgrade_retry_count:
-            result = self._send_request(op)
-            if 'Error' in result and 'upgrade in progress' in result['Error']:
-                logger.info("Juju upgrade in progress...")
-                retry_count += 1
-                time.sleep(self._upgrade_retry_delay_secs)
+        response = self._response(result, lazy)
+        if key is not None:
+            cache.put(key, response)
+        return response
+
+    def _deadline(self, timeout):
+        if timeout is _DEFAULT_TIMEOUT:
+            timeout = self.timeout
+        if timeout is None:
+            return None
+        return time.time() + timeout
+
+    @staticmethod
+    def _response(result, lazy):
+        response = result['Response']
+        if lazy:
+            return response
+        return response.materialize()
+
+    def submit(self, facade, func, params=None, version=None, lazy=False,
+               object_id=None, timeout=_DEFAULT_TIMEOUT):
+        """Send a request without waiting for its response.
+
+        Returns an RPCFuture for the response. On a connection that isn't
+        pipelined the request is sent and its response read before submit
+        returns. timeout is as for rpc, the future failing with RPCTimeout
+        once it passes.
+
+        """
+        if self.response_cache is not None:
+            self.response_cache.note_call(facade, func)
+        op = self._new_op(facade, func, params, version, object_id)
+        future = RPCFuture(
+            op['RequestId'],
+            on_cancel=functools.partial(self._abandon, op['RequestId']))
+        deadline = self._deadline(timeout)
+        if deadline is not None:
+            timer = scheduler.call_later(
+                max(0, deadline - time.time()), self._expire, op, future)
+            # The timer holds on to the future, and so to its response,
+            # until it's cancelled.
+            future.add_done_callback(lambda _: timer.cancel())
+        self._submit_with_retries(op, future, 0, time.time(), lazy, deadline)
+        return future
+
+    def _expire(self, op, future):
+        if future.done():
+            return
+        self._abandon(op['RequestId'])
+        future.set_exception(RPCTimeout(
+            "{}.{} timed out".format(op['Type'], op['Request'])))
+
+    def _abandon(self, request_id):
+        """Give up on a request, discarding its response if it comes."""
+        with self._lock:
+            sent = self._pending.pop(request_id, None) is not None
+            if sent or self._reader is None:
+                self._abandoned.add(request_id)
+
+    def _submit_with_retries(self, op, future, attempt, start, lazy,
+                             deadline):
+        while not future.done():
+            sent = self._dispatch(op, deadline)
+            if self._reader is None and sent.done():
+                # Not pipelined, so the response was read in this thread,
+                # which waits out any retry too.
+                delay = self._settle(op, future, sent, attempt, start, lazy,
+                                     deadline)
+                if delay is None:
+                    return
+                attempt += 1
+                time.sleep(delay)
+                continue
+
+            def on_result(sent):
+                delay = self._settle(op, future, sent, attempt, start, lazy,
+                                     deadline)
+                if delay is not None:
+                    # Sending the retry can block, so it mustn't hold up
+                    # the reader thread or the shared scheduler thread.
+                    scheduler.spawn_later(
+                        delay, self._submit_with_retries,
+                        op, future, attempt + 1, start, lazy, deadline)
+            sent.add_done_callback(on_result)
+            return
+
+    def _settle(self, op, future, sent, attempt, start, lazy, deadline):
+        """Complete future from sent, unless it's to be retried.
+
+        Returns how long to wait before retrying, or None.
+
+        """
+        if self.response_cache is not None:
+            self.response_cache.note_call(op['Type'], op['Request'])
+        error = sent.exception()
+        if error is not None:
+            if self.metrics is not None:
+                self._record_call(op, start, error=error)
+            future.set_exception(error)
+            return None
+        result = sent.result()
+        delay = self._retry_delay(op, result, attempt, start, deadline)
+        if delay is not None:
+            return delay
+        if self.metrics is not None:
+            self._record_call(op, start, result)
+        if 'Error' in result:
+            future.set_exception(new_error(result))
+        else:
+            future.set_result(self._response(result, lazy))
+        return None
+
+    def _rpc_with_retries(self, op, deadline=None):
+        """Make the call, retrying it as the retry policy says.
+
+        Only the calling thread waits between retries; the connection is
+        free for other calls in the meantime.
+
+        """
+        start = time.time()
+        attempt = 0
+        while True:
+            result = self._send_request(op, deadline)
+            delay = self._retry_delay(op, result, attempt, start, deadline)
+            if delay is None:
+                return result
+            attempt += 1
+            time.sleep(delay)
+
+    def _retry_delay(self, op, result, attempt, start, deadline=None):
+        delay = self._retry_policy.retry_delay(
+            result, attempt, time.time() - start, self._retry_budget)
+        if (delay is not None and deadline is not None and
+                time.time() + delay >= deadline):
+            logger.info(
+                "not retrying %s.%s past its timeout: %s", op['Type'],
+                op['Request'], result['Error'])
+            return None
+        if delay is not None:
+            logger.info(
+                "retrying %s.%s in %.2fs: %s", op['Type'], op['Request'],
+                delay, result['Error'])
+            if self.metrics is not None:
+                self.metrics.record_retry(op['Type'], op['Request'])
+        return delay
+
+    def _record_call(self, op, start, result=None, error=None):
+        response_bytes = 0
+        error_code = None
+        if error is not None:
+            error_code = type(error).__name__
+        elif 'Error' in result:
+            error_code = result.get('ErrorCode') or 'unknown'
+        else:
+            response_bytes = len(result['Response'].raw)
+        self.metrics.record_call(
+            op['Type'], op['Request'], time.time() - start, response_bytes,
+            error_code)
+
+    def _send_request(self, op, deadline=None):
+        future = self._dispatch(op, deadline)
+        if deadline is None:
+            return future.result()
+        try:
+            return future.result(max(0, deadline - time.time()))
+        except RPCTimeout:
+            if future.done():
+                raise
+            # Still waiting on the reader thread for the response.
+            self._abandon(op['RequestId'])
+            raise RPCTimeout(
+                "{}.{} timed out".format(op['Type'], op['Request']))
+
+    def _dispatch(self, op, deadline=None):
+        """Send the op, returning a future for the raw result.
+
+        On a pipelined connection the future is completed by the reader
+        thread, otherwise the response is read before returning.
+
+        """
+        future = RPCFuture(op['RequestId'])
+        if deadline is None:
+            self._io_lock.acquire()
+        elif not self._io_lock.acquire(
+                timeout=max(0, deadline - time.time())):
+            future.set_exception(RPCTimeout(
+                "{}.{} timed out waiting for the connection".format(
+                    op['Type'], op['Request'])))
+            return future
+        try:
+            if self._reader is None:
+                try:
+                    future.set_result(self._exchange(op, deadline))
+                except Exception as e:
+                    future.set_exception(e)
+                return future
+            with self._lock:
+                self._pending[op['RequestId']] = (future, op)
+            try:
+                self._send(op)
+            except Exception as e:
+                self._closed = True
+                with self._lock:
+                    self._pending.pop(op['RequestId'], None)
+                future.set_exception(e)
+        finally:
+            self._io_lock.release()
+        return future
+
+    def _exchange(self, op, deadline=None):
+        """Send the op and read its response, failing over if need be.
+
+        Called with the io lock held, on a connection that isn't pipelined.
+        Responses to earlier requests that timed out are skipped over. An
+        idempotent op is sent once more if the connection breaks while
+        waiting for its response.
+
+        """
+        try:
+            self._send(op)
+        except Exception:
+            self._closed = True
+            if not self._can_failover():
+                raise
+            self._reconnect()
+            # The request never reached the old server, so it's safe to send
+            # it to the new one.
+            self._send(op)
+        resent = False
+        while True:
+            try:
+                while True:
+                    result = self._recv(deadline)
+                    if result.get('RequestId') == op['RequestId']:
+                        if self.metrics is not None:
+                            self._record_response(op)
+                        return result
+                    self._discard(result)
+            except RPCTimeout:
+                # The socket is still fine, so leave it for the next call.
+                self._abandon(op['RequestId'])
+                raise RPCTimeout(
+                    "{}.{} timed out".format(op['Type'], op['Request']))
+            except Exception:
+                self._closed = True
+                if not self._can_failover():
+                    raise
+                # The request may or may not have been handled, so only
+                # resend it if that's harmless, but either way leave the
+                # connection ready for the next one.
+                self._reconnect()
+                if resent or not is_idempotent(op):
+                    raise
+            logger.info(
+                "resending %s.%s after reconnecting", op['Type'],
+                op['Request'])
+            self._send(op)
+            resent = True
+
+    def _can_failover(self):
+        return ((self._auto_reconnect or len(self._addresses) > 1) and
+                not self._closing and not self._reconnecting)
+
+    def _reconnect(self):
+        """Replace the broken websocket and log in again.
+
+        The other API servers are tried first, fastest first, then the one
+        that failed. With auto_reconnect, rounds of tries are repeated with
+        the retry policy's backoff until its deadline. Called with the io
+        lock held, and without a reader thread, as the login reads its own
+        response.
+
+        """
+        start = time.time()
+        self._reconnecting = True
+        try:
+            attempt = 0
+            while True:
+                last_error = self._reconnect_once()
+                if last_error is None:
+                    break
+                policy = self._retry_policy
+                delay = policy.backoff(attempt)
+                if (not self._auto_reconnect or self._closing or
+                        (policy.deadline is not None and
+                         time.time() - start + delay > policy.deadline)):
+                    raise ConnectionClosed(
+                        "unable to reconnect: {}".format(last_error))
+                logger.info(
+                    "unable to reconnect, retrying in %.2fs: %s", delay,
+                    last_error)
+                attempt += 1
+                time.sleep(delay)
+        finally:
+            self._reconnecting = False
+        logger.info("reconnected to %s", self._address)
+        with self._lock:
+            self._abandoned.clear()
+        self._generate_facades()
+        self._closed = False
+
+    def _reconnect_once(self):
+        """Try each address once, returning the last error if none work.
+
+        The addresses are connected to as by connect_fastest, so that a
+        dead server, which may take the transport's connect timeout to
+        fail, doesn't hold up the others. The first to connect is logged in
+        to, and if that fails the rest are tried again.
+
+        """
+        others = [a for a in self._addresses if a != self._address]
+        candidates = endpoint_stats.order(others) + [self._address]
+
+        def connect(address):
+            start = time.time()
+            try:
+                websocket = self._connect(
+                    self._endpoint(address, self._env_uuid), self._cacert)
+            except Exception:
+                endpoint_stats.record_failure(address)
+                raise
+            return websocket, start
+
+        last_error = None
+        while candidates:
+            try:
+                address, (websocket, start) = _race(
+                    candidates, connect, self.reconnect_stagger,
+                    lambda result: result[0].close())
+            except Exception as e:
+                return e
+            candidates.remove(address)
+            try:
+                self._connection = websocket
+                self._address = address
+                self._login_key = self._endpoint(address, self._env_uuid)
+                self._info = self._authenticate(*self._auth_args)
+            except Exception as e:
+                logger.debug("unable to reconnect to %s: %s", address, e)
+                endpoint_stats.record_failure(address)
+                last_error = e
+                continue
+            endpoint_stats.record(address, time.time() - start)
+            return None
+        return last_error
+
+    def _send(self, op):
+        data = self._codec.encode(op)
+        logger.debug("rpc request: %s", LogFrame(data))
+        self._connection.send(data)
+        if self.metrics is not None:
+            self.metrics.record_request(
+                op['Type'], op['Request'], len(data),
+                getattr(self._connection, 'last_send_size', None))
+
+    def _recv(self, deadline=None):
+        if deadline is None:
+            raw = self._connection.recv()
+        else:
+            websocket = import_websocket()
+            self._connection.settimeout(max(0, deadline - time.time()))
+            try:
+                raw = self._connection.recv()
+            except websocket.WebSocketTimeoutException:
+                raise RPCTimeout("timed out waiting for a response")
+            finally:
+                self._connection.settimeout(None)
+        self._last_recv = time.time()
+        logger.debug("rpc response: %s", LogFrame(raw))
+        if self.metrics is not None:
+            # Recorded against the call once the response is matched to it.
+            self._recv_sizes = (
+                len(raw), getattr(self._connection, 'last_recv_size', None))
+        return decode_envelope(raw, self._codec)
+
+    def _record_response(self, op):
+        self.metrics.record_response(
+            op['Type'], op['Request'], *self._recv_sizes)
+
+    def _read_loop(self):
+        while True:
+            try:
+                result = self._recv()
+            except Exception as e:
+                logger.debug("rpc reader stopping: %s", e)
+                self._reader_failed(e)
+                return
+            with self._lock:
+                entry = self._pending.pop(result.get('RequestId'), None)
+            if entry is None:
+                self._discard(result)
+                continue
+            if self.metrics is not None:
+                self._record_response(entry[1])
+            entry[0].set_result(result)
+
+    def _discard(self, result):
+        request_id = result.get('RequestId')
+        with self._lock:
+            abandoned = request_id in self._abandoned
+            self._abandoned.discard(request_id)
+        if abandoned:
+            logger.debug(
+                "discarding late response to request %s", request_id)
+        else:
+            logger.warning(
+                "discarding response to unknown request %s", request_id)
+
+    def _reader_failed(self, error):
+        # Holding the io lock stops new requests being sent, and left
+        # pending, until the connection has been failed over or given up on.
+        with self._io_lock:
+            self._closed = True
+            self._reader = None
+            error = ConnectionClosed(str(error))
+            failover = self._can_failover()
+            replay = []
+            if failover:
+                # Hold on to the idempotent calls, to send them again once
+                # reconnected, and fail the rest.
+                with self._lock:
+                    for request_id, (_, op) in list(self._pending.items()):
+                        if is_idempotent(op):
+                            replay.append(self._pending.pop(request_id))
+            self._fail_pending(error)
+            if not failover:
+                return
+            try:
+                self._reconnect()
+            except ConnectionClosed as e:
+                logger.warning("%s", e)
+                for future, _ in replay:
+                    future.set_exception(error)
+                return
+            # Reconnecting cleared the reader, so start a new one.
+            self.start_pipelining()
+            for future, op in replay:
+                self._replay(future, op)
+
+    def _replay(self, future, op):
+        if future.done():
+            # Cancelled, or timed out, while reconnecting.
+            return
+        logger.info(
+            "resending %s.%s after reconnecting", op['Type'], op['Request'])
+        with self._lock:
+            self._pending[op['RequestId']] = (future, op)
+        try:
+            self._send(op)
+        except Exception as e:
+            with self._lock:
+                self._pending.pop(op['RequestId'], None)
+            future.set_exception(e)
+
+    def _fail_pending(self, error):
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        for future, _ in pending.values():
+            future.set_exception(error)
+
+    def _keepalive_loop(self, interval):
+        """Ping the server when idle, replacing the websocket if it's dead."""
+        while not self._stop_keepalive.wait(interval / 2.0):
+            if time.time() - self._last_recv < interval:
+                continue
+            if self._reader is not None:
+                if not self._keepalive_ping(interval):
+                    return
                 continue
-            break
-        return result
-
-    def _send_request(self, op):
-        if logger.isEnabledFor(logging.DEBUG):
-            logger.debug("rpc request:\n%s" % (json.dumps(op, indent=2)))
-        self._connection.send(json.dumps(op))
-        raw = self._connection.recv()
-        result = json.loads(raw)
-        if logger.isEnabledFor(logging.DEBUG):
-            logger.debug("rpc response:\n%s" % (json.dumps(result, indent=2)))
-        return result
+            # Without a reader, a call holding the io lock shows the
+            # connection is in use, and a ping would only wait behind it
+            # and time out, so the ping is skipped. Holding the lock while
+            # pinging means a timeout is the ping's own.
+            if not self._io_lock.acquire(False):
+                continue
+            try:
+                if not self._keepalive_ping(interval):
+                    return
+            finally:
+                self._io_lock.release()
+
+    def _keepalive_ping(self, interval):
+        """Ping, treating the websocket as dead if there's no response.
+
+        Returns False once the connection is closing.
+
+        """
+        sent = time.time()
+        try:
+            self.rpc("Pinger", "Ping", timeout=interval)
+        except RPCTimeout:
+            if self._last_recv >= sent or self._closing:
+                # Busy with other calls, rather than dead.
+                return not self._closing
+            logger.warning(
+                "no response to ping in %.1fs, reconnecting", interval)
+            self._connection_dead(sent)
+        except Exception as e:
+            if self._closing:
+                return False
+            logger.warning("keepalive ping failed: %s", e)
+        return True
+
+    def _connection_dead(self, since):
+        """Shut the websocket down, unless anything was received since."""
+        if self._reader is not None:
+            if self._last_recv >= since:
+                return
+            # The reader fails, and so fails over, once its socket is shut.
+            self._connection.shutdown()
+            return
+        with self._io_lock:
+            if self._last_recv >= since or self._closing:
+                return
+            self._closed = True
+            self._connection.shutdown()
+            if self._can_failover():
+                try:
+                    self._reconnect()
+                except ConnectionClosed as e:
+                    logger.warning("%s", e)
 
     def _generate_facades(self):
         self._facade_versions = dict([
@@ -253,6 +1205,44 @@ class Connection(object):
             for facade in self._info['facades']
         ])
 
+    def ping(self):
+        """Make a trivial call to check the connection is alive."""
+        self.rpc("Pinger", "Ping")
+
+    def watch(self):
+        """Return the connection's AllWatcher, running in the background.
+
+        The watcher is shared by the wait_for calls on the connection, and
+        its state can be read at any time. The connection is made pipelined,
+        so that waiting for deltas doesn't hold up other calls. A watcher
+        that has failed, as when the connection was replaced by
+        reconnecting, is replaced by a new one.
+
+        """
+        # Imported here, as the watcher module imports this one.
+        from .watcher import AllWatcher
+        with self._watcher_lock:
+            watcher = self._watcher
+            if watcher is None or watcher.error is not None:
+                self.start_pipelining()
+                watcher = AllWatcher(self)
+                watcher.run_in_background()
+                self._watcher = watcher
+            return watcher
+
+    def wait_for(self, predicate, timeout=None, kinds=None):
+        """Wait until predicate(state) is true for the environment's
+        ModelState, checking it only as the AllWatcher reports changes.
+
+        Returns the predicate's result, or raises WaitTimeout after timeout
+        seconds. See AllWatcher.wait_for, and watcher.units_started:
+
+            >>> connection.wait_for(
+            ...     units_started("mysql"), timeout=300, kinds=["unit"])
+
+        """
+        return self.watch().wait_for(predicate, timeout, kinds)
+
     def get_facade(self, name, version=None):
         try:
             versions = self._facade_versions[name]
@@ -265,20 +1255,155 @@ class Connection(object):
         except KeyError:
             raise UnknownFacade(name)
 
+    def get_typed_facade(self, name, version=None):
+        """Return a typed facade, generated from the bundled schema.
+
+        Without a version, the latest version both the server and the schema
+        have is used. See juju.facades.
+
+        """
+        from .facades import facade_class, schema_versions
+        try:
+            versions = self._facade_versions[name]
+        except KeyError:
+            raise UnknownFacade(name)
+        known = [v for v in schema_versions(name) if v in versions]
+        if version is None and known:
+            version = max(known)
+        if version not in known:
+            raise FacadeVersionNotSupported(
+                "{} version {}".format(name, version))
+        return facade_class(name, version)(self)
+
+
+def connect_fastest(addresses, cacert, auth_tag, credentials, nonce="",
+                    env_uuid="", stagger=0.25, **kwargs):
+    """Connect to whichever of the API server addresses logs in first.
+
+    Connection attempts are started in order of past connection times, each
+    stagger seconds after the previous one or as soon as it fails, so that a
+    slow or dead server doesn't hold up the others. The first connection to
+    log in is returned, with the other addresses kept for failing over, and
+    any others that succeed later are closed. Connection times are recorded
+    in endpoint_stats for next time.
+
+    The remaining parameters are as for Connection.
+
+    """
+    addresses = endpoint_stats.order(addresses)
+    if not addresses:
+        raise ValueError("no API server addresses")
+
+    def attempt(address):
+        start = time.time()
+        try:
+            connection = Connection(
+                address, cacert, auth_tag, credentials, nonce=nonce,
+                env_uuid=env_uuid, failover_addresses=addresses, **kwargs)
+        except Exception:
+            endpoint_stats.record_failure(address)
+            raise
+        endpoint_stats.record(address, time.time() - start)
+        return connection
+
+    return _race(addresses, attempt, stagger, lambda c: c.close())[1]
+
+
+def _race(addresses, attempt, stagger, discard):
+    """Return the address and result of whichever attempt(address) returns
+    first.
 
-def open_environment(env_name):
+    Attempts are started in order, each on a thread of its own, stagger
+    seconds after the previous one or as soon as it fails. The results of
+    attempts that finish later are passed to discard. If every attempt
+    fails, the first error is raised.
+
+    """
+    results = queue.Queue()
+    state = {'winner': None}
+    lock = threading.Lock()
+
+    def run(address):
+        try:
+            result = attempt(address)
+        except Exception as e:
+            results.put((address, None, e))
+            return
+        with lock:
+            won = state['winner'] is None
+            if won:
+                state['winner'] = result
+        if not won:
+            discard(result)
+        results.put((address, result, None))
+
+    started = 0
+    finished = 0
+    errors = []
+    while True:
+        if started < len(addresses):
+            thread = threading.Thread(
+                target=run, args=(addresses[started],),
+                name="juju-connect")
+            thread.daemon = True
+            thread.start()
+            started += 1
+        timeout = stagger if started < len(addresses) else None
+        try:
+            address, result, error = results.get(timeout=timeout)
+        except queue.Empty:
+            continue
+        finished += 1
+        if error is None and result is state['winner']:
+            return address, result
+        if error is not None:
+            logger.debug("unable to connect to %s: %s", address, error)
+            errors.append(error)
+        if finished == len(addresses):
+            # Every attempt failed; raise the first error as the most
+            # representative.
+            raise errors[0]
+
+
+def open_environment(env_name, pool=None, **kwargs):
     """Return an API connection to a named environment.
 
     The specified environment name is looked up in the user's config store.
-    The resulting connection is to the environment endpoint.
+    The resulting connection is to the environment endpoint. Any keyword
+    arguments, such as pipelined, are passed through to the Connection.
+
+    If a ConnectionPool is given, a connection is acquired from the pool
+    instead, and should be released back to it when done with. The keyword
+    arguments for pooled connections are those given to the pool.
 
     """
+    if pool is not None:
+        if kwargs:
+            raise TypeError(
+                "connection arguments can't be given with a pool")
+        return pool.acquire(env_name)
     store = ConfigStore()
     info = store.connection_info(env_name)
+    return connection_from_info(info, **kwargs)
+
+
+def connection_from_info(info, **kwargs):
+    """Return an API connection using the info from the config store.
+
+    With more than one state server, connections to them all are raced and
+    the first to log in is used.
+
+    """
     auth_tag = "user-{}".format(info['user'])
     credentials = info['password']
+    if len(info['state-servers']) > 1:
+        return connect_fastest(
+            info['state-servers'],
+            info['ca-cert'],
+            auth_tag, credentials,
+            env_uuid=info['environ-uuid'], **kwargs)
     return Connection(
         info['state-servers'][0],
         info['ca-cert'],
         auth_tag, credentials,
-        env_uuid=info['environ-uuid'])
+        env_uuid=info['environ-uuid'], **kwargs)
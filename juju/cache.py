@@ -0,0 +1,134 @@
+import collections
+import copy
+import json
+import threading
+import time
+
+
+# Calls whose responses rarely change, and are safe to cache.
+DEFAULT_CACHEABLE = frozenset([
+    ("Client", "AgentVersion"),
+    ("Client", "CharmInfo"),
+    ("Client", "EnvironmentGet"),
+    ("Client", "EnvironmentInfo"),
+    ("Client", "GetEnvironmentConstraints"),
+    ("Client", "GetServiceConstraints"),
+    ("Client", "ServiceCharmRelations"),
+    ("Client", "ServiceGet"),
+    ("Charms", "CharmInfo"),
+    ("Charms", "List"),
+    ("EnvironmentManager", "EnvironmentInfo"),
+    ("Service", "ServiceGet"),
+])
+
+# Calls starting with these change the environment, and so invalidate
+# cached responses. Service calls are listed one by one, as the facade also
+# has read-only ones such as ServiceGet and ServiceGetCharmURL.
+MUTATING_PREFIXES = (
+    "Abort", "Add", "Block", "Cancel", "Create", "Deploy", "Destroy",
+    "Disable", "Enable", "Enqueue", "EnvironmentSet", "EnvironmentUnset",
+    "Expose", "Import", "Provision", "Put", "Remove", "Resolved", "Retry",
+    "Run", "ServiceDeploy", "ServiceDestroy", "ServiceExpose", "ServiceSet",
+    "ServiceUnexpose", "ServiceUnset", "ServiceUpdate", "ServicesDeploy",
+    "Set", "Share", "Unexpose", "Unset", "Unshare", "Update", "Upgrade",
+)
+
+
+def is_mutating(facade, method, cacheable=DEFAULT_CACHEABLE,
+                prefixes=MUTATING_PREFIXES):
+    """Return whether a call may change the environment."""
+    return ((facade, method) not in cacheable and
+            method.startswith(prefixes))
+
+
+class ResponseCache(object):
+    """A read-through cache of responses to calls on a connection.
+
+    Only calls in the cacheable set of (facade, method) pairs are cached,
+    keyed by facade, method, version and params, for up to ttl seconds. The
+    least recently used responses are dropped once there are more than
+    maxsize. Responses are copied in and out of the cache, so callers can
+    modify them.
+
+    A call whose method starts with one of the mutating prefixes invalidates
+    the cached responses from its facade. As the Client facade overlaps with
+    most others, mutating calls on it invalidate everything, and mutating
+    calls on other facades also invalidate the Client facade's responses.
+    invalidate can be called to drop responses explicitly.
+
+    """
+
+    def __init__(self, ttl=60, maxsize=1024, cacheable=DEFAULT_CACHEABLE,
+                 mutating_prefixes=MUTATING_PREFIXES):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.cacheable = frozenset(cacheable)
+        self.mutating_prefixes = tuple(mutating_prefixes)
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def is_cacheable(self, facade, method):
+        return (facade, method) in self.cacheable
+
+    def is_mutating(self, facade, method):
+        return is_mutating(
+            facade, method, self.cacheable, self.mutating_prefixes)
+
+    @staticmethod
+    def key(facade, method, version, params):
+        return (facade, method, version,
+                json.dumps(params or {}, sort_keys=True))
+
+    def get(self, key):
+        """Return a copy of the cached response, or None."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or time.time() - entry[0] > self.ttl:
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return None
+            # Move to the end, as the most recently used.
+            del self._entries[key]
+            self._entries[key] = entry
+            self.hits += 1
+            response = entry[1]
+        return copy.deepcopy(response)
+
+    def put(self, key, response):
+        response = copy.deepcopy(response)
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (time.time(), response)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, facade=None, method=None):
+        """Drop the cached responses from a facade, or facade method.
+
+        With no arguments everything is dropped.
+
+        """
+        with self._lock:
+            if facade is None and method is None:
+                self._entries.clear()
+                return
+            for key in list(self._entries):
+                if ((facade is None or key[0] == facade) and
+                        (method is None or key[1] == method)):
+                    del self._entries[key]
+
+    def note_call(self, facade, method):
+        """Invalidate the responses a call to the method may change."""
+        if not self.is_mutating(facade, method):
+            return
+        if facade == "Client":
+            self.invalidate()
+        else:
+            self.invalidate(facade)
+            self.invalidate("Client")
@@ -0,0 +1,158 @@
+"""JSON encoding and decoding of API frames.
+
+The fastest JSON library available is used: orjson, then ujson, falling
+back to the standard library's json module. Responses can also be decoded
+lazily, see LazyResponse.
+
+"""
+import json
+import re
+
+try:
+    from collections.abc import Mapping
+except ImportError:
+    from collections import Mapping
+
+
+class JSONCodec(object):
+    """Encodes and decodes frames with the standard library json module."""
+    name = "json"
+
+    def encode(self, obj):
+        return json.dumps(obj)
+
+    def decode(self, data):
+        return json.loads(data)
+
+
+class OrjsonCodec(JSONCodec):
+    name = "orjson"
+
+    def __init__(self):
+        import orjson
+        self._orjson = orjson
+
+    def encode(self, obj):
+        return self._orjson.dumps(obj).decode('utf-8')
+
+    def decode(self, data):
+        return self._orjson.loads(data)
+
+
+class UjsonCodec(JSONCodec):
+    name = "ujson"
+
+    def __init__(self):
+        import ujson
+        self._ujson = ujson
+
+    def encode(self, obj):
+        return self._ujson.dumps(obj)
+
+    def decode(self, data):
+        return self._ujson.loads(data)
+
+
+def default_codec():
+    """Return a codec using the fastest JSON library installed."""
+    for codec in (OrjsonCodec, UjsonCodec):
+        try:
+            return codec()
+        except ImportError:
+            pass
+    return JSONCodec()
+
+
+class LogFrame(object):
+    """Formats a raw frame for logging, only if the log record is emitted.
+
+    Long frames are cut short, so that debug logging of multi-megabyte
+    responses neither re-encodes them nor floods the log.
+
+    """
+    limit = 1000
+
+    def __init__(self, data, limit=None):
+        self.data = data
+        if limit is not None:
+            self.limit = limit
+
+    def __str__(self):
+        data = self.data
+        if isinstance(data, bytes):
+            data = data.decode('utf-8', 'replace')
+        if len(data) <= self.limit:
+            return data
+        return "{}... ({} more characters)".format(
+            data[:self.limit], len(data) - self.limit)
+
+
+class LazyResponse(Mapping):
+    """A read-only view of a response that is only decoded when used.
+
+    The raw frame is kept, and decoded the first time the response is
+    looked at, so callers that only pass a response on (see the raw
+    property), or never look at it, don't pay for decoding it. Looking up
+    any key decodes the whole response, as scanning the frame for one key's
+    value in Python is slower than decoding all of it in C; to read parts of
+    a large FullStatus without decoding it all, see status.iter_status.
+
+    """
+
+    def __init__(self, raw, codec, data=None):
+        self._raw = raw
+        self._codec = codec
+        self._data = data
+
+    @property
+    def raw(self):
+        """The raw frame the response was sent in."""
+        return self._raw
+
+    def materialize(self):
+        """Return the response, decoded to plain dicts and lists."""
+        if self._data is None:
+            self._data = self._codec.decode(self._raw)['Response']
+        return self._data
+
+    def __getitem__(self, key):
+        return self.materialize()[key]
+
+    def __iter__(self):
+        return iter(self.materialize())
+
+    def __len__(self):
+        return len(self.materialize())
+
+    def __repr__(self):
+        if self._data is None:
+            return "<LazyResponse ({} bytes, not decoded)>".format(
+                len(self._raw))
+        return "<LazyResponse {!r}>".format(self._data)
+
+
+# Juju's server writes the fields of a response in a fixed order:
+# RequestId, then Error and ErrorCode if there was an error, then Response.
+_ENVELOPE = re.compile(r'\{\s*"RequestId"\s*:\s*(\d+)\s*,\s*"Response"\s*:')
+
+
+def decode_envelope(raw, codec):
+    """Decode a response frame, leaving a successful response undecoded.
+
+    Returns a dict with the RequestId and either the Error and ErrorCode or
+    a LazyResponse for the Response. Frames that don't have the fields in
+    the order the server normally sends them are decoded there and then.
+
+    """
+    text = raw.decode('utf-8') if isinstance(raw, bytes) else raw
+    match = _ENVELOPE.match(text)
+    if match is None:
+        result = codec.decode(raw)
+        if 'Response' in result:
+            result['Response'] = LazyResponse(
+                raw, codec, result['Response'])
+        return result
+    return {
+        'RequestId': int(match.group(1)),
+        'Response': LazyResponse(raw, codec),
+    }
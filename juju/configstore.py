@@ -1,11 +1,56 @@
 __metaclass__ = type
 
+import copy
 import os
-import yaml
+import threading
 
 from .exceptions import EnvironmentNotBootstrapped
 
 
+# Parsed files, by filename, along with the stat stamp of the file when it
+# was parsed. This is shared by all ConfigStore instances in the process.
+_parsed = {}
+_parsed_lock = threading.Lock()
+
+
+def _stamp(st):
+    return (st.st_ino, st.st_size, getattr(st, 'st_mtime_ns', st.st_mtime))
+
+
+def load_yaml(filename):
+    """Return the parsed contents of a YAML file.
+
+    The result of parsing the file is kept, and returned again until the
+    file's modification time, size or inode changes. Callers must not modify
+    what is returned.
+
+    """
+    st = os.stat(filename)
+    stamp = _stamp(st)
+    with _parsed_lock:
+        cached = _parsed.get(filename)
+    if cached is not None and cached[0] == stamp:
+        return cached[1]
+    # yaml is only imported once there's a file to parse, as it is slow to
+    # import and not needed to connect from the cached connection info.
+    import yaml
+    try:
+        from yaml import CSafeLoader as SafeLoader
+    except ImportError:
+        from yaml import SafeLoader
+    with open(filename) as fh:
+        data = yaml.load(fh, Loader=SafeLoader)
+    with _parsed_lock:
+        _parsed[filename] = (stamp, data)
+    return data
+
+
+def clear_cache():
+    """Forget all parsed files."""
+    with _parsed_lock:
+        _parsed.clear()
+
+
 class ConfigStore():
     """The config store contains the cached information about a juju environment.
 
@@ -39,26 +84,38 @@ class ConfigStore():
             raise EnvironmentNotBootstrapped(name)
         return self._environment_from_jenv(jenv)
 
+    def environment_names(self):
+        """Return the sorted names of the environments in the store."""
+        names = set()
+        cache_file = os.path.join(self.directory, 'cache.yaml')
+        if os.path.exists(cache_file):
+            data = load_yaml(cache_file) or {}
+            names.update(data.get('environment') or {})
+        if os.path.isdir(self.directory):
+            names.update(
+                filename[:-len('.jenv')]
+                for filename in os.listdir(self.directory)
+                if filename.endswith('.jenv'))
+        return sorted(names)
+
     def _environment_from_cache(self, env_name, cache_filename):
-        with open(cache_filename) as fh:
-            data = yaml.safe_load(fh.read())
-            try:
-                # environment holds:
-                #   user, env-uuid, server-uuid
-                environment = data['environment'][env_name]
-                server = data['server-data'][environment['server-uuid']]
-                return {
-                    'user': environment['user'],
-                    'password': server['identities'][environment['user']],
-                    'environ-uuid': environment['env-uuid'],
-                    'server-uuid': environment['server-uuid'],
-                    'state-servers': server['api-endpoints'],
-                    'ca-cert': server['ca-cert'],
-                }
-            except KeyError:
-                raise EnvironmentNotBootstrapped(env_name)
+        data = load_yaml(cache_filename)
+        try:
+            # environment holds:
+            #   user, env-uuid, server-uuid
+            environment = data['environment'][env_name]
+            server = data['server-data'][environment['server-uuid']]
+            return {
+                'user': environment['user'],
+                'password': server['identities'][environment['user']],
+                'environ-uuid': environment['env-uuid'],
+                'server-uuid': environment['server-uuid'],
+                'state-servers': list(server['api-endpoints']),
+                'ca-cert': server['ca-cert'],
+            }
+        except (KeyError, TypeError):
+            raise EnvironmentNotBootstrapped(env_name)
 
     def _environment_from_jenv(self, jenv):
-        with open(jenv) as fh:
-            data = yaml.safe_load(fh.read())
-            return data
+        # Copy, as the parsed file is shared.
+        return copy.deepcopy(load_yaml(jenv))
@@ -0,0 +1,545 @@
+"""Deploying a topology of services, as concurrently as it allows.
+
+A DeploymentPlan takes a topology in the form of a Juju bundle's
+services, machines and relations, and works out the calls needed to deploy
+it and which of them depend on which:
+
+    >>> plan = DeploymentPlan({
+    ...     "services": {
+    ...         "wordpress": {"charm": "cs:trusty/wordpress-4",
+    ...                       "num_units": 2, "expose": True},
+    ...         "mysql": {"charm": "cs:trusty/mysql-38", "to": ["0"]},
+    ...     },
+    ...     "machines": {"0": {"series": "trusty"}},
+    ...     "relations": [["wordpress:db", "mysql:db"]],
+    ... })
+    >>> report = plan.execute(connection)
+    >>> print(report.format())
+
+All the machines are added with one bulk AddMachines call. The services
+are deployed with one bulk Service.ServicesDeploy call where the server has
+it, or else a ServiceDeploy call each, and every call whose dependencies
+are done is in flight at once, so the wall-clock time is that of the
+longest chain of dependent calls rather than of all the calls. The
+connection should be pipelined; otherwise calls are made one at a time.
+
+"""
+import collections
+import threading
+import time
+
+from .apiclient import UnknownFacade, new_result_error
+from .facades import facade_class
+
+
+class DependencyFailed(Exception):
+    """The error of steps not made because a step they need failed."""
+
+    def __init__(self, step, dependency):
+        self.step = step
+        self.dependency = dependency
+
+    def __str__(self):
+        return "{} not run, as {} failed".format(self.step, self.dependency)
+
+
+class Step(object):
+    """A call in a deployment, and what became of it.
+
+    params is the call's params, or a function returning them given the
+    plan's completed steps by name. A step with no facade makes no call:
+    params is a function returning its result, or raising its error, once
+    the steps it requires are done. started and finished are times, and
+    result or error is set once the step is done.
+
+    """
+    __slots__ = ('name', 'facade', 'method', 'params', 'requires',
+                 'started', 'finished', 'result', 'error')
+
+    def __init__(self, name, facade, method, params, requires=()):
+        self.name = name
+        self.facade = facade
+        self.method = method
+        self.params = params
+        self.requires = tuple(requires)
+        self.started = None
+        self.finished = None
+        self.result = None
+        self.error = None
+
+    @property
+    def seconds(self):
+        if self.started is None or self.finished is None:
+            return None
+        return self.finished - self.started
+
+    def __repr__(self):
+        return "<Step {} {}.{}>".format(self.name, self.facade, self.method)
+
+
+_SIZE_SUFFIXES = {'M': 1, 'G': 1024, 'T': 1024 * 1024, 'P': 1024 ** 3}
+_INT_CONSTRAINTS = ('cpu-cores', 'cpu-power')
+_SIZE_CONSTRAINTS = ('mem', 'root-disk')
+_LIST_CONSTRAINTS = ('tags', 'spaces')
+
+
+def parse_constraints(constraints):
+    """Return constraints such as "mem=4G cpu-cores=2" as the API's dict.
+
+    Sizes are in megabytes, as the API expects. A dict is returned as is.
+
+    """
+    if constraints is None or isinstance(constraints, dict):
+        return constraints
+    parsed = {}
+    for part in constraints.split():
+        name, sep, value = part.partition('=')
+        if not sep:
+            raise ValueError("bad constraint {!r}".format(part))
+        if name in _INT_CONSTRAINTS:
+            parsed[name] = int(value)
+        elif name in _SIZE_CONSTRAINTS:
+            multiplier = 1
+            if value[-1:].upper() in _SIZE_SUFFIXES:
+                multiplier = _SIZE_SUFFIXES[value[-1].upper()]
+                value = value[:-1]
+            parsed[name] = int(float(value) * multiplier)
+        elif name in _LIST_CONSTRAINTS:
+            parsed[name] = [v for v in value.split(',') if v]
+        else:
+            parsed[name] = value
+    return parsed
+
+
+def _config(options):
+    # ServiceDeploy takes the config as strings, parsed by the charm's
+    # config schema, so booleans must be spelt as in YAML.
+    config = {}
+    for key, value in (options or {}).items():
+        if isinstance(value, bool):
+            value = 'true' if value else 'false'
+        config[key] = str(value)
+    return config
+
+
+class DeploymentPlan(object):
+    """The steps deploying a topology, and their dependencies.
+
+    The topology is a dict with services, and optionally machines and
+    relations, as in a bundle. Each service has a charm, and may have
+    num_units, options, constraints, expose and to, a list of placements
+    for its units: the name of a machine in machines, a container on one
+    ("lxc:0"), or "new". Requests are checked against the Client facade's
+    schema as the plan is made, raising SchemaError, and ValueError is
+    raised for topologies that don't make sense.
+
+    """
+
+    def __init__(self, topology, client_version=0):
+        self.types = facade_class("Client", client_version).TYPES
+        self.steps = collections.OrderedDict()
+        self._machine_names = []
+        services = topology.get('services') or {}
+        machines = topology.get('machines') or {}
+        if machines:
+            self._plan_machines(machines)
+        for name in sorted(services):
+            self._plan_service(name, services[name], machines)
+        for endpoints in topology.get('relations') or []:
+            self._plan_relation(endpoints, services)
+        self.levels()
+
+    def _add(self, step):
+        if step.name in self.steps:
+            raise ValueError("duplicate step {}".format(step.name))
+        self.steps[step.name] = step
+
+    def _plan_machines(self, machines):
+        self._machine_names = sorted(machines, key=_machine_order)
+        params = []
+        for name in self._machine_names:
+            machine = machines[name] or {}
+            params.append(self.types['AddMachineParams'](
+                jobs=['JobHostUnits'], series=machine.get('series'),
+                constraints=parse_constraints(machine.get('constraints'))))
+        self._add(Step(
+            'machines', 'Client', 'AddMachines',
+            self.types['AddMachines'](machine_params=params).to_json()))
+        # A step for each machine, failing if the server couldn't add it,
+        # so that only the units placed on it fail with it.
+        for index, name in enumerate(self._machine_names):
+            self._add(Step(
+                'machine ' + name, None, None, _machine_id(index, name),
+                ('machines',)))
+
+    def _placement(self, spec, machines):
+        """Return a function of the done steps giving the machine spec, and
+        the steps it requires."""
+        if spec in (None, 'new'):
+            return (lambda done: None), ()
+        container, sep, machine = spec.rpartition(':')
+        if machine not in machines:
+            raise ValueError("placement {!r} names no machine".format(spec))
+        step = 'machine ' + machine
+
+        def resolve(done):
+            return container + sep + done[step].result
+        return resolve, (step,)
+
+    def _plan_service(self, name, service, machines):
+        if not service.get('charm'):
+            raise ValueError("service {} has no charm".format(name))
+        num_units = service.get('num_units', 1)
+        # Checked now, rather than when the steps are run.
+        deploy = self.types['ServiceDeploy'](
+            service_name=name, charm_url=service['charm'],
+            num_units=num_units,
+            config=_config(service.get('options')),
+            constraints=parse_constraints(service.get('constraints')))
+        placements = list(service.get('to') or [])
+        if len(placements) > num_units:
+            raise ValueError(
+                "service {} has more placements than units".format(name))
+        requires = ()
+        place = None
+        if placements:
+            # The first unit is placed by the deploy, and the others each
+            # added to their place by an AddServiceUnits call.
+            deploy.num_units = 1
+            place, requires = self._placement(placements[0], machines)
+        self._add(Step(
+            'deploy ' + name, 'Client', 'ServiceDeploy',
+            _deploy_params(deploy, place), requires))
+        for i, spec in enumerate(placements[1:], 1):
+            place, requires = self._placement(spec, machines)
+            self._add(Step(
+                'add {}/{}'.format(name, i), 'Client', 'AddServiceUnits',
+                _units_params(self.types['AddServiceUnits'](
+                    service_name=name, num_units=1), place),
+                ('deploy ' + name,) + requires))
+        unplaced = num_units - max(1, len(placements))
+        if placements and unplaced > 0:
+            self._add(Step(
+                'add {} units'.format(name), 'Client', 'AddServiceUnits',
+                self.types['AddServiceUnits'](
+                    service_name=name, num_units=unplaced).to_json(),
+                ('deploy ' + name,)))
+        if service.get('expose'):
+            self._add(Step(
+                'expose ' + name, 'Client', 'ServiceExpose',
+                self.types['ServiceExpose'](service_name=name).to_json(),
+                ('deploy ' + name,)))
+
+    def _plan_relation(self, endpoints, services):
+        endpoints = list(endpoints)
+        if len(endpoints) != 2:
+            raise ValueError(
+                "relation {} should have two endpoints".format(endpoints))
+        names = [e.split(':')[0] for e in endpoints]
+        for name in names:
+            if name not in services:
+                raise ValueError(
+                    "relation {} names unknown service {}".format(
+                        endpoints, name))
+        self._add(Step(
+            'relate {} {}'.format(*endpoints), 'Client', 'AddRelation',
+            self.types['AddRelation'](endpoints=endpoints).to_json(),
+            ['deploy ' + name for name in names]))
+
+    def levels(self):
+        """Return the names of the steps in order of dependency.
+
+        Each list of names depends only on steps in the lists before it,
+        so the steps in it can all be run at once. Raises ValueError if
+        the steps depend on each other in a cycle.
+
+        """
+        remaining = dict(
+            (name, set(step.requires)) for name, step in self.steps.items())
+        levels = []
+        done = set()
+        while remaining:
+            level = sorted(
+                name for name, requires in remaining.items()
+                if requires <= done)
+            if not level:
+                raise ValueError("steps depend on each other: {}".format(
+                    ", ".join(sorted(remaining))))
+            levels.append(level)
+            done.update(level)
+            for name in level:
+                del remaining[name]
+        return levels
+
+    def execute(self, connection, max_in_flight=16, timeout=None):
+        """Make the calls, returning a DeploymentReport.
+
+        Every step whose dependencies are done is started, up to
+        max_in_flight calls at a time. A step that fails fails those that
+        depend on it with DependencyFailed, but the others go on. timeout
+        is the seconds each call has, defaulting to the connection's.
+
+        """
+        return _Execution(self, connection, max_in_flight, timeout).run()
+
+
+def _machine_order(name):
+    try:
+        return (0, int(name))
+    except ValueError:
+        return (1, name)
+
+
+def _machine_id(index, name):
+    def machine_id(done):
+        results = done['machines'].result.get('Machines') or []
+        result = results[index] if index < len(results) else {}
+        if result.get('Error'):
+            raise new_result_error(result['Error'])
+        if not result.get('Machine'):
+            raise RuntimeError(
+                "AddMachines returned no machine for {}".format(name))
+        return result['Machine']
+    return machine_id
+
+
+def _deploy_params(deploy, place):
+    if place is None:
+        return deploy.to_json()
+
+    def params(done):
+        deploy.to_machine_spec = place(done)
+        return deploy.to_json()
+    return params
+
+
+def _units_params(add, place):
+    def params(done):
+        add.to_machine_spec = place(done)
+        return add.to_json()
+    return params
+
+
+class _Execution(object):
+    """Runs a plan's steps, as their dependencies complete.
+
+    Each step counts the steps it requires that haven't finished, and is
+    ready once none are left. Completed calls are queued by their callbacks
+    and handled by run, which starts the calls newly ready, so a connection
+    that completes calls as they are submitted doesn't recurse.
+
+    """
+
+    def __init__(self, plan, connection, max_in_flight, timeout):
+        if max_in_flight < 1:
+            raise ValueError("max_in_flight must be positive")
+        plan.levels()
+        self.plan = plan
+        self.connection = connection
+        self.max_in_flight = max_in_flight
+        self.timeout = timeout
+        self.done = {}
+        self.remaining = len(plan.steps)
+        self.in_flight = 0
+        self.cond = threading.Condition()
+        self.finished = collections.deque()
+        self.bulk_version = None
+        try:
+            self.bulk_version = connection.get_facade("Service").version
+        except UnknownFacade:
+            pass
+        self.ready = collections.deque()
+        # Ready steps that make no call.
+        self.local = collections.deque()
+        # Ready deploys, sent together when the server has ServicesDeploy.
+        self.ready_deploys = []
+        self.unmet = {}
+        self.dependents = collections.defaultdict(list)
+        for step in plan.steps.values():
+            self.unmet[step.name] = len(step.requires)
+            for name in step.requires:
+                self.dependents[name].append(step)
+            if not step.requires:
+                self._make_ready(step)
+
+    def run(self):
+        start = time.time()
+        with self.cond:
+            while self.remaining:
+                while self.finished:
+                    self._complete(*self.finished.popleft())
+                while self.local:
+                    self._run_local(self.local.popleft())
+                calls = self._next_calls()
+                if calls:
+                    # Submitted without the lock, as on a connection that
+                    # isn't pipelined the callbacks are called at once.
+                    self.cond.release()
+                    try:
+                        for call in calls:
+                            self._submit(*call)
+                    finally:
+                        self.cond.acquire()
+                elif self.remaining and not self.finished:
+                    self.cond.wait()
+        return DeploymentReport(list(self.plan.steps.values()),
+                                time.time() - start)
+
+    def _make_ready(self, step):
+        if step.facade is None:
+            self.local.append(step)
+        elif (self.bulk_version is not None and
+                step.method == 'ServiceDeploy'):
+            self.ready_deploys.append(step)
+        else:
+            self.ready.append(step)
+
+    def _run_local(self, step):
+        # Called with the lock held.
+        step.started = time.time()
+        try:
+            step.result = step.params(self.done)
+        except Exception as e:
+            step.error = e
+        step.finished = time.time()
+        self._release(step)
+
+    def _next_calls(self):
+        # Called with the lock held.
+        capacity = self.max_in_flight - self.in_flight
+        calls = []
+        if capacity > 0 and len(self.ready_deploys) > 1:
+            calls.append((self.ready_deploys, 'Service', 'ServicesDeploy',
+                          self.bulk_version))
+            self.ready_deploys = []
+        elif self.ready_deploys:
+            self.ready.extend(self.ready_deploys)
+            self.ready_deploys = []
+        while self.ready and len(calls) < capacity:
+            step = self.ready.popleft()
+            calls.append(((step,), step.facade, step.method, None))
+        started = time.time()
+        for steps, _, _, _ in calls:
+            for step in steps:
+                step.started = started
+        self.in_flight += len(calls)
+        return [self._resolve(*call) for call in calls]
+
+    def _resolve(self, steps, facade, method, version):
+        try:
+            params = [self._params(step) for step in steps]
+        except Exception as e:
+            params = e
+        if isinstance(params, list) and facade == 'Service':
+            params = {'Services': params}
+        elif isinstance(params, list):
+            params = params[0]
+        return steps, facade, method, params, version
+
+    def _params(self, step):
+        if callable(step.params):
+            return step.params(self.done)
+        return step.params
+
+    def _submit(self, steps, facade, method, params, version):
+        if isinstance(params, Exception):
+            self._finished(steps, None, params)
+            return
+        kwargs = {}
+        if self.timeout is not None:
+            kwargs['timeout'] = self.timeout
+        try:
+            future = self.connection.submit(
+                facade, method, params, version=version, **kwargs)
+        except Exception as e:
+            self._finished(steps, None, e)
+            return
+
+        def on_done(future):
+            error = future.exception()
+            self._finished(
+                steps, None if error else future.result(), error)
+        future.add_done_callback(on_done)
+
+    def _finished(self, steps, result, error):
+        # Called from the future's callback, so only queues the outcome
+        # for run to handle.
+        with self.cond:
+            self.finished.append((steps, result, error, time.time()))
+            self.cond.notify()
+
+    def _complete(self, steps, result, error, finished):
+        # Called with the lock held.
+        try:
+            results = None
+            if len(steps) > 1 and error is None:
+                results = (result or {}).get('Results') or []
+                if len(results) != len(steps):
+                    error = RuntimeError(
+                        "ServicesDeploy returned {} results for {} "
+                        "services".format(len(results), len(steps)))
+            for i, step in enumerate(steps):
+                step.finished = finished
+                if error is not None:
+                    step.error = error
+                elif results is not None and results[i].get('Error'):
+                    step.error = new_result_error(results[i]['Error'])
+                else:
+                    step.result = result
+        finally:
+            self.in_flight -= 1
+        for step in steps:
+            self._release(step)
+
+    def _release(self, step):
+        """Mark a step done, and make ready or fail the steps needing it."""
+        work = [step]
+        while work:
+            step = work.pop()
+            self.done[step.name] = step
+            self.remaining -= 1
+            for dependent in self.dependents.get(step.name, ()):
+                if dependent.name in self.done:
+                    continue
+                if step.error is not None:
+                    # Failed now, rather than once its other dependencies
+                    # are done.
+                    dependent.error = DependencyFailed(
+                        dependent.name, step.name)
+                    self.done[dependent.name] = dependent
+                    work.append(dependent)
+                    continue
+                self.unmet[dependent.name] -= 1
+                if self.unmet[dependent.name] == 0:
+                    self._make_ready(dependent)
+
+
+class DeploymentReport(object):
+    """What became of each step of a deployment, and how long it took."""
+
+    def __init__(self, steps, seconds):
+        self.steps = steps
+        self.seconds = seconds
+
+    @property
+    def errors(self):
+        """The steps that failed, by name."""
+        return collections.OrderedDict(
+            (step.name, step.error) for step in self.steps
+            if step.error is not None)
+
+    @property
+    def ok(self):
+        return not self.errors
+
+    def format(self):
+        lines = []
+        for step in sorted(self.steps, key=lambda s: s.started or 0):
+            seconds = step.seconds
+            lines.append("{:<40} {:>9} {}".format(
+                step.name,
+                "-" if seconds is None else "{:.3f}s".format(seconds),
+                "" if step.error is None else "FAILED: {}".format(
+                    step.error)))
+        lines.append("{:<40} {:>8.3f}s".format("total", self.seconds))
+        return "\n".join(line.rstrip() for line in lines)
@@ -6,10 +6,19 @@ class Environment(object):
     """Represents an environment in a Juju System.
 
     The environment may be the initial environment of the system itself.
+    Environments listed by a System also know their UUID and owner, and
+    fetch their summary from the system when it is first asked for.
     """
 
-    def __init__(self, name):
+    def __init__(self, name, uuid=None, owner=None, system=None):
         self.name = name
+        self.uuid = uuid
+        self.owner = owner
+        self.system = system
+        self._summary = None
+
+    def __repr__(self):
+        return "<Environment {}>".format(self.name)
 
     @property
     def running(self):
@@ -21,10 +30,69 @@ class Environment(object):
         except EnvironmentNotBootstrapped:
             return False
 
+    @property
+    def summary(self):
+        """The environment's life, owner, and counts of machines and
+        services, as returned by SystemManager.EnvironmentStatus.
+
+        Fetched from the system the first time it is asked for; see
+        System.fetch_summaries for fetching many at once.
+
+        """
+        if self._summary is None:
+            if self.system is None:
+                raise ValueError(
+                    "environment {} has no system".format(self.name))
+            result = self.system.fetch_summaries([self])[0]
+            if result.error is not None:
+                raise result.error
+        return self._summary
+
+    def refresh(self):
+        """Forget the summary, so it is fetched again when next used."""
+        self._summary = None
+
     def connection_info(self):
+        if (self.system is not None and self.system.info is not None and
+                self.uuid is not None):
+            info = dict(self.system.info)
+            info['environ-uuid'] = self.uuid
+            return info
         store = ConfigStore()
         return store.connection_info(self.name)
 
-    def status():
-        # work in progress here...
-        pass
+    def status(self, **connection_args):
+        """Return the environment's Client.FullStatus.
+
+        A connection is made to the environment for the call, and closed
+        after. Any keyword arguments are passed to the Connection.
+
+        """
+        # Imported here, so that importing juju doesn't import the client.
+        from .apiclient import connection_from_info
+        connection = connection_from_info(
+            self.connection_info(), **connection_args)
+        try:
+            return connection.rpc("Client", "FullStatus")
+        finally:
+            connection.close()
+
+    def wait_for(self, predicate, timeout=None, kinds=None,
+                 **connection_args):
+        """Wait until predicate(state) is true for the environment.
+
+        A pipelined connection is made to the environment, and its
+        AllWatcher used to check the predicate as the environment changes,
+        rather than polling its status; see Connection.wait_for. The
+        connection is closed after. Any keyword arguments are passed to the
+        Connection.
+
+        """
+        from .apiclient import connection_from_info
+        connection_args.setdefault('pipelined', True)
+        connection = connection_from_info(
+            self.connection_info(), **connection_args)
+        try:
+            return connection.wait_for(predicate, timeout, kinds)
+        finally:
+            connection.close()
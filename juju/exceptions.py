@@ -7,3 +7,12 @@ class EnvironmentNotBootstrapped(Exception):
 
     def __str__(self):
         return "environment %s is not bootstrapped" % self.environment
+
+
+class EnvironmentNotFound(Exception):
+
+    def __init__(self, environment):
+        self.environment = environment
+
+    def __str__(self):
+        return "environment %s not found" % self.environment
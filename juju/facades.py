@@ -0,0 +1,317 @@
+"""Typed facade classes, generated from a facade schema.
+
+Facade's methods are looked up dynamically and take and return plain dicts.
+The classes generated here instead have a real method for each of the
+facade's methods, taking the request's fields as keyword arguments and
+returning a slotted Type, with a slot for each field, for the response:
+
+    >>> client = connection.get_typed_facade("Client")
+    >>> status = client.FullStatus(patterns=["wordpress"])
+    >>> status.machines["0"].dns_name
+
+Requests are checked against the schema before they are sent. Classes are
+generated once per facade and version, from the schema bundled in
+juju/schemas/facades.json, which is in the same format as Juju's own
+schema.json, or from another schema file passed to load_schema.
+
+"""
+import json
+import os
+import re
+import threading
+
+try:
+    string_types = (basestring,)  # noqa
+except NameError:
+    string_types = (str,)
+
+
+SCHEMA_FILE = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), 'schemas', 'facades.json')
+
+
+class SchemaError(ValueError):
+    """Raised for requests that don't match the facade's schema."""
+
+
+_lock = threading.Lock()
+_schemas = {}
+_classes = {}
+
+
+def load_schema(filename=SCHEMA_FILE):
+    """Return the schema in a file, by (facade name, version)."""
+    with _lock:
+        schema = _schemas.get(filename)
+    if schema is None:
+        with open(filename) as f:
+            schema = dict(
+                ((facade['Name'], facade['Version']), facade['Schema'])
+                for facade in json.load(f))
+        with _lock:
+            schema = _schemas.setdefault(filename, schema)
+    return schema
+
+
+def schema_versions(name, filename=SCHEMA_FILE):
+    """Return the versions of a facade in the schema."""
+    return sorted(v for n, v in load_schema(filename) if n == name)
+
+
+_FIRST_CAP = re.compile(r'(.)([A-Z][a-z]+)')
+_ALL_CAP = re.compile(r'([a-z0-9])([A-Z])')
+
+
+def attribute_name(field):
+    """Return the Python name for a field, such as dns_name for DNSName."""
+    name = _ALL_CAP.sub(r'\1_\2', _FIRST_CAP.sub(r'\1_\2', field))
+    return name.replace('-', '_').lower()
+
+
+_PRIMITIVES = {
+    'string': string_types,
+    'integer': (int,),
+    'number': (int, float),
+    'boolean': (bool,),
+    'array': (list, tuple),
+    'object': (dict,),
+}
+
+
+class Type(object):
+    """A slotted request or response type generated from the schema.
+
+    FIELDS maps each attribute to its field name in the JSON. Types are
+    constructed with keyword arguments, which are checked against the
+    schema; from_json builds one from a response without checking it.
+
+    """
+    __slots__ = ()
+    FIELDS = {}
+    REQUIRED = ()
+    _converters = {}
+    _definition = {}
+
+    def __init__(self, **kwargs):
+        for attr in self.__slots__:
+            setattr(self, attr, kwargs.pop(attr, None))
+        if kwargs:
+            raise SchemaError("{} has no fields {}".format(
+                type(self).__name__, ", ".join(sorted(kwargs))))
+        self.validate()
+
+    def validate(self):
+        """Check the values against the schema, raising SchemaError."""
+        name = type(self).__name__
+        properties = self._definition.get('properties', {})
+        for attr in self.REQUIRED:
+            if getattr(self, attr) is None:
+                raise SchemaError("{} needs {}".format(name, attr))
+        for attr, field in self.FIELDS.items():
+            value = getattr(self, attr)
+            if value is not None:
+                _check(value, properties[field], "{}.{}".format(name, attr))
+
+    @classmethod
+    def from_json(cls, data):
+        obj = cls.__new__(cls)
+        fields = cls.FIELDS
+        converters = cls._converters
+        for attr in cls.__slots__:
+            value = data.get(fields[attr])
+            if value is not None and attr in converters:
+                value = converters[attr](value)
+            setattr(obj, attr, value)
+        return obj
+
+    def to_json(self):
+        """Return the JSON fields, leaving out those that are None."""
+        data = {}
+        for attr, field in self.FIELDS.items():
+            value = getattr(self, attr)
+            if value is not None:
+                data[field] = _to_json(value)
+        return data
+
+    def __eq__(self, other):
+        return (type(self) is type(other) and
+                all(getattr(self, a) == getattr(other, a)
+                    for a in self.__slots__))
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return "<{} {}>".format(type(self).__name__, " ".join(
+            "{}={!r}".format(a, getattr(self, a)) for a in self.__slots__
+            if getattr(self, a) is not None))
+
+
+def _to_json(value):
+    if isinstance(value, Type):
+        return value.to_json()
+    if isinstance(value, (list, tuple)):
+        return [_to_json(v) for v in value]
+    if isinstance(value, dict):
+        return dict((k, _to_json(v)) for k, v in value.items())
+    return value
+
+
+def _check(value, schema, where):
+    if isinstance(value, Type):
+        if '$ref' not in schema:
+            raise SchemaError("{} should not be a {}".format(
+                where, type(value).__name__))
+        return
+    if '$ref' in schema:
+        if not isinstance(value, dict):
+            raise SchemaError("{} should be a dict".format(where))
+        return
+    kind = schema.get('type')
+    if kind is None:
+        return
+    if (not isinstance(value, _PRIMITIVES[kind]) or
+            (kind in ('integer', 'number') and isinstance(value, bool))):
+        raise SchemaError("{} should be of type {}, not {}".format(
+            where, kind, type(value).__name__))
+    if kind == 'array' and 'items' in schema:
+        for i, item in enumerate(value):
+            _check(item, schema['items'], "{}[{}]".format(where, i))
+    elif kind == 'object' and 'patternProperties' in schema:
+        item_schema = schema['patternProperties']['.*']
+        for key, item in value.items():
+            _check(item, item_schema, "{}[{!r}]".format(where, key))
+
+
+class _Builder(object):
+    """Builds the Types for a facade's definitions, once each."""
+
+    def __init__(self, schema):
+        self.definitions = schema.get('definitions', {})
+        self.types = {}
+
+    def type_for(self, name):
+        cls = self.types.get(name)
+        if cls is not None:
+            return cls
+        definition = self.definitions[name]
+        properties = definition.get('properties', {})
+        fields = dict((attribute_name(f), f) for f in properties)
+        cls = type(str(name), (Type,), {
+            '__slots__': tuple(sorted(fields)),
+            'FIELDS': fields,
+            'REQUIRED': tuple(
+                attribute_name(f) for f in definition.get('required', ())),
+            '_definition': definition,
+        })
+        # Added before the converters, which may refer back to the type.
+        self.types[name] = cls
+        converters = {}
+        for attr, field in fields.items():
+            converter = self.converter(properties[field])
+            if converter is not None:
+                converters[attr] = converter
+        cls._converters = converters
+        return cls
+
+    def ref(self, schema):
+        """Return the type a {"$ref": ...} schema refers to."""
+        return self.type_for(schema['$ref'].split('/')[-1])
+
+    def converter(self, schema):
+        """Return a function converting JSON to the schema's types, if any."""
+        if '$ref' in schema:
+            return self.ref(schema).from_json
+        kind = schema.get('type')
+        if kind == 'array' and 'items' in schema:
+            item = self.converter(schema['items'])
+            if item is not None:
+                return lambda values: [item(v) for v in values]
+        elif kind == 'object' and 'patternProperties' in schema:
+            item = self.converter(schema['patternProperties']['.*'])
+            if item is not None:
+                return lambda values: dict(
+                    (k, item(v)) for k, v in values.items())
+        return None
+
+
+class TypedFacade(object):
+    """The base of the generated facade classes.
+
+    TYPES holds the facade's request and response types by name.
+
+    """
+    __slots__ = ('connection',)
+    NAME = None
+    VERSION = None
+    TYPES = {}
+
+    def __init__(self, connection):
+        self.connection = connection
+
+
+def _make_method(facade, method, params, result):
+    def call(self, params_=None, **kwargs):
+        if params is None:
+            if params_ is not None or kwargs:
+                raise SchemaError("{}.{} takes no params".format(
+                    facade, method))
+            data = None
+        else:
+            if params_ is None:
+                params_ = params(**kwargs)
+            elif kwargs:
+                raise SchemaError(
+                    "{}.{} takes params or keyword arguments, not "
+                    "both".format(facade, method))
+            elif not isinstance(params_, params):
+                raise SchemaError("{}.{} takes a {}, not a {}".format(
+                    facade, method, params.__name__,
+                    type(params_).__name__))
+            data = params_.to_json()
+        response = self.connection.rpc(
+            self.NAME, method, data, version=self.VERSION)
+        if result is None:
+            return response
+        return result.from_json(response)
+
+    call.__name__ = str(method)
+    fields = ""
+    if params is not None:
+        fields = " Takes a {} or its fields ({}).".format(
+            params.__name__, ", ".join(params.__slots__))
+    call.__doc__ = "Call {}.{}.{}{}".format(
+        facade, method, fields,
+        " Returns a {}.".format(result.__name__) if result else "")
+    return call
+
+
+def facade_class(name, version, filename=SCHEMA_FILE):
+    """Return the typed facade class for a facade version in the schema.
+
+    Classes are only generated the first time they are asked for.
+
+    """
+    key = (filename, name, version)
+    with _lock:
+        cls = _classes.get(key)
+    if cls is not None:
+        return cls
+    try:
+        schema = load_schema(filename)[(name, version)]
+    except KeyError:
+        raise KeyError("no schema for {} version {}".format(name, version))
+    builder = _Builder(schema)
+    attrs = {'__slots__': (), 'NAME': name, 'VERSION': version}
+    for method, spec in schema.get('properties', {}).items():
+        props = spec.get('properties', {})
+        params = result = None
+        if 'Params' in props:
+            params = builder.ref(props['Params'])
+        if 'Result' in props:
+            result = builder.ref(props['Result'])
+        attrs[str(method)] = _make_method(name, method, params, result)
+    attrs['TYPES'] = builder.types
+    cls = type(str("{}V{}".format(name, version)), (TypedFacade,), attrs)
+    with _lock:
+        return _classes.setdefault(key, cls)
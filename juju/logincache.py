@@ -0,0 +1,103 @@
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+
+
+logger = logging.getLogger("juju")
+
+
+class LoginCache(object):
+    """Remembers, on disk, how each API endpoint was last logged in to.
+
+    Connections start with the newest version of the Admin facade and fall
+    back to older ones, which costs a round trip per version an older server
+    doesn't support. The cache records, per endpoint, the login version that
+    worked and the facades the server offered, so that later connections,
+    from this or another process, try that version first.
+
+    Entries older than ttl seconds are ignored. An entry is invalidated when
+    its login version stops working, and replaced when the server reports a
+    different facade table.
+
+    """
+
+    def __init__(self, path=None, ttl=24 * 60 * 60):
+        if path is None:
+            path = self._default_path()
+        self.path = path
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = {}
+        self._stamp = None
+
+    @staticmethod
+    def _default_path():
+        cache_home = os.environ.get(
+            'XDG_CACHE_HOME', os.path.join('~', '.cache'))
+        return os.path.expanduser(
+            os.path.join(cache_home, 'jujulib', 'login-cache.json'))
+
+    def _load(self):
+        """Reread the file if it has changed since it was last read."""
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            self._entries, self._stamp = {}, None
+            return
+        stamp = (st.st_mtime, st.st_size)
+        if stamp == self._stamp:
+            return
+        try:
+            with open(self.path) as fh:
+                entries = json.load(fh)
+            if not isinstance(entries, dict):
+                raise ValueError("not a mapping")
+        except (IOError, OSError, ValueError) as e:
+            logger.warning("ignoring bad login cache %s: %s", self.path, e)
+            entries = {}
+        self._entries, self._stamp = entries, stamp
+
+    def _save(self):
+        directory = os.path.dirname(self.path)
+        try:
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            fd, tmp = tempfile.mkstemp(dir=directory, suffix='.tmp')
+            with os.fdopen(fd, 'w') as fh:
+                json.dump(self._entries, fh)
+            getattr(os, 'replace', os.rename)(tmp, self.path)
+            st = os.stat(self.path)
+            self._stamp = (st.st_mtime, st.st_size)
+        except (IOError, OSError) as e:
+            # The cache is only an optimization, so carry on without it.
+            logger.warning("unable to write login cache %s: %s", self.path, e)
+
+    def get(self, key):
+        """Return the cached {'version', 'facades'} for the key, or None."""
+        with self._lock:
+            self._load()
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if time.time() - entry.get('time', 0) > self.ttl:
+                return None
+            return entry
+
+    def put(self, key, version, facades):
+        with self._lock:
+            self._load()
+            self._entries[key] = {
+                'version': version,
+                'facades': facades,
+                'time': time.time(),
+            }
+            self._save()
+
+    def invalidate(self, key):
+        with self._lock:
+            self._load()
+            if self._entries.pop(key, None) is not None:
+                self._save()
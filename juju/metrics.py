@@ -0,0 +1,320 @@
+"""Metrics for the calls made on API connections.
+
+Pass a Metrics to a Connection to record, for each facade method, how many
+calls were made, how long they took, how many bytes were sent and received
+(and how many they took on the wire, when compressed), how many times they
+were retried and which errors they failed with:
+
+    >>> metrics = Metrics(exporters=[LoggingExporter()])
+    >>> conn = open_environment("prod", metrics=metrics)
+    >>> conn.rpc("Client", "FullStatus")
+    >>> metrics.snapshot()["Client.FullStatus"]["count"]
+    1
+    >>> metrics.export()
+
+Connections without a Metrics do no more than check for one, so there is
+next to no cost to leaving metrics off.
+
+"""
+import collections
+import logging
+import os
+import tempfile
+import threading
+
+
+logger = logging.getLogger("juju")
+
+
+# The upper bounds, in seconds, of the latency histogram's buckets. The last
+# bucket, for everything slower, is implied.
+DEFAULT_BUCKETS = (
+    0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+CallRecord = collections.namedtuple(
+    "CallRecord", "facade method seconds response_bytes error_code")
+
+
+class _MethodStats(object):
+    __slots__ = ('count', 'errors', 'retries', 'seconds', 'buckets',
+                 'request_bytes', 'response_bytes', 'error_codes',
+                 'request_wire_bytes', 'response_frame_bytes',
+                 'response_wire_bytes')
+
+    def __init__(self, nbuckets):
+        self.count = 0
+        self.errors = 0
+        self.retries = 0
+        self.seconds = 0.0
+        self.buckets = [0] * (nbuckets + 1)
+        self.request_bytes = 0
+        self.response_bytes = 0
+        self.error_codes = {}
+        self.request_wire_bytes = 0
+        self.response_frame_bytes = 0
+        self.response_wire_bytes = 0
+
+
+class Metrics(object):
+    """Collects the metrics of calls, for any number of connections.
+
+    Hooks are called with a CallRecord for each call as it completes, from
+    whichever thread completed it. Exporters are passed a snapshot each time
+    export is called.
+
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS, hooks=(), exporters=()):
+        self.buckets = tuple(sorted(buckets))
+        self.hooks = list(hooks)
+        self.exporters = list(exporters)
+        self._lock = threading.Lock()
+        self._methods = {}
+
+    def _stats(self, facade, method):
+        # Called with the lock held.
+        key = (facade, method)
+        stats = self._methods.get(key)
+        if stats is None:
+            stats = self._methods[key] = _MethodStats(len(self.buckets))
+        return stats
+
+    def record_request(self, facade, method, nbytes, wire_bytes=None):
+        """Record a request frame of nbytes being sent.
+
+        wire_bytes is what the frame took once compressed, if it was.
+
+        """
+        if wire_bytes is None:
+            wire_bytes = nbytes
+        with self._lock:
+            stats = self._stats(facade, method)
+            stats.request_bytes += nbytes
+            stats.request_wire_bytes += wire_bytes
+
+    def record_response(self, facade, method, nbytes, wire_bytes=None):
+        """Record a response frame of nbytes being received.
+
+        wire_bytes is what the frame took before being decompressed, if it
+        was compressed.
+
+        """
+        if wire_bytes is None:
+            wire_bytes = nbytes
+        with self._lock:
+            stats = self._stats(facade, method)
+            stats.response_frame_bytes += nbytes
+            stats.response_wire_bytes += wire_bytes
+
+    def record_retry(self, facade, method):
+        """Record a call being retried."""
+        with self._lock:
+            self._stats(facade, method).retries += 1
+
+    def record_call(self, facade, method, seconds, response_bytes=0,
+                    error_code=None):
+        """Record a completed call, and pass it on to the hooks.
+
+        error_code is the error code of a failed call: the ErrorCode of an
+        error response, or the name of the exception raised.
+
+        """
+        index = 0
+        for bound in self.buckets:
+            if seconds <= bound:
+                break
+            index += 1
+        with self._lock:
+            stats = self._stats(facade, method)
+            stats.count += 1
+            stats.seconds += seconds
+            stats.buckets[index] += 1
+            stats.response_bytes += response_bytes
+            if error_code is not None:
+                stats.errors += 1
+                stats.error_codes[error_code] = (
+                    stats.error_codes.get(error_code, 0) + 1)
+        if self.hooks:
+            record = CallRecord(
+                facade, method, seconds, response_bytes, error_code)
+            for hook in self.hooks:
+                try:
+                    hook(record)
+                except Exception:
+                    logger.exception("exception in metrics hook")
+
+    def snapshot(self):
+        """Return the metrics as a dict, keyed by "Facade.Method".
+
+        Each value is a dict of the count of calls, errors and retries, the
+        total seconds and bytes, the count of each error code, and the
+        latency histogram as a list of [upper bound, cumulative count]
+        pairs, the last bound being None for infinity. request_wire_bytes
+        and response_wire_bytes are the bytes the frames took on the wire,
+        and compression_ratio how many times bigger the frames were than
+        that (1.0 without compression), or None before any were recorded.
+
+        """
+        bounds = list(self.buckets) + [None]
+        snapshot = {}
+        with self._lock:
+            for (facade, method), stats in self._methods.items():
+                cumulative = 0
+                histogram = []
+                for bound, count in zip(bounds, stats.buckets):
+                    cumulative += count
+                    histogram.append([bound, cumulative])
+                snapshot["{}.{}".format(facade, method)] = {
+                    'facade': facade,
+                    'method': method,
+                    'count': stats.count,
+                    'errors': stats.errors,
+                    'retries': stats.retries,
+                    'seconds': stats.seconds,
+                    'histogram': histogram,
+                    'request_bytes': stats.request_bytes,
+                    'response_bytes': stats.response_bytes,
+                    'error_codes': dict(stats.error_codes),
+                    'request_wire_bytes': stats.request_wire_bytes,
+                    'response_wire_bytes': stats.response_wire_bytes,
+                    'compression_ratio': _ratio(
+                        stats.request_bytes + stats.response_frame_bytes,
+                        stats.request_wire_bytes +
+                        stats.response_wire_bytes),
+                }
+        return snapshot
+
+    def reset(self):
+        """Forget everything recorded so far."""
+        with self._lock:
+            self._methods.clear()
+
+    def export(self):
+        """Pass a snapshot to each of the exporters."""
+        snapshot = self.snapshot()
+        for exporter in self.exporters:
+            try:
+                exporter.export(snapshot)
+            except Exception:
+                logger.exception("exception exporting metrics")
+
+
+class LoggingExporter(object):
+    """Logs a line for each facade method."""
+
+    def __init__(self, log=None, level=logging.INFO):
+        if log is None:
+            log = logger
+        self.log = log
+        self.level = level
+
+    def export(self, snapshot):
+        for name in sorted(snapshot):
+            stats = snapshot[name]
+            mean = stats['seconds'] / stats['count'] if stats['count'] else 0
+            self.log.log(
+                self.level,
+                "%s: %d calls, %d errors, %d retries, mean %.3fs, "
+                "%d bytes sent, %d bytes received", name, stats['count'],
+                stats['errors'], stats['retries'], mean,
+                stats['request_bytes'], stats['response_bytes'])
+
+
+class PrometheusExporter(object):
+    """Formats metrics in the Prometheus text exposition format.
+
+    render returns the text. If path is given, export writes it there,
+    atomically, for a node exporter's textfile collector to pick up.
+
+    """
+
+    def __init__(self, path=None, prefix="juju_rpc"):
+        self.path = path
+        self.prefix = prefix
+
+    def render(self, snapshot):
+        prefix = self.prefix
+        lines = []
+
+        def family(name, kind, help):
+            lines.append("# HELP {}_{} {}".format(prefix, name, help))
+            lines.append("# TYPE {}_{} {}".format(prefix, name, kind))
+
+        def sample(name, stats, value, **extra):
+            labels = [('facade', stats['facade']),
+                      ('method', stats['method'])]
+            labels.extend(sorted(extra.items()))
+            lines.append("{}_{}{{{}}} {}".format(
+                prefix, name, ",".join(
+                    '{}="{}"'.format(k, _escape(v)) for k, v in labels),
+                _number(value)))
+
+        methods = [snapshot[name] for name in sorted(snapshot)]
+        family("calls_total", "counter", "API calls made.")
+        for stats in methods:
+            sample("calls_total", stats, stats['count'])
+        family("retries_total", "counter", "API calls retried.")
+        for stats in methods:
+            sample("retries_total", stats, stats['retries'])
+        family("errors_total", "counter", "API calls failed, by error code.")
+        for stats in methods:
+            for code in sorted(stats['error_codes']):
+                sample("errors_total", stats, stats['error_codes'][code],
+                       code=code)
+        family("request_bytes_total", "counter", "Request bytes sent.")
+        for stats in methods:
+            sample("request_bytes_total", stats, stats['request_bytes'])
+        family("response_bytes_total", "counter", "Response bytes received.")
+        for stats in methods:
+            sample("response_bytes_total", stats, stats['response_bytes'])
+        family("request_wire_bytes_total", "counter",
+               "Request bytes sent on the wire, after compression.")
+        for stats in methods:
+            sample("request_wire_bytes_total", stats,
+                   stats['request_wire_bytes'])
+        family("response_wire_bytes_total", "counter",
+               "Response bytes received on the wire, before decompression.")
+        for stats in methods:
+            sample("response_wire_bytes_total", stats,
+                   stats['response_wire_bytes'])
+        family("duration_seconds", "histogram", "API call latency.")
+        for stats in methods:
+            for bound, count in stats['histogram']:
+                le = "+Inf" if bound is None else _number(bound)
+                sample("duration_seconds_bucket", stats, count, le=le)
+            sample("duration_seconds_sum", stats, stats['seconds'])
+            sample("duration_seconds_count", stats, stats['count'])
+        return "\n".join(lines) + "\n"
+
+    def export(self, snapshot):
+        text = self.render(snapshot)
+        if self.path is None:
+            return text
+        directory = os.path.dirname(os.path.abspath(self.path))
+        fd, tmp = tempfile.mkstemp(dir=directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w") as f:
+                f.write(text)
+            getattr(os, 'replace', os.rename)(tmp, self.path)
+        except Exception:
+            os.unlink(tmp)
+            raise
+        return text
+
+
+def _ratio(nbytes, wire_bytes):
+    if not wire_bytes:
+        return None
+    return float(nbytes) / wire_bytes
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace(
+        '\n', '\\n')
+
+
+def _number(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
@@ -0,0 +1,162 @@
+"""Making the same call on many environments at once.
+
+for_each_environment connects to each environment in the config store (or
+a given list of them) and makes a call on each connection, a bounded number
+at a time, generating the results as they complete:
+
+    >>> def version(conn):
+    ...     return conn.rpc("Client", "AgentVersion")["Version"]
+    >>> for r in for_each_environment(version, timeout=30):
+    ...     print(r.name, r.error or r.result)
+
+"""
+import collections
+import logging
+import threading
+import time
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+from .apiclient import connection_from_info
+from .configstore import ConfigStore
+
+
+logger = logging.getLogger("juju")
+
+
+EnvironmentResult = collections.namedtuple(
+    "EnvironmentResult", "name result error elapsed")
+
+
+class EnvironmentTimeout(Exception):
+    """Raised for environments that didn't finish within the timeout."""
+
+    def __init__(self, environment, timeout):
+        self.environment = environment
+        self.timeout = timeout
+
+    def __str__(self):
+        return "environment {} timed out after {}s".format(
+            self.environment, self.timeout)
+
+
+def for_each_environment(call, names=None, max_workers=8, timeout=None,
+                         store=None, pool=None, **connection_args):
+    """Call call(connection) for each environment, concurrently.
+
+    Generates an EnvironmentResult for each environment, in the order they
+    complete, holding the call's result or the error from connecting or
+    making the call, and the seconds taken.
+
+    names: the environments to use, by default all those in the store.
+
+    max_workers: the most environments connected to at once.
+
+    timeout: the seconds each environment has to connect and make the call.
+    An environment that takes longer gets an EnvironmentTimeout error and
+    its worker is abandoned, so a dead controller can't stall the sweep.
+    The connection's calls also time out when the environment's time is
+    up, so abandoned workers end and close their connections.
+
+    pool: a ConnectionPool to acquire connections from, rather than making
+    new connections, which are closed once the call is made. Waiting for a
+    pooled connection, and its calls, time out with the environment too.
+    Any other keyword arguments are passed to the Connection constructor.
+
+    """
+    if store is None:
+        store = ConfigStore()
+    if names is None:
+        names = store.environment_names()
+    names = list(names)
+    if len(set(names)) != len(names):
+        raise ValueError("environment names must be unique")
+    if max_workers < 1:
+        raise ValueError("max_workers must be positive")
+    waiting = list(reversed(names))
+    results = queue.Queue()
+    running = {}
+
+    def work(name, deadline):
+        start = time.time()
+        try:
+            result = _call_environment(
+                call, name, store, pool, deadline, connection_args)
+        except Exception as e:
+            if deadline is not None and time.time() >= deadline:
+                # Most likely the call timing out with the environment,
+                # reported the same as if the worker had been abandoned.
+                e = EnvironmentTimeout(name, timeout)
+            results.put(EnvironmentResult(
+                name, None, e, time.time() - start))
+        else:
+            results.put(EnvironmentResult(
+                name, result, None, time.time() - start))
+
+    while waiting or running:
+        while waiting and len(running) < max_workers:
+            name = waiting.pop()
+            deadline = None if timeout is None else time.time() + timeout
+            thread = threading.Thread(
+                target=work, args=(name, deadline), name="juju-env-" + name)
+            thread.daemon = True
+            running[name] = deadline
+            thread.start()
+        deadlines = [d for d in running.values() if d is not None]
+        wait = None
+        if deadlines:
+            wait = max(0, min(deadlines) - time.time())
+        try:
+            result = results.get(timeout=wait)
+        except queue.Empty:
+            now = time.time()
+            for name, deadline in list(running.items()):
+                if deadline is not None and deadline <= now:
+                    logger.warning(
+                        "abandoning environment %s after %ss", name, timeout)
+                    del running[name]
+                    yield EnvironmentResult(
+                        name, None, EnvironmentTimeout(name, timeout),
+                        timeout)
+            continue
+        if result.name not in running:
+            # Finished after being abandoned, and already reported.
+            continue
+        del running[result.name]
+        yield result
+
+
+def _remaining(deadline):
+    # Kept positive, as it may end up as a socket timeout.
+    return max(0.001, deadline - time.time())
+
+
+def _call_environment(call, name, store, pool, deadline, connection_args):
+    if pool is not None:
+        if deadline is None:
+            with pool.connection(name) as connection:
+                return call(connection)
+        with pool.connection(name, _remaining(deadline)) as connection:
+            # Pooled connections are handed out again, so their own timeout
+            # is put back afterwards.
+            saved = connection.timeout
+            connection.timeout = _remaining(deadline)
+            try:
+                return call(connection)
+            finally:
+                connection.timeout = saved
+    if deadline is not None:
+        connection_args = dict(
+            connection_args, timeout=_remaining(deadline))
+    connection = connection_from_info(
+        store.connection_info(name), **connection_args)
+    try:
+        if deadline is not None:
+            # Logging in took some of the time.
+            connection.timeout = _remaining(deadline)
+        return call(connection)
+    finally:
+        connection.close()
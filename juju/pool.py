@@ -0,0 +1,225 @@
+import contextlib
+import logging
+import threading
+import time
+
+from .apiclient import ServerError, connection_from_info
+from .configstore import ConfigStore
+
+
+logger = logging.getLogger("juju")
+
+
+class PoolTimeout(Exception):
+    """Raised when no pooled connection became free in time."""
+
+
+class _Idle(object):
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.since = time.time()
+
+
+class ConnectionPool(object):
+    """A thread-safe pool of authenticated connections.
+
+    Opening a connection means a TLS handshake and a login, which can take a
+    number of round trips, so the pool keeps connections around once they
+    are released and hands them out again for the same environment. Pooled
+    connections are keyed by environment UUID, so different names for the
+    same environment share connections.
+
+        >>> pool = ConnectionPool()
+        >>> with pool.connection("local") as conn:
+        ...     conn.rpc("Client", "FullStatus")
+
+    max_size: the most connections, in use or idle, held for a single
+    environment. Once reached, acquire waits for one to be released.
+
+    idle_timeout: connections idle for longer than this many seconds are
+    closed, the next time any connection is acquired or released.
+
+    check_after: connections idle for longer than this many seconds are
+    pinged before being handed out, and replaced if the ping fails.
+
+    Any other keyword arguments, such as pipelined, are passed to the
+    Connection constructor.
+
+    """
+
+    def __init__(self, max_size=4, idle_timeout=300, check_after=30,
+                 store=None, **connection_args):
+        if max_size < 1:
+            raise ValueError("max_size must be positive")
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.check_after = check_after
+        self.store = store
+        self._connection_args = connection_args
+        self._lock = threading.Condition()
+        self._idle = {}
+        self._in_use = {}
+        self._keys = {}
+
+    def _connection_info(self, env_name):
+        store = self.store
+        if store is None:
+            store = ConfigStore()
+        return store.connection_info(env_name)
+
+    def _connect(self, info):
+        return connection_from_info(info, **self._connection_args)
+
+    def acquire(self, env_name, timeout=None):
+        """Return a connection to the named environment.
+
+        An idle connection is reused if there is one, otherwise a new one is
+        made. If the pool is already at max_size for the environment this
+        waits up to timeout seconds (forever if None) for one to be released,
+        raising PoolTimeout if none is.
+
+        """
+        info = self._connection_info(env_name)
+        key = info['environ-uuid']
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            entry = self._reserve(key, env_name, timeout, deadline)
+            if entry is None:
+                break
+            # Check idle connections outside the lock, as it may need a ping.
+            if self._usable(entry):
+                return entry.connection
+            with self._lock:
+                self._in_use[key] -= 1
+                self._discard(entry.connection)
+                self._lock.notify()
+        try:
+            connection = self._connect(info)
+        except Exception:
+            with self._lock:
+                self._in_use[key] -= 1
+                self._lock.notify()
+            raise
+        with self._lock:
+            self._keys[id(connection)] = key
+        return connection
+
+    def _reserve(self, key, env_name, timeout, deadline):
+        """Reserve a slot in the pool for the key.
+
+        Returns the most recently used idle connection if there is one, or
+        None if a new connection should be made in the slot.
+
+        """
+        with self._lock:
+            while True:
+                self._drop_expired()
+                idle = self._idle.get(key)
+                if idle:
+                    self._in_use[key] = self._in_use.get(key, 0) + 1
+                    return idle.pop()
+                if self._size(key) < self.max_size:
+                    self._in_use[key] = self._in_use.get(key, 0) + 1
+                    return None
+                remaining = None
+                if deadline is not None:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        raise PoolTimeout(
+                            "no connection to {} free after {}s".format(
+                                env_name, timeout))
+                self._lock.wait(remaining)
+
+    def _drop_expired(self):
+        """Close the connections idle for longer than idle_timeout.
+
+        Called with the lock held, on every acquire and release, so idle
+        connections are closed even if their environment isn't used again.
+        Each list of idle connections is in the order they were released,
+        so the expired ones are at the front.
+
+        """
+        cutoff = time.time() - self.idle_timeout
+        for key, idle in list(self._idle.items()):
+            expired = 0
+            while expired < len(idle) and idle[expired].since < cutoff:
+                self._discard(idle[expired].connection)
+                expired += 1
+            if expired:
+                del idle[:expired]
+                if not idle:
+                    del self._idle[key]
+                # Others may be waiting for the slots freed.
+                self._lock.notify_all()
+
+    def _usable(self, entry):
+        if entry.connection.closed:
+            return False
+        age = time.time() - entry.since
+        if age > self.idle_timeout:
+            return False
+        if age <= self.check_after:
+            return True
+        try:
+            entry.connection.ping()
+        except Exception as e:
+            logger.debug("pooled connection failed health check: %s", e)
+            return False
+        return True
+
+    def _size(self, key):
+        return self._in_use.get(key, 0) + len(self._idle.get(key, []))
+
+    def _discard(self, connection):
+        self._keys.pop(id(connection), None)
+        try:
+            connection.close()
+        except Exception:
+            pass
+
+    def release(self, connection, discard=False):
+        """Return a connection to the pool.
+
+        Connections that are closed or broken, or released with discard set,
+        are closed and dropped rather than kept for reuse.
+
+        """
+        with self._lock:
+            key = self._keys.get(id(connection))
+            if key is None:
+                raise ValueError("connection is not from this pool")
+            self._in_use[key] -= 1
+            self._drop_expired()
+            if discard or connection.closed:
+                self._discard(connection)
+            else:
+                self._idle.setdefault(key, []).append(_Idle(connection))
+            self._lock.notify()
+
+    @contextlib.contextmanager
+    def connection(self, env_name, timeout=None):
+        """A context manager that acquires and releases a connection.
+
+        If the block raises anything other than a ServerError the connection
+        is assumed to be broken and is discarded.
+
+        """
+        connection = self.acquire(env_name, timeout)
+        try:
+            yield connection
+        except ServerError:
+            self.release(connection)
+            raise
+        except Exception:
+            self.release(connection, discard=True)
+            raise
+        self.release(connection)
+
+    def close(self):
+        """Close all the idle connections."""
+        with self._lock:
+            idle, self._idle = self._idle, {}
+            for entries in idle.values():
+                for entry in entries:
+                    self._discard(entry.connection)
@@ -0,0 +1,253 @@
+import heapq
+import logging
+import random
+import threading
+import time
+
+
+logger = logging.getLogger("juju")
+
+
+class RetryRule(object):
+    """Says which error responses are worth retrying.
+
+    A rule matches a response if its error code is error_code, or its error
+    message contains message. If max_attempts is given, the rule stops
+    matching after that many retries, regardless of the policy's limit.
+
+    """
+
+    def __init__(self, error_code=None, message=None, max_attempts=None):
+        if error_code is None and message is None:
+            raise ValueError("a rule needs an error_code or message")
+        self.error_code = error_code
+        self.message = message
+        self.max_attempts = max_attempts
+
+    def matches(self, result, attempt):
+        if 'Error' not in result:
+            return False
+        if self.max_attempts is not None and attempt >= self.max_attempts:
+            return False
+        if (self.error_code is not None and
+                result.get('ErrorCode') == self.error_code):
+            return True
+        return (self.message is not None and
+                self.message in (result.get('Error') or ''))
+
+
+DEFAULT_RULES = (
+    RetryRule(error_code="upgrade in progress", message="upgrade in progress"),
+    RetryRule(error_code="try again"),
+)
+
+
+class RetryBudget(object):
+    """Limits how many retries a connection makes overall.
+
+    Each retry spends a token and each call that doesn't need retrying earns
+    back a fraction of one, so that when a server is failing persistently the
+    connection stops adding retry load on top of its ordinary calls.
+
+    """
+
+    def __init__(self, tokens=100, earn_ratio=0.1):
+        self.max_tokens = tokens
+        self.earn_ratio = earn_ratio
+        self._tokens = float(tokens)
+        self._lock = threading.Lock()
+
+    @property
+    def tokens(self):
+        return self._tokens
+
+    def spend(self):
+        """Take a token for a retry, returning False if there are none."""
+        with self._lock:
+            if self._tokens < 1:
+                return False
+            self._tokens -= 1
+            return True
+
+    def earn(self):
+        with self._lock:
+            self._tokens = min(
+                self.max_tokens, self._tokens + self.earn_ratio)
+
+
+class RetryPolicy(object):
+    """Decides whether, and after how long, a failed call is retried.
+
+    Delays grow exponentially from base_delay by multiplier up to max_delay,
+    and each is reduced by a random amount of up to jitter (a fraction of
+    the delay) so that many clients don't retry in lock step. A call is given
+    up on after max_attempts retries, or once the next attempt would start
+    more than deadline seconds after the first.
+
+    budget is the number of retry tokens each connection using the policy
+    gets in its RetryBudget, or None for no budget.
+
+    """
+
+    def __init__(self, rules=DEFAULT_RULES, max_attempts=60, base_delay=0.1,
+                 max_delay=5.0, multiplier=2.0, jitter=0.5, deadline=60.0,
+                 budget=100):
+        self.rules = tuple(rules)
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.multiplier = multiplier
+        self.jitter = jitter
+        self.deadline = deadline
+        self.budget = budget
+
+    def new_budget(self):
+        if self.budget is None:
+            return None
+        return RetryBudget(self.budget)
+
+    def backoff(self, attempt):
+        """The delay before the given retry, counting from zero."""
+        delay = min(self.max_delay,
+                    self.base_delay * (self.multiplier ** attempt))
+        if self.jitter:
+            delay -= delay * self.jitter * random.random()
+        return delay
+
+    def retry_delay(self, result, attempt, elapsed, budget=None):
+        """Return the delay before retrying the call, or None to give up.
+
+        result is the raw response to the call's attempt'th retry (the first
+        try being attempt zero), and elapsed the seconds since it was first
+        sent. A successful response earns the budget a fraction of a token.
+
+        """
+        if 'Error' not in result:
+            if budget is not None:
+                budget.earn()
+            return None
+        if attempt >= self.max_attempts:
+            return None
+        if not any(rule.matches(result, attempt) for rule in self.rules):
+            return None
+        delay = self.backoff(attempt)
+        if self.deadline is not None and elapsed + delay > self.deadline:
+            return None
+        if budget is not None and not budget.spend():
+            logger.info("retry budget exhausted, not retrying")
+            return None
+        return delay
+
+
+class Timer(object):
+    """A call scheduled by a Scheduler, which can be cancelled."""
+    __slots__ = ('fn', 'args', '_scheduler')
+
+    def __init__(self, scheduler, fn, args):
+        self._scheduler = scheduler
+        self.fn = fn
+        self.args = args
+
+    def cancel(self):
+        """Cancel the call, if it hasn't been made.
+
+        The function and its arguments are let go of at once, rather than
+        when the call would have been made.
+
+        """
+        self._scheduler._cancel(self)
+
+
+class Scheduler(object):
+    """Runs functions after a delay on a single background thread.
+
+    Retries on pipelined connections are parked here rather than sleeping in
+    the thread that noticed the failure, so the reader thread, and any other
+    calls, carry on in the meantime. The thread is shared by every
+    connection, so functions run on it must never block; spawn_later runs
+    those that might, such as sending a request, on threads of their own.
+
+    """
+
+    def __init__(self):
+        self._queue = []
+        self._counter = 0
+        self._cancelled_count = 0
+        self._cond = threading.Condition()
+        self._thread = None
+
+    def call_later(self, delay, fn, *args):
+        """Call fn(*args) after delay seconds, returning a Timer."""
+        timer = Timer(self, fn, args)
+        with self._cond:
+            self._counter += 1
+            heapq.heappush(
+                self._queue, (time.time() + delay, self._counter, timer))
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name="juju-retry-scheduler")
+                self._thread.daemon = True
+                self._thread.start()
+            self._cond.notify()
+        return timer
+
+    def spawn_later(self, delay, fn, *args):
+        """Call fn(*args) after delay seconds, on a new daemon thread."""
+        return self.call_later(delay, _spawn, fn, args)
+
+    def _cancel(self, timer):
+        with self._cond:
+            if timer.fn is None:
+                return
+            timer.fn, timer.args = None, ()
+            self._cancelled_count += 1
+            # Cancelled timers are dropped when due, or all at once when
+            # they are most of the queue, such as when many calls with long
+            # timeouts complete.
+            if self._cancelled_count * 2 > len(self._queue):
+                self._queue = [
+                    entry for entry in self._queue
+                    if entry[2].fn is not None]
+                heapq.heapify(self._queue)
+                self._cancelled_count = 0
+
+    def __len__(self):
+        with self._cond:
+            return len(self._queue)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while True:
+                    if self._queue:
+                        wait = self._queue[0][0] - time.time()
+                        if wait <= 0:
+                            timer = heapq.heappop(self._queue)[2]
+                            fn, args = timer.fn, timer.args
+                            if fn is None:
+                                self._cancelled_count = max(
+                                    0, self._cancelled_count - 1)
+                                continue
+                            timer.fn, timer.args = None, ()
+                            break
+                        self._cond.wait(wait)
+                    else:
+                        self._cond.wait()
+            try:
+                fn(*args)
+            except Exception:
+                logger.exception("exception in scheduled call")
+
+
+def _spawn(fn, args):
+    def run():
+        try:
+            fn(*args)
+        except Exception:
+            logger.exception("exception in scheduled call")
+    thread = threading.Thread(target=run, name="juju-retry")
+    thread.daemon = True
+    thread.start()
+
+
+scheduler = Scheduler()
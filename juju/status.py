@@ -0,0 +1,321 @@
+"""Streaming the status of large environments.
+
+Decoding a FullStatus response for an environment with thousands of units
+builds a dict for every machine, service and unit, all at once. iter_status
+instead scans the response frame and decodes one entity at a time,
+generating a compact, slotted record for each, so the memory used beyond
+the frame itself doesn't grow with the size of the environment:
+
+    >>> for record in stream_status(connection):
+    ...     if isinstance(record, Unit) and record.agent_state == "error":
+    ...         print(record.name)
+
+Records hold only the commonly used fields, under the names used here,
+whether the server sends Juju 1 or Juju 2 style field names.
+
+"""
+import json
+import re
+from json.decoder import scanstring
+
+
+class Record(object):
+    """A slotted record of a status entity.
+
+    FIELDS maps each attribute to the names of the fields it is read from,
+    in order of preference.
+
+    """
+    __slots__ = ()
+    FIELDS = {}
+
+    def __init__(self, **kwargs):
+        for attr in self.__slots__:
+            setattr(self, attr, kwargs.pop(attr, None))
+        if kwargs:
+            raise TypeError("unexpected fields: {}".format(
+                ", ".join(sorted(kwargs))))
+
+    @classmethod
+    def from_dict(cls, data, **kwargs):
+        """Return a record of the fields in data, and the given values."""
+        record = cls.__new__(cls)
+        fields = cls.FIELDS
+        for attr in cls.__slots__:
+            value = kwargs.get(attr)
+            if value is None:
+                for name in fields.get(attr, ()):
+                    if name in data:
+                        value = data[name]
+                        break
+            setattr(record, attr, value)
+        return record
+
+    def __eq__(self, other):
+        return (type(self) is type(other) and
+                all(getattr(self, a) == getattr(other, a)
+                    for a in self.__slots__))
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return "<{} {}>".format(type(self).__name__, " ".join(
+            "{}={!r}".format(a, getattr(self, a)) for a in self.__slots__
+            if getattr(self, a) is not None))
+
+
+class Machine(Record):
+    """A machine, or a container when parent is set."""
+    __slots__ = ('id', 'parent', 'instance_id', 'dns_name', 'series',
+                 'agent_state', 'agent_state_info', 'agent_version', 'life',
+                 'hardware', 'jobs')
+    FIELDS = {
+        'id': ('Id', 'id'),
+        'instance_id': ('InstanceId', 'instance-id'),
+        'dns_name': ('DNSName', 'dns-name'),
+        'series': ('Series', 'series'),
+        'agent_state': ('AgentState', 'agent-state'),
+        'agent_state_info': ('AgentStateInfo', 'agent-state-info'),
+        'agent_version': ('AgentVersion', 'agent-version'),
+        'life': ('Life', 'life'),
+        'hardware': ('Hardware', 'hardware'),
+        'jobs': ('Jobs', 'jobs'),
+    }
+
+
+class Service(Record):
+    """A service (an application, in Juju 2)."""
+    __slots__ = ('name', 'charm', 'exposed', 'life', 'relations',
+                 'subordinate_to', 'status')
+    FIELDS = {
+        'charm': ('Charm', 'charm'),
+        'exposed': ('Exposed', 'exposed'),
+        'life': ('Life', 'life'),
+        'relations': ('Relations', 'relations'),
+        'subordinate_to': ('SubordinateTo', 'subordinate-to'),
+        'status': ('Status', 'status', 'application-status'),
+    }
+
+
+class Unit(Record):
+    """A unit, or a subordinate unit when principal is set."""
+    __slots__ = ('name', 'service', 'principal', 'machine', 'agent_state',
+                 'agent_state_info', 'agent_version', 'public_address',
+                 'ports', 'charm', 'workload_status')
+    FIELDS = {
+        'machine': ('Machine', 'machine'),
+        'agent_state': ('AgentState', 'agent-state'),
+        'agent_state_info': ('AgentStateInfo', 'agent-state-info'),
+        'agent_version': ('AgentVersion', 'agent-version'),
+        'public_address': ('PublicAddress', 'public-address'),
+        'ports': ('OpenedPorts', 'opened-ports'),
+        'charm': ('Charm', 'charm'),
+        'workload_status': ('Workload', 'workload-status'),
+    }
+
+
+class Relation(Record):
+    __slots__ = ('id', 'key', 'interface', 'scope', 'endpoints')
+    FIELDS = {
+        'id': ('Id', 'id'),
+        'key': ('Key', 'key'),
+        'interface': ('Interface', 'interface'),
+        'scope': ('Scope', 'scope'),
+        'endpoints': ('Endpoints', 'endpoints'),
+    }
+
+
+class Status(object):
+    """The records of a status, by id or name.
+
+    A more compact alternative to the decoded FullStatus response, built
+    from the records generated by iter_status.
+
+    """
+    __slots__ = ('machines', 'services', 'units', 'relations')
+
+    def __init__(self, records=()):
+        self.machines = {}
+        self.services = {}
+        self.units = {}
+        self.relations = []
+        for record in records:
+            self.add(record)
+
+    def add(self, record):
+        if isinstance(record, Machine):
+            self.machines[record.id] = record
+        elif isinstance(record, Service):
+            self.services[record.name] = record
+        elif isinstance(record, Unit):
+            self.units[record.name] = record
+        elif isinstance(record, Relation):
+            self.relations.append(record)
+
+    def units_of(self, service):
+        return [u for u in self.units.values() if u.service == service]
+
+    def units_on(self, machine_id):
+        return [u for u in self.units.values() if u.machine == machine_id]
+
+
+_WHITESPACE = re.compile(r'[ \t\n\r]*')
+_decoder = json.JSONDecoder()
+
+
+class _Scanner(object):
+    """Walks through JSON text, decoding only the values asked for."""
+
+    def __init__(self, text):
+        self.text = text
+        self.pos = 0
+
+    def peek(self):
+        char = self.text[self.pos:self.pos + 1]
+        if char and char in ' \t\n\r':
+            self.pos = _WHITESPACE.match(self.text, self.pos).end()
+            char = self.text[self.pos:self.pos + 1]
+        return char
+
+    def expect(self, char):
+        if self.peek() != char:
+            raise ValueError("expected {!r} at position {}".format(
+                char, self.pos))
+        self.pos += 1
+
+    def value(self):
+        """Decode and return the value at the current position."""
+        self.peek()
+        value, self.pos = _decoder.raw_decode(self.text, self.pos)
+        return value
+
+    def keys(self):
+        """Generate the keys of the object at the current position.
+
+        After each key is generated the position is at its value, which the
+        caller must consume (with value, keys or elements) before asking for
+        the next key. A null is taken as an empty object.
+
+        """
+        if self.peek() == 'n':
+            self.value()
+            return
+        self.expect('{')
+        if self.peek() == '}':
+            self.pos += 1
+            return
+        while True:
+            self.expect('"')
+            key, self.pos = scanstring(self.text, self.pos)
+            self.expect(':')
+            yield key
+            end = self.peek()
+            self.pos += 1
+            if end == '}':
+                return
+            if end != ',':
+                raise ValueError("expected ',' or '}}' at position {}".format(
+                    self.pos - 1))
+
+    def elements(self):
+        """Generate once for each element of the array at the position.
+
+        As with keys, the caller consumes each element. A null is taken as
+        an empty array.
+
+        """
+        if self.peek() == 'n':
+            self.value()
+            return
+        self.expect('[')
+        if self.peek() == ']':
+            self.pos += 1
+            return
+        while True:
+            yield
+            end = self.peek()
+            self.pos += 1
+            if end == ']':
+                return
+            if end != ',':
+                raise ValueError("expected ',' or ']' at position {}".format(
+                    self.pos - 1))
+
+
+def _machines(data, parent=None):
+    containers = data.pop('Containers', None) or data.pop('containers', None)
+    machine = Machine.from_dict(data, parent=parent)
+    yield machine
+    for container in (containers or {}).values():
+        for record in _machines(container, machine.id):
+            yield record
+
+
+def _units(name, data, service):
+    subordinates = (data.pop('Subordinates', None) or
+                    data.pop('subordinates', None))
+    yield Unit.from_dict(data, name=name, service=service)
+    for sub_name, sub in (subordinates or {}).items():
+        yield Unit.from_dict(
+            sub, name=sub_name, service=sub_name.split('/')[0],
+            principal=name)
+
+
+def _service(scanner, name):
+    data = {}
+    for key in scanner.keys():
+        if key in ('Units', 'units'):
+            for unit in scanner.keys():
+                for record in _units(unit, scanner.value(), name):
+                    yield record
+        else:
+            data[key] = scanner.value()
+    yield Service.from_dict(data, name=name)
+
+
+def iter_status(raw):
+    """Generate a record for each entity in a FullStatus response frame.
+
+    raw is the whole response frame, as sent by the server (see
+    LazyResponse.raw). Machines are followed by their containers, and units
+    by their subordinates. A service's units come before the service itself,
+    as the service record is only complete once all its fields are read.
+
+    """
+    if isinstance(raw, bytes):
+        raw = raw.decode('utf-8')
+    scanner = _Scanner(raw)
+    for key in scanner.keys():
+        if key != 'Response':
+            scanner.value()
+            continue
+        for section in scanner.keys():
+            if section in ('Machines', 'machines'):
+                for _ in scanner.keys():
+                    for record in _machines(scanner.value()):
+                        yield record
+            elif section in ('Services', 'applications'):
+                for name in scanner.keys():
+                    for record in _service(scanner, name):
+                        yield record
+            elif section in ('Relations', 'relations'):
+                for _ in scanner.elements():
+                    yield Relation.from_dict(scanner.value())
+            else:
+                scanner.value()
+
+
+def stream_status(connection, patterns=None):
+    """Call Client.FullStatus, generating a record for each entity.
+
+    patterns limits the status to matching machines, services and units, as
+    with juju status. The response is received whole, but only decoded an
+    entity at a time.
+
+    """
+    params = {}
+    if patterns is not None:
+        params['Patterns'] = list(patterns)
+    response = connection.rpc("Client", "FullStatus", params, lazy=True)
+    return iter_status(response.raw)
@@ -1,25 +1,159 @@
+"""The environments hosted by a Juju System.
+
+A System is the state servers, and the environments they host. Its API is
+reached over a root connection, made without an environment UUID, which is
+opened when first needed and reused for every call:
+
+    >>> system = System.from_environment("local")
+    >>> for env in system.fetch_summaries():
+    ...     print(env.item.name, env.error or env.item.summary["Life"])
+
+Environments are listed with one call, and the summaries of any number of
+them fetched with a bulk call, split into chunks that are all in flight at
+once on the pipelined connection.
+
+"""
+import threading
+
+from .apiclient import BatchResult, Facade, connection_from_info
+from .configstore import ConfigStore
+from .environment import Environment
+from .exceptions import EnvironmentNotFound
+
 
 class System(object):
+    """A Juju System, reached through a root API connection.
+
+    info: the connection info of any environment of the system, from the
+    config store, whose state servers and credentials are used for the root
+    connection.
+
+    connection: an already open root connection to use instead.
+
+    chunk_size: the most environments fetched in each call, so that the
+    summaries of many environments are fetched by concurrent calls.
+
+    Any other keyword arguments are passed to the Connection constructor;
+    the connection is pipelined unless pipelined=False is given.
+
+    """
+
+    def __init__(self, info=None, connection=None, chunk_size=25,
+                 **connection_args):
+        self.info = info
+        self.current_user = info['user'] if info is not None else None
+        self.credentials = info['password'] if info is not None else None
+        self.current_environment = None
+        self.chunk_size = chunk_size
+        connection_args.setdefault('pipelined', True)
+        self._connection_args = connection_args
+        self._connection = connection
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_environment(cls, env_name, store=None, **kwargs):
+        """Return the System hosting an environment in the config store."""
+        if store is None:
+            store = ConfigStore()
+        system = cls(store.connection_info(env_name), **kwargs)
+        system.current_environment = env_name
+        return system
+
+    def connect(self, credentials=None):
+        """Return the root connection, opening it if need be.
+
+        credentials replaces the password from the connection info.
+
+        """
+        if credentials is not None:
+            self.close()
+            self.credentials = credentials
+        with self._lock:
+            if self._connection is None or self._connection.closed:
+                if self.info is None:
+                    raise ValueError("no connection info for the system")
+                info = dict(self.info)
+                info['environ-uuid'] = ""
+                info['password'] = self.credentials
+                self._connection = connection_from_info(
+                    info, **self._connection_args)
+            return self._connection
+
+    def close(self):
+        with self._lock:
+            connection, self._connection = self._connection, None
+        if connection is not None:
+            connection.close()
+
+    def list_environments(self, user=None):
+        """Return the environments the user can use.
+
+        user defaults to the user connected as.
+
+        """
+        user = self._get_user(user)
+        response = self.connect().rpc(
+            "EnvironmentManager", "ListEnvironments",
+            {"Tag": "user-{}".format(user)})
+        return self._environments(response)
+
+    def all_environments(self):
+        """Return all the environments in the system.
+
+        Only administrators of the system may list them all.
+
+        """
+        response = self.connect().rpc("SystemManager", "AllEnvironments")
+        return self._environments(response)
 
+    def get_environment(self, name, user=None):
+        """Return the user's environment with the given name or UUID."""
+        for env in self.list_environments(user):
+            if name in (env.name, env.uuid):
+                return env
+        raise EnvironmentNotFound(name)
 
-	def __init__(self):
-		self.current_user = None
-		self.credentials = None
-		self.current_environment = None
+    def fetch_summaries(self, environments=None):
+        """Fetch the summaries of environments, all at once.
 
-	def connect(self, credentials):
-		self.validate_credentials(credentials)
+        environments defaults to those returned by list_environments.
+        Summaries already fetched aren't fetched again. Returns a
+        BatchResult for each environment, holding its summary or the error
+        fetching it.
 
-	def get_environment(self, user=None):
-		pass
+        """
+        if environments is None:
+            environments = self.list_environments()
+        missing = [env for env in environments if env._summary is None]
+        errors = {}
+        if missing:
+            facade = Facade(self.connect(), "SystemManager")
+            results = facade.bulk(
+                "EnvironmentStatus",
+                [{"Tag": "environment-{}".format(env.uuid)}
+                 for env in missing],
+                chunk_size=self.chunk_size)
+            for env, result in zip(missing, results):
+                if result.error is not None:
+                    errors[env.uuid] = result.error
+                else:
+                    env._summary = result.result
+        return [BatchResult(env, env._summary, errors.get(env.uuid))
+                for env in environments]
 
-	def list_enviroments(self, user=None):
-		# Connect to the server as a user (defaults to currently logged 
-		# in user) and returns a list of environment objects. 
+    def _environments(self, response):
+        environments = []
+        for env in response.get('UserEnvironments') or []:
+            owner = env.get('OwnerTag')
+            if owner and owner.startswith('user-'):
+                owner = owner[len('user-'):]
+            environments.append(Environment(
+                env['Name'], uuid=env['UUID'], owner=owner, system=self))
+        return environments
 
-		return (environments)	
-	
-	def _get_user(self, user=None):
-		if user == None: 
-			user = self.current_user
-			return None
+    def _get_user(self, user=None):
+        if user is None:
+            user = self.current_user
+        if user is None:
+            raise ValueError("no user given, or connected as")
+        return user
@@ -0,0 +1,95 @@
+"""TLS for API connections.
+
+SSL contexts are built once per CA certificate, straight from the PEM text
+rather than a temporary file, and shared by every connection trusting that
+certificate. The TLS session of each connection is kept so that reconnecting
+to the same server can resume it, skipping the full handshake.
+
+"""
+import hashlib
+import socket
+import ssl
+import threading
+
+
+_lock = threading.Lock()
+_contexts = {}
+_sessions = {}
+
+# Not all Pythons can resume sessions (it needs 3.6 or later).
+_can_resume = hasattr(ssl.SSLSocket, 'session')
+
+
+def fingerprint(cacert):
+    """Return the SHA-256 fingerprint of the PEM text of a certificate."""
+    if not isinstance(cacert, bytes):
+        cacert = cacert.encode('ascii')
+    return hashlib.sha256(cacert.strip()).hexdigest()
+
+
+def ssl_context(cacert):
+    """Return the shared SSL context trusting the CA certificate.
+
+    The highest TLS version both ends support is used. Juju's certificates
+    don't name the servers' addresses, so hostnames aren't checked, but the
+    server's certificate must be signed by the CA.
+
+    """
+    key = fingerprint(cacert)
+    with _lock:
+        context = _contexts.get(key)
+        if context is not None:
+            return context
+    if isinstance(cacert, bytes):
+        cacert = cacert.decode('ascii')
+    protocol = getattr(ssl, 'PROTOCOL_TLS_CLIENT', ssl.PROTOCOL_SSLv23)
+    context = ssl.SSLContext(protocol)
+    context.options |= ssl.OP_NO_SSLv2 | ssl.OP_NO_SSLv3
+    context.check_hostname = False
+    context.verify_mode = ssl.CERT_REQUIRED
+    context.load_verify_locations(cadata=cacert)
+    with _lock:
+        return _contexts.setdefault(key, context)
+
+
+def connect(host, port, cacert, timeout=None):
+    """Return a TLS socket connected to the host and port.
+
+    If there was an earlier connection to the same server, with the same CA
+    certificate, its session is offered for resumption.
+
+    """
+    context = ssl_context(cacert)
+    key = (fingerprint(cacert), host, port)
+    sock = socket.create_connection((host, port), timeout)
+    kwargs = {}
+    if _can_resume:
+        with _lock:
+            kwargs['session'] = _sessions.get(key)
+    try:
+        return context.wrap_socket(sock, server_hostname=host, **kwargs)
+    except Exception:
+        sock.close()
+        raise
+
+
+def remember_session(sock, cacert):
+    """Keep the socket's TLS session, to resume on the next connection.
+
+    With TLS 1.3 the session is only available once the server has sent
+    some data, so call this after the websocket handshake.
+
+    """
+    if not _can_resume or sock.session is None:
+        return
+    host, port = sock.getpeername()[:2]
+    key = (fingerprint(cacert), sock.server_hostname or host, port)
+    with _lock:
+        _sessions[key] = sock.session
+
+
+def clear_cache():
+    """Forget all SSL contexts and sessions."""
+    with _lock:
+        _contexts.clear()
+        _sessions.clear()
@@ -0,0 +1,593 @@
+"""The transports API connections send their frames over.
+
+A transport opens the websocket for a connection: its connect method takes
+the endpoint URL and CA certificate and returns an object with send(text),
+recv(), settimeout(seconds), close() and shutdown() methods, as
+websocket-client's WebSocket has. recv raises WebSocketTimeoutException
+when the timeout passes. WebsocketTransport, the default, connects to the
+API server, optionally compressing messages with permessage-deflate:
+
+    >>> conn = open_environment("remote", transport=WebsocketTransport(
+    ...     compression=True))
+
+RecordingTransport wraps another transport, saving every frame sent and
+received, and when, to a file. ReplayTransport serves the responses in such
+a file back, without a network or API server, so the traffic of a real
+session can be replayed against new client code:
+
+    >>> with RecordingTransport("session.jsonl.gz") as recorder:
+    ...     conn = open_environment("prod", transport=recorder)
+    ...     conn.rpc("Client", "FullStatus")
+    >>> conn = open_environment("prod", transport=ReplayTransport(
+    ...     "session.jsonl.gz", speed=10))
+
+The file holds a line of JSON for each event: the index of the connection,
+the seconds since recording started, the kind of event (connect, send, recv
+or close) and the frame or endpoint. It is gzipped if its name ends in .gz.
+The params of logins, which hold the password, are left out, and the file
+is only readable by its owner.
+
+"""
+import collections
+import gzip
+import heapq
+import json
+import logging
+import os
+import socket
+import struct
+import threading
+import time
+import zlib
+
+
+logger = logging.getLogger("juju")
+
+FORMAT_VERSION = 1
+
+_websocket = None
+
+
+def import_websocket():
+    """Import websocket (and with it ssl) on first use, to start faster."""
+    global _websocket
+    if _websocket is None:
+        import websocket
+        # There are two pypi modules with the name websocket
+        # (python-websocket and websocket) We utilize python-websocket,
+        # sniff and error if we find the wrong one.
+        try:
+            websocket.create_connection
+        except AttributeError:
+            raise RuntimeError(
+                "Expected 'python-websocket' package or 'websocket-client' "
+                "from pypi, found incompatible gevent 'websocket'")
+        websocket.logger = logging.getLogger("websocket")
+        _websocket = websocket
+    return _websocket
+
+
+class Transport(object):
+    """The interface of transports."""
+
+    def connect(self, endpoint, cacert):
+        """Return a websocket connected to the endpoint."""
+        raise NotImplementedError(self.connect)
+
+
+class WebsocketTransport(Transport):
+    """Connects to the API server over TLS, resuming sessions if it can.
+
+    With compression, permessage-deflate (RFC 7692) is offered to the
+    server. If it's accepted the server may compress its responses, and
+    requests of at least threshold bytes are compressed too, at the given
+    zlib level. max_size, if given, is the most bytes a message may
+    decompress to, as protection from decompression bombs; bigger messages
+    break the connection. Servers that don't accept it are talked to
+    without compression.
+
+    connect_timeout is the most seconds connecting, including the TLS and
+    websocket handshakes, may take, or None to wait as long as the system
+    does.
+
+    """
+
+    def __init__(self, compression=False, threshold=1024, level=6,
+                 max_size=None, connect_timeout=30):
+        self.compression = compression
+        self.connect_timeout = connect_timeout
+        self.threshold = threshold
+        self.level = level
+        self.max_size = max_size
+
+    def connect(self, endpoint, cacert):
+        try:
+            from urllib.parse import urlparse
+        except ImportError:
+            from urlparse import urlparse
+        from . import tls
+        websocket = import_websocket()
+        url = urlparse(endpoint)
+        port = url.port or 443
+        sock = tls.connect(url.hostname, port, cacert, self.connect_timeout)
+        try:
+            # Text frames are decoded as UTF-8 anyway, so skip
+            # websocket-client's much slower pure Python validation.
+            connection = websocket.create_connection(
+                endpoint, origin=endpoint, socket=sock,
+                skip_utf8_validation=True, header=self._headers())
+        except Exception:
+            sock.close()
+            raise
+        # Connections set their own timeouts on each call.
+        connection.settimeout(None)
+        tls.remember_session(sock, cacert)
+        if self.compression:
+            params = accepted_deflate(connection.getheaders())
+            if params is None:
+                logger.debug("%s declined compression", endpoint)
+            else:
+                # websocket-client rejects compressed frames, so take over
+                # the socket once it has done the handshake.
+                return DeflateWebsocket(
+                    connection.sock, params, self.threshold, self.level,
+                    self.max_size)
+        return connection
+
+    def _headers(self):
+        if not self.compression:
+            return None
+        return ["Sec-WebSocket-Extensions: " + DEFLATE_OFFER]
+
+
+DEFLATE_OFFER = "permessage-deflate; client_max_window_bits"
+_DEFLATE_TAIL = b"\x00\x00\xff\xff"
+
+
+def accepted_deflate(headers):
+    """Return the permessage-deflate parameters the server accepted, if it
+    did, from the handshake response's headers."""
+    for header, value in (headers or {}).items():
+        if header.lower() != "sec-websocket-extensions":
+            continue
+        for extension in value.split(","):
+            parts = [p.strip() for p in extension.split(";")]
+            if parts[0] != "permessage-deflate":
+                continue
+            params = {}
+            for part in parts[1:]:
+                name, _, arg = part.partition("=")
+                params[name.strip()] = arg.strip().strip('"') or None
+            return params
+    return None
+
+
+class DeflateWebsocket(object):
+    """A client websocket using permessage-deflate, over a connected socket.
+
+    Only what the API needs is implemented: text messages, answering pings
+    and closing. last_send_size and last_recv_size are the bytes the last
+    message sent and received took on the wire, once compressed.
+
+    """
+
+    def __init__(self, sock, params, threshold=1024, level=6,
+                 max_size=None):
+        self.sock = sock
+        self.threshold = threshold
+        self.level = level
+        self.max_size = max_size
+        self._send_bits = int(params.get("client_max_window_bits") or 15)
+        self._recv_bits = int(params.get("server_max_window_bits") or 15)
+        self._send_takeover = "client_no_context_takeover" not in params
+        self._recv_takeover = "server_no_context_takeover" not in params
+        self._compressor = None
+        self._decompressor = None
+        self._buffer = bytearray()
+        self._fragments = []
+        self._compressed = False
+        self._send_lock = threading.Lock()
+        self.last_send_size = 0
+        self.last_recv_size = 0
+
+    def settimeout(self, timeout):
+        self.sock.settimeout(timeout)
+
+    def send(self, data):
+        if not isinstance(data, bytes):
+            data = data.encode("utf-8")
+        rsv1 = 0
+        if len(data) >= self.threshold:
+            data = self._compress(data)
+            rsv1 = 1
+        self._send_frame(data, 0x1, rsv1)
+        self.last_send_size = len(data)
+
+    def _compress(self, data):
+        if self._compressor is None or not self._send_takeover:
+            self._compressor = zlib.compressobj(
+                self.level, zlib.DEFLATED, -self._send_bits)
+        data = (self._compressor.compress(data) +
+                self._compressor.flush(zlib.Z_SYNC_FLUSH))
+        if data.endswith(_DEFLATE_TAIL):
+            data = data[:-len(_DEFLATE_TAIL)]
+        return data
+
+    def _send_frame(self, payload, opcode, rsv1=0):
+        websocket = import_websocket()
+        frame = websocket.ABNF(1, rsv1, 0, 0, opcode, 1, payload).format()
+        with self._send_lock:
+            self.sock.sendall(frame)
+
+    def recv(self):
+        while True:
+            fin, rsv1, opcode, payload = self._recv_frame()
+            if opcode == 0x9:
+                self._send_frame(payload, 0xa)
+                continue
+            if opcode == 0xa:
+                continue
+            if opcode == 0x8:
+                self._closed()
+            if opcode != 0x0:
+                self._fragments = []
+                self._compressed = bool(rsv1)
+            self._fragments.append(payload)
+            if not fin:
+                continue
+            payload, self._fragments = b"".join(self._fragments), []
+            self.last_recv_size = len(payload)
+            if self._compressed:
+                payload = self._decompress(payload)
+            return payload.decode("utf-8")
+
+    def _decompress(self, data):
+        if self._decompressor is None or not self._recv_takeover:
+            self._decompressor = zlib.decompressobj(-self._recv_bits)
+        if self.max_size is None:
+            return self._decompressor.decompress(data + _DEFLATE_TAIL)
+        data = self._decompressor.decompress(
+            data + _DEFLATE_TAIL, self.max_size + 1)
+        if len(data) > self.max_size:
+            self.shutdown()
+            raise import_websocket().WebSocketPayloadException(
+                "message is larger than {} bytes".format(self.max_size))
+        return data
+
+    def _recv_frame(self):
+        # Bytes are only taken from the buffer once the whole frame is in,
+        # so that a timeout part way through loses nothing.
+        self._fill(2)
+        first, second = struct.unpack_from("!BB", self._buffer)
+        length = second & 0x7f
+        start = 2
+        if length == 126:
+            self._fill(4)
+            length = struct.unpack_from("!H", self._buffer, 2)[0]
+            start = 4
+        elif length == 127:
+            self._fill(10)
+            length = struct.unpack_from("!Q", self._buffer, 2)[0]
+            start = 10
+        if second & 0x80:
+            raise import_websocket().WebSocketProtocolException(
+                "masked frame from the server")
+        self._fill(start + length)
+        payload = bytes(self._buffer[start:start + length])
+        del self._buffer[:start + length]
+        return first & 0x80, first & 0x40, first & 0x0f, payload
+
+    def _fill(self, size):
+        websocket = import_websocket()
+        while len(self._buffer) < size:
+            try:
+                data = self.sock.recv(max(65536, size - len(self._buffer)))
+            except socket.timeout:
+                raise websocket.WebSocketTimeoutException("timed out")
+            if not data:
+                self._closed()
+            self._buffer += data
+
+    def _closed(self):
+        raise import_websocket().WebSocketConnectionClosedException(
+            "connection closed by the server")
+
+    def close(self):
+        try:
+            self._send_frame(struct.pack("!H", 1000), 0x8)
+        except (socket.error, ValueError):
+            pass
+        self.sock.close()
+
+    def shutdown(self):
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except (socket.error, ValueError):
+            pass
+        self.sock.close()
+
+
+def _open(path, mode):
+    if not path.endswith('.gz'):
+        return open(path, mode)
+    if str is bytes:
+        # Python 2's gzip has no text mode, but its strs are bytes anyway.
+        return gzip.open(path, mode + 'b')
+    return gzip.open(path, mode + 't')
+
+
+def _create(path):
+    """Open path to write a recording to, readable only by its owner."""
+    os.close(os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600))
+    # The mode only applies to new files.
+    os.chmod(path, 0o600)
+    return _open(path, 'w')
+
+
+def _text(data):
+    if isinstance(data, bytes):
+        return data.decode('utf-8')
+    return data
+
+
+def _redact(frame):
+    """Return a sent frame, with the params of a login replaced.
+
+    Replaying matches the login by its method alone.
+
+    """
+    try:
+        request = json.loads(frame)
+    except ValueError:
+        return frame
+    if (not isinstance(request, dict) or request.get('Type') != 'Admin' or
+            request.get('Request') != 'Login'):
+        return frame
+    params = request.get('Params')
+    if isinstance(params, dict):
+        request['Params'] = dict((key, 'REDACTED') for key in params)
+    return json.dumps(request)
+
+
+class RecordingTransport(Transport):
+    """Records the frames of the connections made through another transport.
+
+    transport defaults to a WebsocketTransport. Close the recorder (or use
+    it as a context manager) once done, to finish writing the file.
+
+    """
+
+    def __init__(self, path, transport=None):
+        if transport is None:
+            transport = WebsocketTransport()
+        self.transport = transport
+        self.path = path
+        self._lock = threading.Lock()
+        self._file = _create(path)
+        self._start = time.time()
+        self._connections = 0
+        self._write(None, 'header', {'version': FORMAT_VERSION})
+
+    def _write(self, index, kind, data):
+        line = json.dumps(
+            [index, round(time.time() - self._start, 6), kind, data],
+            separators=(',', ':'))
+        with self._lock:
+            if self._file is not None:
+                self._file.write(line + '\n')
+
+    def connect(self, endpoint, cacert):
+        connection = self.transport.connect(endpoint, cacert)
+        with self._lock:
+            index = self._connections
+            self._connections += 1
+        self._write(index, 'connect', endpoint)
+        return _RecordingSocket(self, index, connection)
+
+    def close(self):
+        with self._lock:
+            f, self._file = self._file, None
+        if f is not None:
+            f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class _RecordingSocket(object):
+
+    def __init__(self, recorder, index, connection):
+        self._recorder = recorder
+        self._index = index
+        self._connection = connection
+
+    def send(self, data):
+        self._recorder._write(self._index, 'send', _redact(_text(data)))
+        return self._connection.send(data)
+
+    def recv(self):
+        data = self._connection.recv()
+        self._recorder._write(self._index, 'recv', _text(data))
+        return data
+
+    def settimeout(self, timeout):
+        self._connection.settimeout(timeout)
+
+    def close(self):
+        self._recorder._write(self._index, 'close', None)
+        self._connection.close()
+
+    def shutdown(self):
+        self._recorder._write(self._index, 'close', None)
+        self._connection.shutdown()
+
+
+def _request_key(request, exact=True):
+    key = (request.get('Type'), request.get('Request'), request.get('Id'))
+    if exact:
+        key += (json.dumps(request.get('Params'), sort_keys=True),)
+    return key
+
+
+class _Recording(object):
+    """The requests of a recorded connection, and their responses."""
+
+    def __init__(self, endpoint):
+        self.endpoint = endpoint
+        # Responses by exact request, then by just the method, each a queue
+        # of [response, latency, used] entries shared between the two.
+        self.exact = collections.defaultdict(collections.deque)
+        self.loose = collections.defaultdict(collections.deque)
+
+    def add(self, request, response, latency):
+        entry = [response, latency, False]
+        self.exact[_request_key(request)].append(entry)
+        self.loose[_request_key(request, False)].append(entry)
+
+    def take(self, request):
+        """Return the response and latency for a request, or None.
+
+        Requests are matched to a recorded one of the same method with the
+        same params if there is one, or else of just the same method, each
+        response being used once, in the order they were recorded.
+
+        """
+        for responses, key in ((self.exact, _request_key(request)),
+                               (self.loose, _request_key(request, False))):
+            queue = responses.get(key)
+            while queue:
+                entry = queue.popleft()
+                if not entry[2]:
+                    entry[2] = True
+                    return entry[0], entry[1]
+        return None
+
+
+def load_recording(path):
+    """Return the recorded connections in a file, in the order made."""
+    recordings = {}
+    order = []
+    sent = {}
+    with _open(path, 'r') as f:
+        for line in f:
+            index, seconds, kind, data = json.loads(line)
+            if kind == 'header':
+                if data.get('version') != FORMAT_VERSION:
+                    raise ValueError("unsupported recording version {}".format(
+                        data.get('version')))
+            elif kind == 'connect':
+                recordings[index] = _Recording(data)
+                order.append(index)
+            elif kind == 'send':
+                request = json.loads(data)
+                sent[(index, request.get('RequestId'))] = (request, seconds)
+            elif kind == 'recv':
+                response = json.loads(data)
+                request, sent_at = sent.pop(
+                    (index, response.get('RequestId')), (None, None))
+                if request is None:
+                    continue
+                recordings[index].add(request, response, seconds - sent_at)
+    return [recordings[index] for index in order]
+
+
+class ReplayTransport(Transport):
+    """Serves recorded responses, without connecting to anything.
+
+    Each connection made is given the next connection in the recording, and
+    each request sent on it is answered with the response to a matching
+    recorded request (see _Recording.take), or with a "not found" error if
+    there's none. Responses are delayed by the time the recorded ones took,
+    divided by speed; a speed of None sends them as soon as they can be.
+
+    """
+
+    def __init__(self, path, speed=1.0):
+        self.path = path
+        self.speed = speed
+        self._lock = threading.Lock()
+        self._recordings = collections.deque(load_recording(path))
+
+    def connect(self, endpoint, cacert):
+        with self._lock:
+            if not self._recordings:
+                raise IOError("no more recorded connections in {}".format(
+                    self.path))
+            recording = self._recordings.popleft()
+        if recording.endpoint != endpoint:
+            logger.debug(
+                "replaying connection to %s for %s", recording.endpoint,
+                endpoint)
+        return _ReplaySocket(recording, self.speed)
+
+
+class _ReplaySocket(object):
+
+    def __init__(self, recording, speed):
+        self._recording = recording
+        self._speed = speed
+        self._timeout = None
+        self._closed = False
+        self._responses = []
+        self._sequence = 0
+        self._cond = threading.Condition()
+
+    def send(self, data):
+        if self._closed:
+            raise IOError("socket is closed")
+        request = json.loads(_text(data))
+        found = self._recording.take(request)
+        if found is None:
+            response, latency = {
+                'Error': 'no recorded response for {}.{}'.format(
+                    request.get('Type'), request.get('Request')),
+                'ErrorCode': 'not found'}, 0
+        else:
+            response, latency = found
+            response = dict(response)
+        response['RequestId'] = request.get('RequestId')
+        due = time.time()
+        if self._speed:
+            due += latency / self._speed
+        with self._cond:
+            self._sequence += 1
+            heapq.heappush(
+                self._responses,
+                (due, self._sequence, json.dumps(response)))
+            self._cond.notify_all()
+
+    def recv(self):
+        deadline = None
+        if self._timeout is not None:
+            deadline = time.time() + self._timeout
+        with self._cond:
+            while True:
+                if self._closed:
+                    raise IOError("socket is closed")
+                now = time.time()
+                wait = None
+                if self._responses:
+                    due = self._responses[0][0]
+                    if due <= now:
+                        return heapq.heappop(self._responses)[2]
+                    wait = due - now
+                if deadline is not None:
+                    if deadline <= now:
+                        raise import_websocket().WebSocketTimeoutException(
+                            "timed out")
+                    wait = deadline - now if wait is None else min(
+                        wait, deadline - now)
+                self._cond.wait(wait)
+
+    def settimeout(self, timeout):
+        self._timeout = timeout
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+    shutdown = close
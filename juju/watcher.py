@@ -0,0 +1,358 @@
+"""Streaming changes to an environment with the AllWatcher.
+
+An AllWatcher asks the API server for every change to the environment's
+machines, services, units, relations and so on, as a stream of deltas, and
+keeps a ModelState up to date with them. Once the watcher has caught up,
+the current state of the environment can be read from the ModelState
+without making any calls:
+
+    >>> watcher = AllWatcher(connection)
+    >>> watcher.run_in_background()
+    >>> watcher.state.units_of("wordpress")
+
+The Next call used to wait for deltas blocks until something changes, so the
+watcher should have a connection to itself or a pipelined one.
+
+Rather than polling FullStatus until the environment looks right, wait_for
+waits for a condition on the ModelState, checked only as deltas arrive:
+
+    >>> watcher.wait_for(units_started("wordpress", 2), timeout=600,
+    ...                  kinds=["unit"])
+
+"""
+import logging
+import threading
+import time
+
+from .apiclient import ConnectionClosed, ServerError
+
+
+logger = logging.getLogger("juju")
+
+
+# The field holding each kind of entity's id. Older servers use capitalized
+# field names, newer ones lower case.
+ID_FIELDS = {
+    'action': ('Id', 'id'),
+    'annotation': ('Tag', 'tag'),
+    'application': ('Name', 'name'),
+    'block': ('Id', 'id'),
+    'machine': ('Id', 'id'),
+    'relation': ('Key', 'key'),
+    'service': ('Name', 'name'),
+    'unit': ('Name', 'name'),
+}
+
+
+def _field(data, *names):
+    for name in names:
+        if name in data:
+            return data[name]
+    return None
+
+
+class WaitTimeout(RuntimeError):
+    """Raised when a condition waited for doesn't hold within the timeout."""
+
+
+def entity_id(kind, data):
+    """Return the id of the entity a delta is about."""
+    return _field(data, *ID_FIELDS.get(kind, ('Id', 'id')))
+
+
+class ModelState(object):
+    """An in-memory copy of an environment, kept current by deltas.
+
+    Entities are held by kind ('machine', 'service', 'unit', 'relation' and
+    so on) and id, and units are also indexed by service and machine. The
+    entity dicts are as last sent by the server, and shouldn't be modified.
+    All methods are safe to call while another thread applies deltas.
+
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entities = {}
+        self._units_by_service = {}
+        self._units_by_machine = {}
+        self.version = 0
+
+    def apply(self, deltas):
+        """Apply a list of [kind, "change" or "remove", entity] deltas.
+
+        Returns the (kind, id) of each entity changed or removed.
+
+        """
+        changed = []
+        with self._lock:
+            for kind, change, data in deltas:
+                eid = entity_id(kind, data)
+                entities = self._entities.setdefault(kind, {})
+                old = entities.get(eid)
+                if kind == 'unit' and old is not None:
+                    self._unindex_unit(eid, old)
+                if change == 'remove':
+                    entities.pop(eid, None)
+                else:
+                    entities[eid] = data
+                    if kind == 'unit':
+                        self._index_unit(eid, data)
+                changed.append((kind, eid))
+            self.version += 1
+        return changed
+
+    def _index_unit(self, name, data):
+        service = _field(data, 'Service', 'application')
+        machine = _field(data, 'MachineId', 'machine-id')
+        if service:
+            self._units_by_service.setdefault(service, set()).add(name)
+        if machine:
+            self._units_by_machine.setdefault(machine, set()).add(name)
+
+    def _unindex_unit(self, name, data):
+        for index, key in (
+                (self._units_by_service,
+                 _field(data, 'Service', 'application')),
+                (self._units_by_machine,
+                 _field(data, 'MachineId', 'machine-id'))):
+            names = index.get(key)
+            if names is not None:
+                names.discard(name)
+                if not names:
+                    del index[key]
+
+    def get(self, kind, eid):
+        """Return the entity of the kind with the id, or None."""
+        with self._lock:
+            return self._entities.get(kind, {}).get(eid)
+
+    def entities(self, kind):
+        """Return a dict of all the entities of a kind, by id."""
+        with self._lock:
+            return dict(self._entities.get(kind, {}))
+
+    @property
+    def machines(self):
+        return self.entities('machine')
+
+    @property
+    def services(self):
+        services = self.entities('service')
+        services.update(self.entities('application'))
+        return services
+
+    @property
+    def units(self):
+        return self.entities('unit')
+
+    @property
+    def relations(self):
+        return self.entities('relation')
+
+    def units_of(self, service):
+        """Return the units of a service, by name."""
+        return self._units_in(self._units_by_service, service)
+
+    def units_on(self, machine_id):
+        """Return the units on a machine, by name."""
+        return self._units_in(self._units_by_machine, machine_id)
+
+    def _units_in(self, index, key):
+        with self._lock:
+            units = self._entities.get('unit', {})
+            return dict((name, units[name]) for name in index.get(key, ()))
+
+
+def units_started(service, count=1):
+    """Return a predicate for wait_for, true once the service has at least
+    count units whose agents report they have started."""
+    def predicate(state):
+        started = [
+            name for name, unit in state.units_of(service).items()
+            if _field(unit, 'Status', 'status') == 'started']
+        return len(started) >= count
+    return predicate
+
+
+class _Waiter(object):
+    """A caller of wait_for, and whether the state has changed for it."""
+    __slots__ = ('kinds', 'dirty')
+
+    def __init__(self, kinds):
+        self.kinds = None if kinds is None else frozenset(kinds)
+        self.dirty = True
+
+
+class AllWatcher(object):
+    """Streams the changes to an environment, applying them to a ModelState.
+
+    The deltas method is a generator of the deltas as they arrive, and
+    run_in_background applies them from a thread, optionally calling back
+    with each batch. Either way the watcher's state is kept current.
+
+    If the background thread fails, error holds the exception.
+
+    """
+
+    def __init__(self, connection, state=None):
+        self.connection = connection
+        if state is None:
+            state = ModelState()
+        self.state = state
+        self.watcher_id = None
+        self.error = None
+        self._stopping = False
+        self._thread = None
+        # Notified as each batch of deltas is applied, and when the watcher
+        # stops, for callers of wait_for.
+        self._cond = threading.Condition()
+        self._loaded = False
+        self._waiters = []
+
+    def start(self):
+        """Ask the server for a watcher, if not done already."""
+        if self.watcher_id is None:
+            response = self.connection.rpc("Client", "WatchAll")
+            self.watcher_id = response['AllWatcherId']
+
+    def next(self):
+        """Wait for the next batch of deltas, apply them and return them.
+
+        Returns an empty list once the watcher has been stopped.
+
+        """
+        return self._next()[0]
+
+    def _next(self):
+        self.start()
+        try:
+            # Next waits for something to change, so the connection's
+            # timeout doesn't apply.
+            response = self.connection.rpc(
+                "AllWatcher", "Next", object_id=self.watcher_id,
+                timeout=None)
+        except (ServerError, ConnectionClosed):
+            if self._stopping:
+                return [], []
+            raise
+        deltas = response.get('Deltas') or []
+        changed = self.state.apply(deltas)
+        self._notify(changed)
+        return deltas, changed
+
+    def _notify(self, changed):
+        kinds = set(kind for kind, _ in changed)
+        with self._cond:
+            # The first batch is the environment as it was when the watcher
+            # started; conditions are only checked once it has arrived.
+            self._loaded = True
+            for waiter in self._waiters:
+                if waiter.kinds is None or waiter.kinds & kinds:
+                    waiter.dirty = True
+            self._cond.notify_all()
+
+    def deltas(self):
+        """Generate the deltas one at a time, until stopped."""
+        while not self._stopping:
+            for delta in self.next():
+                yield delta
+
+    def run_in_background(self, callback=None):
+        """Apply deltas from a daemon thread until stopped.
+
+        If given, callback is called with each batch of deltas and the list
+        of (kind, id) they changed.
+
+        """
+        self.start()
+
+        def run():
+            while not self._stopping:
+                try:
+                    deltas, changed = self._next()
+                except Exception as e:
+                    logger.exception("all watcher failed")
+                    with self._cond:
+                        self.error = e
+                        self._cond.notify_all()
+                    return
+                if deltas and callback is not None:
+                    try:
+                        callback(deltas, changed)
+                    except Exception:
+                        logger.exception("exception in watcher callback")
+
+        self._thread = threading.Thread(target=run, name="juju-all-watcher")
+        self._thread.daemon = True
+        self._thread.start()
+        return self._thread
+
+    def stop(self, timeout=None):
+        """Stop the watcher on the server, ending any wait for deltas.
+
+        If running in the background, waits up to timeout seconds for the
+        thread to finish.
+
+        """
+        self.abandon()
+        if self.watcher_id is None:
+            return
+        try:
+            self.connection.rpc(
+                "AllWatcher", "Stop", object_id=self.watcher_id)
+        except (ServerError, ConnectionClosed) as e:
+            logger.debug("error stopping all watcher: %s", e)
+        if (self._thread is not None and
+                self._thread is not threading.current_thread()):
+            self._thread.join(timeout)
+
+    def abandon(self):
+        """Stop without telling the server, as when the connection closes."""
+        with self._cond:
+            self._stopping = True
+            self._cond.notify_all()
+
+    def wait_for(self, predicate, timeout=None, kinds=None):
+        """Wait until predicate(state) is true, and return its result.
+
+        The predicate is called with the ModelState once the watcher has
+        caught up with the environment, and after that only when a batch of
+        deltas changes an entity of one of the kinds given ("unit",
+        "machine" and so on), or of any kind if kinds is None. It is called
+        from the waiting thread, and makes no calls to the server.
+
+        The watcher is run in the background if it isn't already. Raises
+        WaitTimeout if the predicate isn't true within timeout seconds,
+        ConnectionClosed if the watcher is stopped, or the error that
+        stopped it.
+
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        waiter = _Waiter(kinds)
+        with self._cond:
+            if self._thread is None:
+                self.run_in_background()
+            self._waiters.append(waiter)
+        try:
+            while True:
+                with self._cond:
+                    while not (self._loaded and waiter.dirty):
+                        if self.error is not None:
+                            raise self.error
+                        if self._stopping:
+                            raise ConnectionClosed("all watcher stopped")
+                        remaining = None
+                        if deadline is not None:
+                            remaining = deadline - time.time()
+                            if remaining <= 0:
+                                raise WaitTimeout(
+                                    "condition not met within {} "
+                                    "seconds".format(timeout))
+                        self._cond.wait(remaining)
+                    waiter.dirty = False
+                result = predicate(self.state)
+                if result:
+                    return result
+        finally:
+            with self._cond:
+                self._waiters.remove(waiter)
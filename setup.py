@@ -27,6 +27,7 @@ setup(
     author_email='mark.ramm-christensen@canonical.com',
     url='https://github.com/juju/jujulib',
     packages=find_packages('.'),
+    package_data={'juju': ['schemas/*.json']},
     install_requires=[str(ir.req) for ir in requirements],
     license='LGPL',
     zip_safe=False,
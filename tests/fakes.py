@@ -0,0 +1,106 @@
+import json
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+import mock
+import websocket
+
+import juju.apiclient
+
+
+FACADES = [
+    {'Name': 'Admin', 'Versions': [0, 1, 2]},
+    {'Name': 'Client', 'Versions': [0]},
+    {'Name': 'Pinger', 'Versions': [0]},
+]
+
+
+class FakeWebsocket(object):
+    """An in-memory stand in for the websocket to the API server.
+
+    Requests are passed to the handler, which is called with the decoded
+    request and returns either the response params or a dict containing an
+    'Error' (and optionally 'ErrorCode'). A handler can return None to hold
+    the response back until reply is called.
+
+    """
+
+    def __init__(self, handler=None, login_versions=(2, 1, 0)):
+        self.handler = handler
+        self.login_versions = login_versions
+        self.requests = []
+        self.closed = False
+        self.timeout = None
+        self._responses = queue.Queue()
+
+    def send(self, data):
+        if self.closed:
+            raise juju.apiclient.ConnectionClosed("socket closed")
+        request = json.loads(data)
+        self.requests.append(request)
+        if request['Type'] == 'Admin' and request['Request'] == 'Login':
+            if request.get('Version') not in self.login_versions:
+                self.reply(request, {'Error': 'no such request',
+                                     'ErrorCode': 'not implemented'})
+            else:
+                self.reply(request, {'facades': FACADES})
+            return
+        response = {}
+        if self.handler is not None:
+            response = self.handler(request)
+        if response is not None:
+            self.reply(request, response)
+
+    def reply(self, request, response):
+        frame = {'RequestId': request['RequestId']}
+        if 'Error' in response:
+            frame.update(response)
+        else:
+            frame['Response'] = response
+        self._responses.put_nowait(json.dumps(frame))
+
+    def settimeout(self, timeout):
+        self.timeout = timeout
+
+    def recv(self):
+        try:
+            frame = self._responses.get(timeout=self.timeout)
+        except queue.Empty:
+            raise websocket.WebSocketTimeoutException("timed out")
+        if frame is None:
+            raise juju.apiclient.ConnectionClosed("socket closed")
+        return frame
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self._responses.put_nowait(None)
+
+    def shutdown(self):
+        self.close()
+
+
+class FakeTransport(object):
+    """A transport connecting to new FakeWebsockets, kept in websockets."""
+
+    def __init__(self, handler=None):
+        self.handler = handler
+        self.websockets = []
+
+    def connect(self, endpoint, cacert):
+        websocket = FakeWebsocket(self.handler)
+        self.websockets.append(websocket)
+        return websocket
+
+
+def make_connection(websocket=None, **kwargs):
+    """Return a Connection logged in over the given fake websocket."""
+    if websocket is None:
+        websocket = FakeWebsocket()
+    with mock.patch.object(
+            juju.apiclient.Connection, '_connect', return_value=websocket):
+        return juju.apiclient.Connection(
+            'localhost:17070', 'cert', 'user-admin', 'sekrit', **kwargs)
@@ -0,0 +1,184 @@
+import asyncio
+import base64
+import hashlib
+import struct
+import unittest
+
+import websocket
+
+from juju import aioclient
+from juju.apiclient import (
+    ConnectionClosed,
+    FacadeVersionNotSupported,
+    NotImplementedError,
+    UnknownFacade,
+)
+from juju.retry import RetryPolicy
+from tests.fakes import FakeWebsocket
+
+
+def run(coro):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coro)
+    finally:
+        loop.close()
+
+
+class AsyncFakeWebsocket(FakeWebsocket):
+
+    def __init__(self, *args, **kwargs):
+        super(AsyncFakeWebsocket, self).__init__(*args, **kwargs)
+        self._responses = asyncio.Queue()
+
+    async def send(self, data):
+        FakeWebsocket.send(self, data)
+
+    async def recv(self):
+        frame = await self._responses.get()
+        if frame is None:
+            raise ConnectionClosed("socket closed")
+        return frame
+
+    async def close(self):
+        FakeWebsocket.close(self)
+
+
+async def connect(websocket, **kwargs):
+    connection = aioclient.AsyncConnection(websocket, **kwargs)
+    connection._info = await connection._authenticate(
+        'user-admin', 'sekrit', '')
+    connection._generate_facades()
+    return connection
+
+
+class TestAsyncConnection(unittest.TestCase):
+
+    def test_login_fallback(self):
+        async def go():
+            ws = AsyncFakeWebsocket(login_versions=(0,))
+            connection = await connect(ws)
+            await connection.close()
+            return ws.requests
+
+        requests = run(go())
+        self.assertEqual([r['Version'] for r in requests], [2, 1, 0])
+        self.assertEqual(
+            requests[-1]['Params'],
+            {'AuthTag': 'user-admin', 'Password': 'sekrit', 'Nonce': ''})
+
+    def test_concurrent_rpc(self):
+        async def go():
+            ws = AsyncFakeWebsocket(lambda r: {'Name': r['Params']['Name']})
+            connection = await connect(ws)
+            client = connection.get_facade('Client')
+            results = await asyncio.gather(*[
+                client.Get({'Name': str(i)}) for i in range(50)])
+            await connection.close()
+            return results
+
+        self.assertEqual(
+            run(go()), [{'Name': str(i)} for i in range(50)])
+
+    def test_error_mapping(self):
+        async def go():
+            ws = AsyncFakeWebsocket(
+                lambda r: {'Error': 'no such request',
+                           'ErrorCode': 'not implemented'})
+            connection = await connect(ws)
+            try:
+                await connection.rpc('Client', 'Missing')
+            finally:
+                await connection.close()
+
+        self.assertRaises(NotImplementedError, run, go())
+
+    def test_upgrade_retry(self):
+        responses = [{'Error': 'upgrade in progress'}, {'Name': 'done'}]
+
+        async def go():
+            ws = AsyncFakeWebsocket(lambda r: responses.pop(0))
+            connection = await connect(
+                ws, retry_policy=RetryPolicy(base_delay=0))
+            result = await connection.rpc('Client', 'Get')
+            await connection.close()
+            return result
+
+        self.assertEqual(run(go()), {'Name': 'done'})
+
+    def test_close_fails_pending(self):
+        async def go():
+            ws = AsyncFakeWebsocket(lambda r: None)
+            connection = await connect(ws)
+            call = asyncio.ensure_future(connection.rpc('Client', 'Get'))
+            await asyncio.sleep(0)
+            await connection.close()
+            await call
+
+        self.assertRaises(ConnectionClosed, run, go())
+
+    def test_get_facade(self):
+        async def go():
+            connection = await connect(AsyncFakeWebsocket())
+            await connection.close()
+            return connection
+
+        connection = run(go())
+        facade = connection.get_facade('Admin')
+        self.assertIsInstance(facade, aioclient.AsyncFacade)
+        self.assertEqual(facade.version, 2)
+        self.assertRaises(UnknownFacade, connection.get_facade, 'Missing')
+        self.assertRaises(
+            FacadeVersionNotSupported, connection.get_facade, 'Admin', 3)
+
+
+class TestAsyncWebSocket(unittest.TestCase):
+
+    def test_handshake_and_frames(self):
+        received = []
+
+        async def handle(reader, writer):
+            head = (await reader.readuntil(b"\r\n\r\n")).decode('latin-1')
+            key = [line.split(":", 1)[1].strip() for line in head.split("\r\n")
+                   if line.lower().startswith("sec-websocket-key")][0]
+            accept = base64.b64encode(hashlib.sha1(
+                (key + aioclient._WEBSOCKET_GUID).encode()).digest())
+            writer.write(
+                b"HTTP/1.1 101 Switching Protocols\r\n"
+                b"Upgrade: websocket\r\nConnection: Upgrade\r\n"
+                b"Sec-WebSocket-Accept: " + accept + b"\r\n\r\n")
+            # Ping the client, then send a fragmented message.
+            writer.write(b"\x89\x02hi")
+            writer.write(b"\x01\x03hel")
+            writer.write(b"\x80\x02lo")
+            for _ in range(2):
+                b1, b2 = await reader.readexactly(2)
+                length = b2 & 0x7f
+                if length == 126:
+                    length, = struct.unpack("!H", await reader.readexactly(2))
+                mask = await reader.readexactly(4)
+                payload = websocket.ABNF.mask(
+                    mask, await reader.readexactly(length))
+                received.append((b1 & 0x0f, payload))
+            writer.close()
+
+        async def go():
+            server = await asyncio.start_server(handle, '127.0.0.1', 0)
+            port = server.sockets[0].getsockname()[1]
+            ws = await aioclient.AsyncWebSocket.open(
+                'ws://127.0.0.1:{}/'.format(port))
+            message = await ws.recv()
+            await ws.send('x' * 200)
+            try:
+                await ws.recv()
+            except ConnectionClosed:
+                pass
+            server.close()
+            await server.wait_closed()
+            return message
+
+        self.assertEqual(run(go()), 'hello')
+        self.assertEqual(received, [
+            (websocket.ABNF.OPCODE_PONG, b'hi'),
+            (websocket.ABNF.OPCODE_TEXT, b'x' * 200),
+        ])
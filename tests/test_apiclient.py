@@ -1,9 +1,12 @@
-import os
+import threading
+import time
 import unittest
 
 import mock
 
 import juju.apiclient
+from juju.retry import RetryPolicy
+from tests.fakes import FakeWebsocket, make_connection
 
 
 class TestFacade(unittest.TestCase):
@@ -28,27 +31,79 @@ class TestFacade(unittest.TestCase):
         connection.rpc.assert_called_with(
             'FacadeName', 'SomeMethod', 'args', version=3)
 
+    def test_methods_are_kept(self):
+        facade = juju.apiclient.Facade(mock.Mock(), 'FacadeName')
+        self.assertIs(facade.SomeMethod, facade.SomeMethod)
+        self.assertRaises(AttributeError, getattr, facade, '__deepcopy__')
 
-class TestConnection(unittest.TestCase):
 
-    def test_write_cert(self):
-        cert_text = 'some fake cert text'
-        f = juju.apiclient.Connection._write_cert(cert_text)
-        filename = f.name
-        self.assertTrue(filename.endswith('.pem'))
-        with open(filename) as cert_file:
-            content = cert_file.read()
-            self.assertEqual(content, cert_text)
-
-    def test_write_cert_removed_when_closed(self):
-        cert_text = 'some fake cert text'
-        f = juju.apiclient.Connection._write_cert(cert_text)
-        filename = f.name
-        f.close()
+class TestBatch(unittest.TestCase):
+
+    def life_handler(self, request):
+        results = []
+        for entity in request['Params']['Entities']:
+            if entity['Tag'].endswith('missing'):
+                results.append({'Error': {'Message': 'not found',
+                                          'Code': 'not found'}})
+            else:
+                results.append({'Life': 'alive'})
+        return {'Results': results}
+
+    def test_bulk_chunks_and_fans_out(self):
+        websocket = FakeWebsocket(self.life_handler)
+        connection = make_connection(websocket)
+        client = connection.get_facade('Client')
+        tags = ['unit-a-{}'.format(i) for i in range(5)] + ['unit-missing']
+        results = client.bulk(
+            'Life', [{'Tag': tag} for tag in tags], chunk_size=2)
+        calls = [r for r in websocket.requests if r['Request'] == 'Life']
+        self.assertEqual(
+            [len(c['Params']['Entities']) for c in calls], [2, 2, 2])
+        self.assertEqual([r.item['Tag'] for r in results], tags)
+        self.assertEqual(
+            [r.result for r in results[:5]], [{'Life': 'alive'}] * 5)
+        self.assertIsNone(results[-1].result)
+        self.assertIsInstance(
+            results[-1].error, juju.apiclient.ServerError)
+        self.assertEqual(results[-1].error.error_code, 'not found')
+
+    def test_batch_pipelined(self):
+        websocket = FakeWebsocket(self.life_handler)
+        connection = make_connection(websocket, pipelined=True)
+        self.addCleanup(connection.close)
+        batch = connection.get_facade('Client').batch('Life', chunk_size=3)
+        for i in range(10):
+            self.assertEqual(batch.add({'Tag': 'unit-a-{}'.format(i)}), i)
+        self.assertEqual(len(batch), 10)
+        results = batch.execute()
+        self.assertEqual(len(results), 10)
+        self.assertTrue(all(r.error is None for r in results))
+        self.assertEqual(len(batch), 0)
+
+    def test_call_error_applies_to_chunk(self):
+        websocket = FakeWebsocket(
+            lambda r: {'Error': 'permission denied',
+                       'ErrorCode': 'unauthorized access'})
+        connection = make_connection(websocket)
+        results = connection.get_facade('Client').bulk(
+            'Life', [{'Tag': 'unit-a-0'}, {'Tag': 'unit-a-1'}])
+        self.assertEqual(
+            [r.error.error_code for r in results],
+            ['unauthorized access'] * 2)
+
+    def test_result_count_mismatch(self):
+        websocket = FakeWebsocket(lambda r: {'Results': []})
+        connection = make_connection(websocket)
         self.assertRaises(
-            OSError,
-            os.stat,
-            filename)
+            RuntimeError, connection.get_facade('Client').bulk,
+            'Life', [{'Tag': 'unit-a-0'}])
+
+    def test_bad_chunk_size(self):
+        facade = juju.apiclient.Facade(mock.Mock(), 'Client')
+        self.assertRaises(ValueError, facade.batch, 'Life', chunk_size=0)
+
+
+class TestConnection(unittest.TestCase):
 
     def test_login_args(self):
         self.assertEqual(
@@ -91,3 +146,518 @@ class TestConnection(unittest.TestCase):
         self.assertEqual(
             juju.apiclient.Connection._endpoint(address, 'env-uuid'),
             'wss://localhost:12345/environment/env-uuid/api')
+
+
+class TestPipelining(unittest.TestCase):
+
+    def test_not_pipelined_by_default(self):
+        connection = make_connection()
+        self.assertFalse(connection.pipelined)
+        self.assertEqual(connection.rpc('Client', 'FullStatus'), {})
+
+    def test_responses_matched_by_request_id(self):
+        held = []
+
+        def handler(request):
+            held.append(request)
+            if len(held) < 3:
+                return None
+            # Reply to everything in reverse order.
+            for r in reversed(held):
+                websocket.reply(r, {'Name': r['Params']['Name']})
+
+        websocket = FakeWebsocket(handler)
+        connection = make_connection(websocket, pipelined=True)
+        self.addCleanup(connection.close)
+        self.assertTrue(connection.pipelined)
+        futures = [
+            connection.submit('Client', 'Get', {'Name': name})
+            for name in ('a', 'b', 'c')]
+        self.assertEqual(
+            [f.result(5) for f in futures],
+            [{'Name': 'a'}, {'Name': 'b'}, {'Name': 'c'}])
+
+    def test_concurrent_rpc_calls(self):
+        websocket = FakeWebsocket(lambda r: {'Name': r['Params']['Name']})
+        connection = make_connection(websocket, pipelined=True)
+        self.addCleanup(connection.close)
+        results = {}
+
+        def call(name):
+            results[name] = connection.rpc('Client', 'Get', {'Name': name})
+
+        threads = [
+            threading.Thread(target=call, args=(str(i),)) for i in range(20)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join(5)
+        self.assertEqual(
+            results, dict((str(i), {'Name': str(i)}) for i in range(20)))
+
+    def test_submit_error(self):
+        websocket = FakeWebsocket(
+            lambda r: {'Error': 'no such request',
+                       'ErrorCode': 'not implemented'})
+        connection = make_connection(websocket, pipelined=True)
+        self.addCleanup(connection.close)
+        future = connection.submit('Client', 'Missing')
+        self.assertRaises(
+            juju.apiclient.NotImplementedError, future.result, 5)
+
+    def test_submit_not_pipelined(self):
+        connection = make_connection()
+        future = connection.submit('Client', 'FullStatus')
+        self.assertTrue(future.done())
+        self.assertEqual(future.result(), {})
+
+    def test_start_pipelining_waits_for_call(self):
+        # A call that reads its own response keeps it from the reader.
+        held = []
+
+        def handler(request):
+            held.append(request)
+            return None
+        websocket = FakeWebsocket(handler)
+        connection = make_connection(websocket)
+        self.addCleanup(connection.close)
+        results = []
+        call = threading.Thread(target=lambda: results.append(
+            connection.rpc('Client', 'Get', timeout=5)))
+        call.start()
+        while not held:
+            call.join(0.01)
+        start = threading.Thread(target=connection.start_pipelining)
+        start.start()
+        start.join(0.05)
+        self.assertTrue(start.is_alive())
+        websocket.reply(held[0], {'Name': 'a'})
+        call.join(5)
+        start.join(5)
+        self.assertEqual(results, [{'Name': 'a'}])
+        self.assertTrue(connection.pipelined)
+
+    def test_close_fails_pending(self):
+        websocket = FakeWebsocket(lambda r: None)
+        connection = make_connection(websocket, pipelined=True)
+        future = connection.submit('Client', 'FullStatus')
+        connection.close()
+        self.assertRaises(
+            juju.apiclient.ConnectionClosed, future.result, 5)
+
+    def test_upgrade_retry(self):
+        responses = [
+            {'Error': 'upgrade in progress'},
+            {'Name': 'done'},
+        ]
+        websocket = FakeWebsocket(lambda r: responses.pop(0))
+        connection = make_connection(
+            websocket, pipelined=True,
+            retry_policy=RetryPolicy(base_delay=0))
+        self.addCleanup(connection.close)
+        future = connection.submit('Client', 'Get')
+        self.assertEqual(future.result(5), {'Name': 'done'})
+
+
+class TestTimeouts(unittest.TestCase):
+
+    def setUp(self):
+        self.held = []
+        self.websocket = FakeWebsocket(self.handle)
+
+    def handle(self, request):
+        if request['Request'] == 'Slow':
+            self.held.append(request)
+            return None
+        if request['Request'] == 'Upgrading':
+            return {'Error': 'upgrade in progress'}
+        return {'Name': request['Request']}
+
+    def reply_late(self):
+        for request in self.held:
+            self.websocket.reply(request, {'Name': 'late'})
+
+    def test_rpc_timeout(self):
+        connection = make_connection(self.websocket)
+        self.assertRaises(
+            juju.apiclient.RPCTimeout, connection.rpc, 'Client', 'Slow',
+            timeout=0.05)
+        self.reply_late()
+        self.assertFalse(connection.closed)
+        # The late response is discarded, not taken as this one's.
+        self.assertEqual(connection.rpc('Client', 'Get'), {'Name': 'Get'})
+        self.assertEqual(connection._abandoned, set())
+
+    def test_connection_timeout(self):
+        connection = make_connection(self.websocket, timeout=0.05)
+        self.assertRaises(
+            juju.apiclient.RPCTimeout, connection.rpc, 'Client', 'Slow')
+        threading.Timer(0.1, self.reply_late).start()
+        self.assertEqual(
+            connection.rpc('Client', 'Slow', timeout=None), {'Name': 'late'})
+
+    def test_pipelined_rpc_timeout(self):
+        connection = make_connection(self.websocket, pipelined=True)
+        self.addCleanup(connection.close)
+        with mock.patch('juju.apiclient.logger') as logger:
+            self.assertRaises(
+                juju.apiclient.RPCTimeout, connection.rpc, 'Client', 'Slow',
+                timeout=0.05)
+            self.reply_late()
+            self.assertEqual(
+                connection.rpc('Client', 'Get'), {'Name': 'Get'})
+        self.assertFalse(logger.warning.called)
+        self.assertEqual(connection._pending, {})
+        self.assertEqual(connection._abandoned, set())
+
+    def test_submit_timeout(self):
+        connection = make_connection(self.websocket, pipelined=True)
+        self.addCleanup(connection.close)
+        future = connection.submit('Client', 'Slow', timeout=0.05)
+        self.assertRaises(juju.apiclient.RPCTimeout, future.result, 5)
+        self.assertEqual(connection._pending, {})
+
+    def test_cancel(self):
+        connection = make_connection(self.websocket, pipelined=True)
+        self.addCleanup(connection.close)
+        future = connection.submit('Client', 'Slow')
+        self.assertTrue(future.cancel())
+        self.assertFalse(future.cancel())
+        self.assertRaises(juju.apiclient.RPCCancelled, future.result, 5)
+        self.assertEqual(connection._pending, {})
+        self.reply_late()
+        self.assertEqual(connection.rpc('Client', 'Get'), {'Name': 'Get'})
+        self.assertEqual(connection._abandoned, set())
+        done = connection.submit('Client', 'Get')
+        done.result(5)
+        self.assertFalse(done.cancel())
+
+    def test_deadline_stops_retries(self):
+        connection = make_connection(
+            self.websocket,
+            retry_policy=RetryPolicy(base_delay=0.04, multiplier=1, jitter=0))
+        start = time.time()
+        self.assertRaises(
+            juju.apiclient.ServerError, connection.rpc, 'Client', 'Upgrading',
+            timeout=0.1)
+        self.assertLess(time.time() - start, 0.1)
+        calls = [r for r in self.websocket.requests
+                 if r['Request'] == 'Upgrading']
+        self.assertEqual(len(calls), 3)
+
+    def test_waiting_for_connection_times_out(self):
+        connection = make_connection(self.websocket)
+        slow = threading.Thread(
+            target=connection.rpc, args=('Client', 'Slow'))
+        slow.start()
+        while not self.held:
+            time.sleep(0.001)
+        self.assertRaises(
+            juju.apiclient.RPCTimeout, connection.rpc, 'Client', 'Get',
+            timeout=0.05)
+        self.reply_late()
+        slow.join(5)
+        self.assertEqual(connection.rpc('Client', 'Get'), {'Name': 'Get'})
+
+
+class TestEndpointStats(unittest.TestCase):
+
+    def test_order(self):
+        stats = juju.apiclient.EndpointStats()
+        stats.record('slow:1', 2.0)
+        stats.record('fast:1', 0.1)
+        stats.record_failure('dead:1')
+        self.assertEqual(
+            stats.order(['dead:1', 'new:1', 'slow:1', 'new:2', 'fast:1']),
+            ['fast:1', 'slow:1', 'new:1', 'new:2', 'dead:1'])
+
+    def test_smoothing_and_recovery(self):
+        stats = juju.apiclient.EndpointStats(smoothing=0.5)
+        stats.record('a:1', 1.0)
+        stats.record('a:1', 3.0)
+        self.assertEqual(stats.latency('a:1'), 2.0)
+        stats.record_failure('a:1')
+        self.assertIsNone(stats.latency('a:1'))
+        stats.record('a:1', 1.0)
+        self.assertEqual(stats.order(['b:1', 'a:1']), ['a:1', 'b:1'])
+
+
+class FailoverTestCase(unittest.TestCase):
+    """Connects to fake servers, keyed by address."""
+
+    def setUp(self):
+        self.servers = {}
+        self.delays = {}
+        stats = mock.patch.object(
+            juju.apiclient, 'endpoint_stats',
+            juju.apiclient.EndpointStats())
+        stats.start()
+        self.addCleanup(stats.stop)
+        patcher = mock.patch.object(
+            juju.apiclient.Connection, '_connect', side_effect=self.connect)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def connect(self, endpoint, cacert):
+        address = endpoint[len('wss://'):].split('/')[0]
+        time.sleep(self.delays.get(address, 0))
+        if address not in self.servers:
+            raise IOError('connection refused')
+        websocket = FakeWebsocket(lambda r: {'Address': address})
+        self.servers[address].append(websocket)
+        return websocket
+
+    def add_server(self, address, delay=0):
+        self.servers[address] = []
+        self.delays[address] = delay
+
+
+class TestConnectFastest(FailoverTestCase):
+
+    def test_fastest_wins(self):
+        self.add_server('slow:17070', delay=0.5)
+        self.add_server('fast:17070')
+        connection = juju.apiclient.connect_fastest(
+            ['slow:17070', 'dead:17070', 'fast:17070'], 'cert',
+            'user-admin', 'sekrit', stagger=0.05)
+        self.assertEqual(connection.address, 'fast:17070')
+        stats = juju.apiclient.endpoint_stats
+        self.assertIsNotNone(stats.latency('fast:17070'))
+        self.assertEqual(
+            stats.order(['dead:17070', 'fast:17070']),
+            ['fast:17070', 'dead:17070'])
+
+    def test_loser_closed(self):
+        self.add_server('a:17070', delay=0.1)
+        self.add_server('b:17070', delay=0.1)
+        connection = juju.apiclient.connect_fastest(
+            ['a:17070', 'b:17070'], 'cert', 'user-admin', 'sekrit',
+            stagger=0)
+        other = 'b:17070' if connection.address == 'a:17070' else 'a:17070'
+        for _ in range(50):
+            if self.servers[other] and self.servers[other][0].closed:
+                break
+            time.sleep(0.01)
+        self.assertTrue(self.servers[other][0].closed)
+
+    def test_all_fail(self):
+        self.assertRaises(
+            IOError, juju.apiclient.connect_fastest,
+            ['dead:1', 'dead:2'], 'cert', 'user-admin', 'sekrit', stagger=0)
+
+    def test_connection_from_info_races(self):
+        self.add_server('b:17070')
+        connection = juju.apiclient.connection_from_info({
+            'user': 'admin', 'password': 'sekrit', 'environ-uuid': 'uuid',
+            'ca-cert': 'cert', 'state-servers': ['a:17070', 'b:17070']})
+        self.assertEqual(connection.address, 'b:17070')
+
+
+class TestFailover(FailoverTestCase):
+
+    def test_failover_on_send(self):
+        self.add_server('a:17070')
+        self.add_server('b:17070')
+        connection = juju.apiclient.Connection(
+            'a:17070', 'cert', 'user-admin', 'sekrit',
+            failover_addresses=['b:17070'])
+        self.servers['a:17070'][0].close()
+        self.assertEqual(
+            connection.rpc('Client', 'Get'), {'Address': 'b:17070'})
+        self.assertEqual(connection.address, 'b:17070')
+        self.assertFalse(connection.closed)
+
+    def test_failover_races_addresses(self):
+        # A server slow to connect to doesn't hold up the others.
+        self.add_server('a:17070')
+        self.add_server('slow:17070', delay=5)
+        self.add_server('b:17070')
+        connection = juju.apiclient.Connection(
+            'a:17070', 'cert', 'user-admin', 'sekrit',
+            failover_addresses=['slow:17070', 'b:17070'])
+        connection.reconnect_stagger = 0.05
+        self.servers['a:17070'][0].close()
+        start = time.time()
+        self.assertEqual(
+            connection.rpc('Client', 'Get'), {'Address': 'b:17070'})
+        self.assertLess(time.time() - start, 1)
+
+    def test_failover_pipelined(self):
+        self.add_server('a:17070')
+        self.add_server('b:17070')
+        connection = juju.apiclient.Connection(
+            'a:17070', 'cert', 'user-admin', 'sekrit', pipelined=True,
+            failover_addresses=['b:17070'])
+        self.addCleanup(connection.close)
+        del self.servers['a:17070']
+        websocket = connection._connection
+        websocket.close()
+        for _ in range(100):
+            if connection.address == 'b:17070' and connection.pipelined:
+                break
+            time.sleep(0.01)
+        self.assertEqual(
+            connection.rpc('Client', 'Get'), {'Address': 'b:17070'})
+        self.assertTrue(connection.pipelined)
+
+    def test_no_failover_without_addresses(self):
+        self.add_server('a:17070')
+        connection = juju.apiclient.Connection(
+            'a:17070', 'cert', 'user-admin', 'sekrit')
+        self.servers['a:17070'][0].close()
+        self.assertRaises(
+            juju.apiclient.ConnectionClosed, connection.rpc, 'Client', 'Get')
+        self.assertTrue(connection.closed)
+
+    def test_close_does_not_failover(self):
+        self.add_server('a:17070')
+        self.add_server('b:17070')
+        connection = juju.apiclient.Connection(
+            'a:17070', 'cert', 'user-admin', 'sekrit', pipelined=True,
+            failover_addresses=['b:17070'])
+        connection.close()
+        time.sleep(0.05)
+        self.assertEqual(self.servers['b:17070'], [])
+
+
+def hang_up(websocket):
+    """A handler closing the websocket instead of responding."""
+    def handler(request):
+        websocket.close()
+    return handler
+
+
+class TestReconnect(FailoverTestCase):
+
+    def connection(self, **kwargs):
+        self.add_server('a:17070')
+        kwargs.setdefault('auto_reconnect', True)
+        connection = juju.apiclient.Connection(
+            'a:17070', 'cert', 'user-admin', 'sekrit', **kwargs)
+        self.addCleanup(connection.close)
+        return connection
+
+    def wait_for_sockets(self, count):
+        for _ in range(200):
+            if len(self.servers['a:17070']) >= count:
+                return
+            time.sleep(0.01)
+        self.fail("only {} websockets".format(len(self.servers['a:17070'])))
+
+    def test_auto_reconnect_without_addresses(self):
+        connection = self.connection()
+        self.servers['a:17070'][0].close()
+        self.assertEqual(
+            connection.rpc('Client', 'Get'), {'Address': 'a:17070'})
+        self.assertEqual(len(self.servers['a:17070']), 2)
+        self.assertFalse(connection.closed)
+
+    def test_reconnect_retries(self):
+        connection = self.connection(retry_policy=RetryPolicy(
+            base_delay=0.01, jitter=0, deadline=5))
+        del self.servers['a:17070']
+        connection._connection.close()
+        timer = threading.Timer(0.05, self.add_server, ('a:17070',))
+        timer.start()
+        self.addCleanup(timer.cancel)
+        self.assertEqual(
+            connection.rpc('Client', 'Get'), {'Address': 'a:17070'})
+
+    def test_reconnect_gives_up(self):
+        connection = self.connection(retry_policy=RetryPolicy(
+            base_delay=0.01, jitter=0, deadline=0.05))
+        del self.servers['a:17070']
+        connection._connection.close()
+        self.assertRaises(
+            juju.apiclient.ConnectionClosed, connection.rpc, 'Client', 'Get')
+        self.assertTrue(connection.closed)
+
+    def test_idempotent_call_resent(self):
+        connection = self.connection()
+        websocket = self.servers['a:17070'][0]
+        websocket.handler = hang_up(websocket)
+        self.assertEqual(
+            connection.rpc('Client', 'FullStatus'), {'Address': 'a:17070'})
+        resent = self.servers['a:17070'][1].requests[-1]
+        self.assertEqual(resent['Request'], 'FullStatus')
+
+    def test_mutating_call_not_resent(self):
+        connection = self.connection()
+        websocket = self.servers['a:17070'][0]
+        websocket.handler = hang_up(websocket)
+        self.assertRaises(
+            juju.apiclient.ConnectionClosed, connection.rpc, 'Client',
+            'AddMachines')
+        self.assertFalse(connection.closed)
+        self.assertEqual(
+            [r['Request'] for r in self.servers['a:17070'][1].requests],
+            ['Login'])
+
+    def test_pipelined_replay(self):
+        connection = self.connection(pipelined=True)
+        websocket = self.servers['a:17070'][0]
+        websocket.handler = lambda request: None
+        status = connection.submit('Client', 'FullStatus')
+        add = connection.submit('Client', 'AddMachines')
+        watcher = connection.submit(
+            'AllWatcher', 'Next', object_id='1', timeout=None)
+        websocket.close()
+        self.assertEqual(status.result(1), {'Address': 'a:17070'})
+        self.assertRaises(
+            juju.apiclient.ConnectionClosed, add.result, 1)
+        self.assertRaises(
+            juju.apiclient.ConnectionClosed, watcher.result, 1)
+
+    def test_keepalive_pings_when_idle(self):
+        self.connection(keepalive=0.02)
+        for _ in range(100):
+            requests = self.servers['a:17070'][0].requests
+            if any(r['Type'] == 'Pinger' for r in requests):
+                break
+            time.sleep(0.01)
+        self.assertEqual(requests[-1]['Request'], 'Ping')
+
+    def test_keepalive_replaces_dead_socket(self):
+        self.connection(keepalive=0.05)
+        self.servers['a:17070'][0].handler = lambda request: None
+        self.wait_for_sockets(2)
+        self.assertTrue(self.servers['a:17070'][0].closed)
+
+    def test_keepalive_replaces_dead_socket_pipelined(self):
+        connection = self.connection(keepalive=0.05, pipelined=True)
+        self.servers['a:17070'][0].handler = lambda request: None
+        self.wait_for_sockets(2)
+        for _ in range(100):
+            if connection.pipelined:
+                break
+            time.sleep(0.01)
+        self.assertEqual(
+            connection.rpc('Client', 'Get'), {'Address': 'a:17070'})
+
+    def test_keepalive_spares_slow_call(self):
+        for auto_reconnect in (True, False):
+            connection = self.connection(
+                keepalive=0.05, auto_reconnect=auto_reconnect)
+            websocket = self.servers['a:17070'][-1]
+
+            def slow(request):
+                if request['Request'] == 'Slow':
+                    time.sleep(0.3)
+                return {'Address': 'a:17070'}
+            websocket.handler = slow
+            connection.rpc('Client', 'Slow')
+            # Long enough for a ping that timed out to have acted.
+            time.sleep(0.1)
+            self.assertFalse(websocket.closed)
+            self.assertEqual(
+                connection.rpc('Client', 'Get'), {'Address': 'a:17070'})
+            self.assertIs(self.servers['a:17070'][-1], websocket)
+            connection.close()
+
+    def test_close_stops_keepalive(self):
+        connection = self.connection(keepalive=0.02)
+        connection.close()
+        time.sleep(0.1)
+        self.assertEqual(
+            [r['Request'] for r in self.servers['a:17070'][0].requests],
+            ['Login'])
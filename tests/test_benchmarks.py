@@ -0,0 +1,82 @@
+import unittest
+
+from benchmarks import run
+from benchmarks.server import FakeAPIServer
+from juju.apiclient import ServerError
+from juju.retry import RetryPolicy
+
+
+class TestFakeAPIServer(unittest.TestCase):
+
+    def start(self, **kwargs):
+        server = FakeAPIServer(**kwargs)
+        server.start()
+        self.addCleanup(server.stop)
+        return server
+
+    def connect(self, server, **kwargs):
+        connection = run.connect(server, **kwargs)
+        self.addCleanup(connection.close)
+        return connection
+
+    def test_login_fallback(self):
+        server = self.start(login_versions=(0,))
+        connection = self.connect(server)
+        self.assertEqual(connection.rpc('Client', 'AgentVersion'), {})
+
+    def test_full_status(self):
+        server = self.start(status_units=25)
+        connection = self.connect(server, pipelined=True)
+        status = connection.rpc('Client', 'FullStatus')
+        self.assertEqual(len(status['Machines']), 7)
+        self.assertEqual(
+            sum(len(s['Units']) for s in status['Services'].values()), 25)
+
+    def test_upgrade_errors(self):
+        server = self.start(upgrade_errors=2)
+        connection = self.connect(
+            server, retry_policy=RetryPolicy(base_delay=0, max_attempts=1))
+        self.assertRaises(
+            ServerError, connection.rpc, 'Client', 'AgentVersion')
+        self.assertEqual(connection.rpc('Client', 'AgentVersion'), {})
+        self.assertEqual(server.requests, 3)
+
+
+class TestRun(unittest.TestCase):
+
+    def test_run(self):
+        report = run.run(['rpc_latency', 'configstore_load'], 0.01, None)
+        self.assertEqual(
+            sorted(report['results']),
+            ['configstore_cold', 'configstore_warm', 'rpc_latency'])
+        self.assertIn('rpc_latency', run.format_report(report))
+
+    def test_run_fractional_scale(self):
+        report = run.run(['rpc_throughput'], 0.05, None)
+        self.assertEqual(
+            report['results']['rpc_throughput_serial']['iterations'], 3)
+
+    def test_run_threads_raises(self):
+        def fail():
+            raise ValueError("worker failed")
+        self.assertRaises(ValueError, run.run_threads, fail, 2)
+
+    def test_time_import(self):
+        seconds, modules = run.time_import('import juju.apiclient')
+        self.assertGreater(seconds, 0)
+        self.assertIn('juju.apiclient', modules)
+        # Only imported once needed, to connect or read a config file.
+        self.assertNotIn('websocket', modules)
+        self.assertNotIn('yaml', modules)
+        seconds, modules = run.time_import('from juju import Environment')
+        self.assertIn('juju.environment', modules)
+
+    def test_compare(self):
+        def report(**medians):
+            return {'results': dict(
+                (name, {'median': median})
+                for name, median in medians.items())}
+        lines, regressions = run.compare(
+            report(a=1.0, b=1.0, c=1.0), report(a=1.05, b=1.5, d=2.0))
+        self.assertEqual(regressions, ['b'])
+        self.assertEqual(len(lines), 3)
@@ -0,0 +1,157 @@
+import time
+import unittest
+
+import mock
+
+from juju.cache import ResponseCache
+from tests.fakes import FakeWebsocket, make_connection
+
+
+class TestResponseCache(unittest.TestCase):
+
+    def test_key_canonical(self):
+        self.assertEqual(
+            ResponseCache.key('Client', 'ServiceGet', 0, {'a': 1, 'b': 2}),
+            ResponseCache.key('Client', 'ServiceGet', 0, {'b': 2, 'a': 1}))
+        self.assertNotEqual(
+            ResponseCache.key('Client', 'ServiceGet', 0, {}),
+            ResponseCache.key('Client', 'ServiceGet', 1, {}))
+
+    def test_get_returns_copies(self):
+        cache = ResponseCache()
+        response = {'Config': {'a': 1}}
+        cache.put('k', response)
+        response['Config']['a'] = 2
+        got = cache.get('k')
+        self.assertEqual(got, {'Config': {'a': 1}})
+        got['Config']['a'] = 3
+        self.assertEqual(cache.get('k'), {'Config': {'a': 1}})
+        self.assertEqual((cache.hits, cache.misses), (2, 0))
+
+    def test_ttl(self):
+        cache = ResponseCache(ttl=10)
+        cache.put('k', {})
+        with mock.patch('time.time', return_value=time.time() + 11):
+            self.assertIsNone(cache.get('k'))
+        self.assertEqual(len(cache), 0)
+
+    def test_lru(self):
+        cache = ResponseCache(maxsize=2)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        cache.get('a')
+        cache.put('c', 3)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.get('c'), 3)
+
+    def test_invalidate(self):
+        cache = ResponseCache()
+        keys = [ResponseCache.key(f, m, 0, {}) for f, m in [
+            ('Client', 'ServiceGet'), ('Client', 'CharmInfo'),
+            ('Service', 'ServiceGet')]]
+        for key in keys:
+            cache.put(key, {})
+        cache.invalidate('Client', 'ServiceGet')
+        self.assertIsNone(cache.get(keys[0]))
+        self.assertEqual(cache.get(keys[1]), {})
+        cache.invalidate('Service')
+        self.assertIsNone(cache.get(keys[2]))
+        cache.invalidate()
+        self.assertEqual(len(cache), 0)
+
+    def test_mutating(self):
+        cache = ResponseCache()
+        self.assertTrue(cache.is_mutating('Client', 'ServiceSet'))
+        self.assertTrue(cache.is_mutating('Client', 'AddRelation'))
+        self.assertFalse(cache.is_mutating('Client', 'ServiceGet'))
+        self.assertFalse(cache.is_mutating('Client', 'FullStatus'))
+        self.assertTrue(cache.is_mutating('Client', 'EnvironmentSet'))
+        self.assertTrue(cache.is_mutating('Client', 'EnvironmentUnset'))
+        self.assertTrue(cache.is_mutating('Client', 'ServiceDeploy'))
+        self.assertTrue(cache.is_mutating('Service', 'ServicesDeploy'))
+        self.assertFalse(cache.is_mutating('Client', 'ServiceGetCharmURL'))
+        self.assertFalse(
+            cache.is_mutating('Client', 'ServiceCharmRelations'))
+
+    def test_note_call(self):
+        cache = ResponseCache()
+        client = ResponseCache.key('Client', 'ServiceGet', 0, {})
+        service = ResponseCache.key('Service', 'ServiceGet', 0, {})
+        charms = ResponseCache.key('Charms', 'CharmInfo', 0, {})
+        for key in (client, service, charms):
+            cache.put(key, {})
+        cache.note_call('Service', 'ServiceUpdate')
+        self.assertIsNone(cache.get(client))
+        self.assertIsNone(cache.get(service))
+        self.assertEqual(cache.get(charms), {})
+        cache.note_call('Client', 'SetEnvironAgentVersion')
+        self.assertIsNone(cache.get(charms))
+
+
+class TestConnectionCache(unittest.TestCase):
+
+    def setUp(self):
+        self.config = {'a': 1}
+        self.websocket = FakeWebsocket(self.handle)
+        self.connection = make_connection(
+            self.websocket, response_cache=ResponseCache())
+
+    def handle(self, request):
+        if request['Request'] == 'ServiceSet':
+            self.config = request['Params']['Options']
+            return {}
+        if request['Request'] == 'EnvironmentSet':
+            self.config = request['Params']['Config']
+            return {}
+        return {'Config': self.config}
+
+    def calls(self, method):
+        return len([r for r in self.websocket.requests
+                    if r['Request'] == method])
+
+    def test_read_through(self):
+        for _ in range(3):
+            self.assertEqual(
+                self.connection.rpc(
+                    'Client', 'ServiceGet', {'ServiceName': 'mysql'}),
+                {'Config': {'a': 1}})
+        self.assertEqual(self.calls('ServiceGet'), 1)
+        self.connection.rpc('Client', 'ServiceGet', {'ServiceName': 'wp'})
+        self.assertEqual(self.calls('ServiceGet'), 2)
+
+    def test_uncacheable_and_lazy_calls_not_cached(self):
+        self.connection.rpc('Client', 'FullStatus')
+        self.connection.rpc('Client', 'FullStatus')
+        self.connection.rpc('Client', 'ServiceGet', lazy=True)
+        self.connection.rpc('Client', 'ServiceGet', lazy=True)
+        self.assertEqual(self.calls('FullStatus'), 2)
+        self.assertEqual(self.calls('ServiceGet'), 2)
+
+    def test_mutating_call_invalidates(self):
+        get = self.connection.get_facade('Client').ServiceGet
+        self.assertEqual(get({'ServiceName': 'mysql'}), {'Config': {'a': 1}})
+        self.connection.rpc(
+            'Client', 'ServiceSet',
+            {'ServiceName': 'mysql', 'Options': {'a': 2}})
+        self.assertEqual(get({'ServiceName': 'mysql'}), {'Config': {'a': 2}})
+
+    def test_environment_set_invalidates(self):
+        self.assertEqual(self.connection.rpc('Client', 'EnvironmentGet'),
+                         {'Config': {'a': 1}})
+        self.connection.rpc('Client', 'EnvironmentSet', {'Config': {'a': 2}})
+        self.assertEqual(self.connection.rpc('Client', 'EnvironmentGet'),
+                         {'Config': {'a': 2}})
+
+    def test_submitted_mutating_call_invalidates(self):
+        self.connection.rpc('Client', 'ServiceGet')
+        self.connection.submit(
+            'Client', 'ServiceSet', {'Options': {'a': 3}}).result()
+        self.assertEqual(
+            self.connection.rpc('Client', 'ServiceGet'), {'Config': {'a': 3}})
+
+    def test_no_cache_by_default(self):
+        connection = make_connection(self.websocket)
+        connection.rpc('Client', 'ServiceGet')
+        connection.rpc('Client', 'ServiceGet')
+        self.assertEqual(self.calls('ServiceGet'), 2)
@@ -0,0 +1,105 @@
+import json
+import logging
+import unittest
+
+import mock
+
+from juju import codec
+from tests.fakes import FakeWebsocket, make_connection
+
+
+class TestCodecs(unittest.TestCase):
+
+    def test_json_round_trip(self):
+        c = codec.JSONCodec()
+        self.assertEqual(c.decode(c.encode({'a': [1, 2]})), {'a': [1, 2]})
+
+    def test_default_codec_falls_back(self):
+        with mock.patch.dict('sys.modules', {'orjson': None, 'ujson': None}):
+            self.assertEqual(codec.default_codec().name, 'json')
+
+    def test_default_codec_prefers_installed(self):
+        orjson = mock.Mock()
+        with mock.patch.dict('sys.modules', {'orjson': orjson}):
+            c = codec.default_codec()
+        self.assertEqual(c.name, 'orjson')
+        orjson.loads.return_value = {'a': 1}
+        self.assertEqual(c.decode('{"a": 1}'), {'a': 1})
+
+
+class TestLogFrame(unittest.TestCase):
+
+    def test_short(self):
+        self.assertEqual(str(codec.LogFrame('{"a": 1}')), '{"a": 1}')
+
+    def test_truncated(self):
+        self.assertEqual(
+            str(codec.LogFrame('x' * 15, limit=10)),
+            'xxxxxxxxxx... (5 more characters)')
+
+    def test_bytes(self):
+        self.assertEqual(str(codec.LogFrame(b'{}')), '{}')
+
+
+class TestDecodeEnvelope(unittest.TestCase):
+
+    def setUp(self):
+        self.codec = mock.Mock(wraps=codec.JSONCodec())
+
+    def test_response_left_undecoded(self):
+        raw = '{"RequestId":12,"Response":{"Machines":{"0":{}}}}'
+        result = codec.decode_envelope(raw, self.codec)
+        self.assertEqual(result['RequestId'], 12)
+        response = result['Response']
+        self.assertIsInstance(response, codec.LazyResponse)
+        self.assertEqual(response.raw, raw)
+        self.assertFalse(self.codec.decode.called)
+        self.assertEqual(response['Machines'], {'0': {}})
+        self.assertEqual(dict(response), {'Machines': {'0': {}}})
+        self.assertEqual(self.codec.decode.call_count, 1)
+
+    def test_error_decoded(self):
+        raw = '{"RequestId":1,"Error":"boom","ErrorCode":"bad","Response":{}}'
+        result = codec.decode_envelope(raw, self.codec)
+        self.assertEqual(result['Error'], 'boom')
+        self.assertEqual(result['ErrorCode'], 'bad')
+
+    def test_other_field_order(self):
+        raw = '{"Response": {"a": 1}, "RequestId": 3}'
+        result = codec.decode_envelope(raw, self.codec)
+        self.assertEqual(result['RequestId'], 3)
+        self.assertEqual(result['Response'].materialize(), {'a': 1})
+
+
+class TestConnectionCodec(unittest.TestCase):
+
+    def test_lazy_rpc(self):
+        connection = make_connection(
+            FakeWebsocket(lambda r: {'Machines': {'0': {}}}))
+        response = connection.rpc('Client', 'FullStatus', lazy=True)
+        self.assertIsInstance(response, codec.LazyResponse)
+        self.assertEqual(json.loads(response.raw)['Response'],
+                         {'Machines': {'0': {}}})
+        self.assertEqual(
+            connection.rpc('Client', 'FullStatus'), {'Machines': {'0': {}}})
+
+    def test_lazy_submit(self):
+        connection = make_connection(FakeWebsocket(lambda r: {'a': 1}))
+        response = connection.submit('Client', 'Get', lazy=True).result()
+        self.assertIsInstance(response, codec.LazyResponse)
+
+    def test_custom_codec(self):
+        c = mock.Mock(wraps=codec.JSONCodec())
+        connection = make_connection(codec=c)
+        connection.rpc('Client', 'FullStatus')
+        self.assertTrue(c.encode.called)
+
+    def test_debug_logging_truncates(self):
+        connection = make_connection(
+            FakeWebsocket(lambda r: {'Data': 'x' * 5000}))
+        with mock.patch.object(
+                logging.getLogger('juju'), 'debug') as debug:
+            connection.rpc('Client', 'Get')
+        frame = debug.call_args_list[-1][0][1]
+        self.assertIsInstance(frame, codec.LogFrame)
+        self.assertLess(len(str(frame)), 1100)
@@ -20,7 +20,43 @@ SAMPLE_CONFIG = {
 }
 
 
-class TestConfigStore(unittest.TestCase):
+class ConfigStoreHelpers(object):
+
+    def mkdir(self):
+        d = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, d)
+        return d
+
+    def write_jenv(self, juju_home, env_name, content):
+        env_dir = os.path.join(juju_home, 'environments')
+        if not os.path.exists(env_dir):
+            os.mkdir(env_dir)
+        jenv = os.path.join(env_dir, '{}.jenv'.format(env_name))
+        with open(jenv, 'w') as f:
+            yaml.dump(content, f, default_flow_style=False)
+
+    def write_cache_file(self, juju_home, env_name, content):
+        env_dir = os.path.join(juju_home, 'environments')
+        if not os.path.exists(env_dir):
+            os.mkdir(env_dir)
+        filename = os.path.join(env_dir, 'cache.yaml')
+        cache_content = {
+            'environment': {
+                env_name: {'env-uuid': content['environ-uuid'],
+                           'server-uuid': content['server-uuid'],
+                           'user': content['user']}},
+            'server-data': {
+                content['server-uuid']: {
+                    'api-endpoints': content['state-servers'],
+                    'ca-cert': content['ca-cert'],
+                    'identities': {content['user']: content['password']}}},
+            # Explicitly don't care about 'server-user' here.
+            }
+        with open(filename, 'w') as f:
+            yaml.dump(cache_content, f, default_flow_style=False)
+
+
+class TestConfigStore(ConfigStoreHelpers, unittest.TestCase):
 
     @mock.patch.dict(os.environ, JUJU_HOME='/test/juju/home')
     def test_configstore_default_uses_juju_home(self):
@@ -88,35 +124,46 @@ class TestConfigStore(unittest.TestCase):
             env = store.connection_info('test-env')
             self.assertEqual(env, content)
 
-    def mkdir(self):
-        d = tempfile.mkdtemp()
-        self.addCleanup(shutil.rmtree, d)
-        return d
 
-    def write_jenv(self, juju_home, env_name, content):
-        env_dir = os.path.join(juju_home, 'environments')
-        if not os.path.exists(env_dir):
-            os.mkdir(env_dir)
-        jenv = os.path.join(env_dir, '{}.jenv'.format(env_name))
-        with open(jenv, 'w') as f:
-            yaml.dump(content, f, default_flow_style=False)
-
-    def write_cache_file(self, juju_home, env_name, content):
-        env_dir = os.path.join(juju_home, 'environments')
-        if not os.path.exists(env_dir):
-            os.mkdir(env_dir)
-        filename = os.path.join(env_dir, 'cache.yaml')
-        cache_content = {
-            'environment': {
-                env_name: {'env-uuid': content['environ-uuid'],
-                           'server-uuid': content['server-uuid'],
-                           'user': content['user']}},
-            'server-data': {
-                content['server-uuid']: {
-                    'api-endpoints': content['state-servers'],
-                    'ca-cert': content['ca-cert'],
-                    'identities': {content['user']: content['password']}}},
-            # Explicitly don't care about 'server-user' here.
-            }
-        with open(filename, 'w') as f:
-            yaml.dump(cache_content, f, default_flow_style=False)
+class TestParsedFileCache(ConfigStoreHelpers, unittest.TestCase):
+
+    def setUp(self):
+        configstore.clear_cache()
+        self.addCleanup(configstore.clear_cache)
+        self.juju_home = self.mkdir()
+        self.store = configstore.ConfigStore(
+            os.path.join(self.juju_home, 'environments'))
+
+    def test_unchanged_file_parsed_once(self):
+        self.write_cache_file(self.juju_home, 'test-env', SAMPLE_CONFIG)
+        with mock.patch('yaml.load', wraps=yaml.load) as load:
+            for _ in range(3):
+                self.assertEqual(
+                    self.store.connection_info('test-env'), SAMPLE_CONFIG)
+                configstore.ConfigStore(
+                    self.store.directory).connection_info('test-env')
+        self.assertEqual(load.call_count, 1)
+
+    def test_changed_file_reparsed(self):
+        self.write_cache_file(self.juju_home, 'test-env', SAMPLE_CONFIG)
+        self.store.connection_info('test-env')
+        content = copy.deepcopy(SAMPLE_CONFIG)
+        content['password'] = 'a much longer new password'
+        self.write_cache_file(self.juju_home, 'test-env', content)
+        self.assertEqual(self.store.connection_info('test-env'), content)
+
+    def test_results_are_copies(self):
+        self.write_cache_file(self.juju_home, 'test-env', SAMPLE_CONFIG)
+        info = self.store.connection_info('test-env')
+        info['state-servers'].append('elsewhere:17070')
+        self.assertEqual(
+            self.store.connection_info('test-env'), SAMPLE_CONFIG)
+
+    def test_environment_names(self):
+        self.write_cache_file(self.juju_home, 'test-env', SAMPLE_CONFIG)
+        self.write_jenv(self.juju_home, 'old-env', SAMPLE_CONFIG)
+        self.assertEqual(
+            self.store.environment_names(), ['old-env', 'test-env'])
+
+    def test_environment_names_empty(self):
+        self.assertEqual(self.store.environment_names(), [])
@@ -0,0 +1,246 @@
+import threading
+import unittest
+
+from juju.apiclient import ServerError
+from juju.deploy import DependencyFailed, DeploymentPlan, parse_constraints
+from juju.facades import SchemaError
+from tests.fakes import FakeWebsocket, make_connection
+
+
+TOPOLOGY = {
+    'machines': {
+        '0': {'series': 'trusty', 'constraints': 'mem=4G cpu-cores=2'},
+        '1': {'series': 'trusty'},
+    },
+    'services': {
+        'wordpress': {'charm': 'cs:trusty/wordpress-4', 'num_units': 2,
+                      'options': {'debug': True, 'port': 80},
+                      'expose': True},
+        'mysql': {'charm': 'cs:trusty/mysql-38', 'num_units': 3,
+                  'to': ['0', 'lxc:1']},
+    },
+    'relations': [['wordpress:db', 'mysql:db']],
+}
+
+
+class FakeModel(object):
+    """Answers deployment calls, failing those for services in fail."""
+
+    def __init__(self, fail=()):
+        self.fail = fail
+
+    def __call__(self, request):
+        method = request['Request']
+        params = request.get('Params') or {}
+        if params.get('ServiceName') in self.fail:
+            return {'Error': 'charm not found', 'ErrorCode': 'not found'}
+        if method == 'AddMachines':
+            return {'Machines': [
+                {'Machine': str(i + 10)}
+                for i in range(len(params['MachineParams']))]}
+        if method == 'ServicesDeploy':
+            return {'Results': [
+                {'Error': {'Message': 'charm not found', 'Code': 'not found'}}
+                if s['ServiceName'] in self.fail else {}
+                for s in params['Services']]}
+        return {}
+
+
+class TestParseConstraints(unittest.TestCase):
+
+    def test_parse_constraints(self):
+        self.assertEqual(
+            parse_constraints("mem=4G cpu-cores=2 arch=amd64 tags=a,b"),
+            {'mem': 4096, 'cpu-cores': 2, 'arch': 'amd64',
+             'tags': ['a', 'b']})
+        self.assertEqual(parse_constraints("root-disk=512"),
+                         {'root-disk': 512})
+        self.assertEqual(parse_constraints({'mem': 1}), {'mem': 1})
+        self.assertRaises(ValueError, parse_constraints, "mem")
+
+
+class TestDeploymentPlan(unittest.TestCase):
+
+    def test_levels(self):
+        plan = DeploymentPlan(TOPOLOGY)
+        self.assertEqual(plan.levels(), [
+            ['deploy wordpress', 'machines'],
+            ['expose wordpress', 'machine 0', 'machine 1'],
+            ['deploy mysql'],
+            ['add mysql units', 'add mysql/1',
+             'relate wordpress:db mysql:db'],
+        ])
+
+    def test_params(self):
+        plan = DeploymentPlan(TOPOLOGY)
+        self.assertEqual(plan.steps['machines'].params, {'MachineParams': [
+            {'Jobs': ['JobHostUnits'], 'Series': 'trusty',
+             'Constraints': {'mem': 4096, 'cpu-cores': 2}},
+            {'Jobs': ['JobHostUnits'], 'Series': 'trusty'},
+        ]})
+        self.assertEqual(plan.steps['deploy wordpress'].params, {
+            'ServiceName': 'wordpress', 'CharmUrl': 'cs:trusty/wordpress-4',
+            'NumUnits': 2, 'Config': {'debug': 'true', 'port': '80'}})
+
+    def test_invalid_topologies(self):
+        self.assertRaises(ValueError, DeploymentPlan, {
+            'services': {'a': {'charm': 'cs:a', 'to': ['7']}}})
+        self.assertRaises(ValueError, DeploymentPlan, {
+            'services': {'a': {'charm': 'cs:a'}},
+            'relations': [['a:db', 'b:db']]})
+        self.assertRaises(ValueError, DeploymentPlan, {
+            'services': {'a': {}}})
+        self.assertRaises(SchemaError, DeploymentPlan, {
+            'services': {'a': {'charm': 'cs:a', 'num_units': 'two'}}})
+
+    def test_cycle(self):
+        plan = DeploymentPlan({'services': {'a': {'charm': 'cs:a'}}})
+        plan.steps['deploy a'].requires = ('deploy a',)
+        self.assertRaises(ValueError, plan.levels)
+
+
+class TestExecute(unittest.TestCase):
+
+    def connect(self, model, service_facade=False):
+        self.websocket = FakeWebsocket(model)
+        connection = make_connection(self.websocket, pipelined=True)
+        self.addCleanup(connection.close)
+        if service_facade:
+            connection._facade_versions['Service'] = [1]
+        return connection
+
+    def requests(self, method):
+        return [r for r in self.websocket.requests if r['Request'] == method]
+
+    def test_execute(self):
+        connection = self.connect(FakeModel())
+        report = DeploymentPlan(TOPOLOGY).execute(connection)
+        self.assertTrue(report.ok, report.format())
+        self.assertEqual(len(report.steps), 9)
+        deploy, = self.requests('ServiceDeploy')[1:]
+        self.assertEqual(deploy['Params']['ServiceName'], 'mysql')
+        # Placed on the machines the plan added.
+        self.assertEqual(deploy['Params']['ToMachineSpec'], '10')
+        self.assertEqual(deploy['Params']['NumUnits'], 1)
+        units = dict((r['Params'].get('ToMachineSpec'), r['Params'])
+                     for r in self.requests('AddServiceUnits'))
+        self.assertEqual(units['lxc:11']['ServiceName'], 'mysql')
+        self.assertEqual(units[None], {
+            'ServiceName': 'mysql', 'NumUnits': 1})
+        self.assertIn('total', report.format())
+
+    def test_parallel(self):
+        # Each level is all sent before any of it is answered.
+        model = FakeModel()
+        held = []
+
+        def handler(request):
+            held.append(request)
+            return None
+        connection = self.connect(handler)
+        plan = DeploymentPlan(TOPOLOGY)
+        thread = threading.Thread(target=plan.execute, args=(connection,))
+        thread.start()
+        # Steps checking each machine was added make no call, so calls
+        # come in waves by the number of calls before them.
+        waves = {}
+        depth = {}
+        for level in plan.levels():
+            for name in level:
+                step = plan.steps[name]
+                depth[name] = max([depth[r] for r in step.requires] or [0])
+                if step.facade is not None:
+                    depth[name] += 1
+                    waves.setdefault(depth[name], []).append(name)
+        for _, level in sorted(waves.items()):
+            while len(held) < len(level):
+                thread.join(0.01)
+            requests, held[:] = list(held), []
+            self.assertEqual(len(requests), len(level))
+            for request in requests:
+                self.websocket.reply(request, model(request))
+        thread.join(5)
+        self.assertFalse(thread.is_alive())
+
+    def test_max_in_flight(self):
+        connection = self.connect(FakeModel())
+        report = DeploymentPlan(TOPOLOGY).execute(
+            connection, max_in_flight=1)
+        self.assertTrue(report.ok)
+        self.assertRaises(ValueError, DeploymentPlan(TOPOLOGY).execute,
+                          connection, max_in_flight=0)
+
+    def test_failure_skips_dependents(self):
+        connection = self.connect(FakeModel(fail=('mysql',)))
+        report = DeploymentPlan(TOPOLOGY).execute(connection)
+        self.assertFalse(report.ok)
+        errors = report.errors
+        self.assertEqual(sorted(errors), [
+            'add mysql units', 'add mysql/1', 'deploy mysql',
+            'relate wordpress:db mysql:db'])
+        self.assertIsInstance(errors['deploy mysql'], ServerError)
+        self.assertIsInstance(errors['add mysql/1'], DependencyFailed)
+        self.assertEqual(self.requests('AddRelation'), [])
+        self.assertEqual(len(self.requests('ServiceExpose')), 1)
+        self.assertIn('FAILED', report.format())
+
+    def test_machine_failure_fails_its_units(self):
+        def model(request):
+            if request['Request'] == 'AddMachines':
+                return {'Machines': [
+                    {'Machine': '', 'Error': {
+                        'Message': 'no capacity', 'Code': ''}},
+                    {'Machine': '11'}]}
+            return {}
+        connection = self.connect(model)
+        report = DeploymentPlan(TOPOLOGY).execute(connection)
+        self.assertEqual(sorted(report.errors), [
+            'add mysql units', 'add mysql/1', 'deploy mysql', 'machine 0',
+            'relate wordpress:db mysql:db'])
+        self.assertIsInstance(report.errors['machine 0'], ServerError)
+        self.assertIsInstance(
+            report.errors['deploy mysql'], DependencyFailed)
+        self.assertEqual(report.errors['deploy mysql'].dependency,
+                         'machine 0')
+        # Nothing is placed on an empty machine spec.
+        self.assertEqual(
+            [r['Params']['ServiceName']
+             for r in self.requests('ServiceDeploy')], ['wordpress'])
+
+    def test_bulk_deploy(self):
+        connection = self.connect(FakeModel(fail=('b',)), True)
+        report = DeploymentPlan({'services': {
+            'a': {'charm': 'cs:a'}, 'b': {'charm': 'cs:b'},
+            'c': {'charm': 'cs:c'}}}).execute(connection)
+        self.assertEqual(self.requests('ServiceDeploy'), [])
+        bulk, = self.requests('ServicesDeploy')
+        self.assertEqual(bulk['Type'], 'Service')
+        self.assertEqual(
+            [s['ServiceName'] for s in bulk['Params']['Services']],
+            ['a', 'b', 'c'])
+        self.assertEqual(list(report.errors), ['deploy b'])
+
+    def test_many_dependents_of_failure(self):
+        def model(request):
+            if request['Request'] == 'AddMachines':
+                return {'Error': 'no capacity', 'ErrorCode': ''}
+            return {}
+        connection = self.connect(model)
+        services = dict(
+            ('svc-{}'.format(i), {'charm': 'cs:svc', 'to': ['lxc:0']})
+            for i in range(1500))
+        report = DeploymentPlan({
+            'machines': {'0': {}}, 'services': services}).execute(connection)
+        self.assertEqual(len(report.errors), 1502)
+        self.assertEqual(self.requests('ServiceDeploy'), [])
+
+    def test_not_pipelined(self):
+        self.websocket = FakeWebsocket(FakeModel())
+        connection = make_connection(self.websocket)
+        self.addCleanup(connection.close)
+        services = dict(
+            ('svc-{}'.format(i), {'charm': 'cs:svc', 'expose': True})
+            for i in range(300))
+        report = DeploymentPlan({'services': services}).execute(connection)
+        self.assertTrue(report.ok)
+        self.assertEqual(len(self.requests('ServiceExpose')), 300)
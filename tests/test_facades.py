@@ -0,0 +1,153 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import mock
+
+from juju import facades
+from juju.apiclient import FacadeVersionNotSupported, UnknownFacade
+from juju.facades import SchemaError, attribute_name, facade_class
+from tests.fakes import FakeWebsocket, make_connection
+
+
+STATUS = {
+    'EnvironmentName': 'test',
+    'Machines': {
+        '0': {'Id': '0', 'DNSName': '10.0.0.1', 'Unknown': 1,
+              'Containers': {'0/lxc/0': {'Id': '0/lxc/0'}}},
+    },
+    'Services': {
+        'wordpress': {
+            'Charm': 'cs:wordpress-1',
+            'Units': {
+                'wordpress/0': {
+                    'Machine': '0',
+                    'Workload': {'Status': 'active'},
+                    'Subordinates': {'nrpe/0': {'AgentState': 'started'}},
+                },
+            },
+        },
+    },
+    'Relations': [{'Id': 1, 'Endpoints': [{'ServiceName': 'wordpress'}]}],
+}
+
+
+class TestAttributeName(unittest.TestCase):
+
+    def test_attribute_name(self):
+        for field, name in [('DNSName', 'dns_name'),
+                            ('InstanceId', 'instance_id'),
+                            ('CharmURL', 'charm_url'),
+                            ('UUID', 'uuid'),
+                            ('agent-state', 'agent_state'),
+                            ('Patterns', 'patterns')]:
+            self.assertEqual(attribute_name(field), name)
+
+
+class TestFacadeClass(unittest.TestCase):
+
+    def setUp(self):
+        self.connection = mock.Mock()
+        self.client = facade_class('Client', 0)(self.connection)
+
+    def test_cached(self):
+        self.assertIs(facade_class('Client', 0), type(self.client))
+        self.assertRaises(KeyError, facade_class, 'Client', 99)
+
+    def test_call(self):
+        self.connection.rpc.return_value = STATUS
+        status = self.client.FullStatus(patterns=['wordpress'])
+        self.connection.rpc.assert_called_once_with(
+            'Client', 'FullStatus', {'Patterns': ['wordpress']}, version=0)
+        types = type(self.client).TYPES
+        self.assertIsInstance(status, types['FullStatus'])
+        self.assertEqual(status.environment_name, 'test')
+        machine = status.machines['0']
+        self.assertEqual(machine.dns_name, '10.0.0.1')
+        self.assertEqual(machine.containers['0/lxc/0'].id, '0/lxc/0')
+        unit = status.services['wordpress'].units['wordpress/0']
+        self.assertEqual(unit.workload.status, 'active')
+        self.assertEqual(unit.subordinates['nrpe/0'].agent_state, 'started')
+        self.assertEqual(
+            status.relations[0].endpoints[0].service_name, 'wordpress')
+        self.assertRaises(AttributeError, setattr, machine, 'unknown', 1)
+
+    def test_call_with_params(self):
+        types = type(self.client).TYPES
+        params = types['AddMachines'](machine_params=[
+            types['AddMachineParams'](series='trusty', jobs=['JobHostUnits']),
+            {'Series': 'xenial'},
+        ])
+        self.connection.rpc.return_value = {
+            'Machines': [{'Machine': '1'}, {'Error': {'Message': 'no'}}]}
+        result = self.client.AddMachines(params)
+        self.connection.rpc.assert_called_once_with(
+            'Client', 'AddMachines', {'MachineParams': [
+                {'Series': 'trusty', 'Jobs': ['JobHostUnits']},
+                {'Series': 'xenial'}]}, version=0)
+        self.assertEqual(result.machines[0].machine, '1')
+        self.assertEqual(result.machines[1].error.message, 'no')
+
+    def test_no_params_or_result(self):
+        self.connection.rpc.return_value = {}
+        self.assertEqual(self.client.ServiceExpose(service_name='wp'), {})
+        self.connection.rpc.assert_called_once_with(
+            'Client', 'ServiceExpose', {'ServiceName': 'wp'}, version=0)
+        self.client.EnvironmentInfo()
+        self.connection.rpc.assert_called_with(
+            'Client', 'EnvironmentInfo', None, version=0)
+
+    def test_validation(self):
+        types = type(self.client).TYPES
+        for call, kwargs in [
+                (self.client.ServiceGet, {}),
+                (self.client.ServiceGet, {'service_name': 1}),
+                (self.client.ServiceGet, {'service_name': 'a', 'other': 1}),
+                (self.client.AddServiceUnits,
+                 {'service_name': 'a', 'num_units': True}),
+                (self.client.ServiceSet,
+                 {'service_name': 'a', 'options': {'x': 1}}),
+                (self.client.AddMachines, {'machine_params': ['trusty']}),
+                (self.client.EnvironmentInfo, {'name': 'a'})]:
+            self.assertRaises(SchemaError, call, **kwargs)
+        self.assertRaises(
+            SchemaError, self.client.ServiceGet,
+            types['ServiceExpose'](service_name='a'))
+        self.assertRaises(
+            SchemaError, self.client.ServiceGet,
+            types['ServiceGet'](service_name='a'), service_name='b')
+        self.assertFalse(self.connection.rpc.called)
+
+
+class TestLoadSchema(unittest.TestCase):
+
+    def test_other_schema(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        filename = os.path.join(tmpdir, 'schema.json')
+        with open(filename, 'w') as f:
+            json.dump([{'Name': 'Pinger', 'Version': 3, 'Schema': {
+                'type': 'object', 'properties': {'Ping': {
+                    'type': 'object', 'properties': {}}}}}], f)
+        self.assertEqual(facades.schema_versions('Pinger', filename), [3])
+        pinger = facade_class('Pinger', 3, filename)(mock.Mock())
+        pinger.Ping()
+        pinger.connection.rpc.assert_called_once_with(
+            'Pinger', 'Ping', None, version=3)
+
+
+class TestGetTypedFacade(unittest.TestCase):
+
+    def test_get_typed_facade(self):
+        connection = make_connection(
+            FakeWebsocket(lambda r: {'Version': '1.25.0'}))
+        client = connection.get_typed_facade('Client')
+        self.assertEqual(client.VERSION, 0)
+        self.assertEqual(client.AgentVersion().version, '1.25.0')
+        self.assertRaises(
+            FacadeVersionNotSupported, connection.get_typed_facade,
+            'Client', 1)
+        self.assertRaises(
+            UnknownFacade, connection.get_typed_facade, 'Missing')
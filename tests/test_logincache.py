@@ -0,0 +1,86 @@
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+import mock
+
+from juju.logincache import LoginCache
+from tests.fakes import FACADES, FakeWebsocket, make_connection
+
+
+class TestLoginCache(unittest.TestCase):
+
+    def setUp(self):
+        d = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, d)
+        self.path = os.path.join(d, 'jujulib', 'login-cache.json')
+
+    def test_default_path(self):
+        with mock.patch.dict(os.environ, XDG_CACHE_HOME='/test/cache'):
+            cache = LoginCache()
+        self.assertEqual(cache.path, '/test/cache/jujulib/login-cache.json')
+
+    def test_put_get_across_instances(self):
+        LoginCache(self.path).put('wss://a', 1, FACADES)
+        entry = LoginCache(self.path).get('wss://a')
+        self.assertEqual(entry['version'], 1)
+        self.assertEqual(entry['facades'], FACADES)
+        self.assertIsNone(LoginCache(self.path).get('wss://b'))
+
+    def test_ttl(self):
+        cache = LoginCache(self.path, ttl=10)
+        cache.put('wss://a', 1, FACADES)
+        with mock.patch('time.time', return_value=time.time() + 11):
+            self.assertIsNone(cache.get('wss://a'))
+
+    def test_invalidate(self):
+        cache = LoginCache(self.path)
+        cache.put('wss://a', 1, FACADES)
+        cache.invalidate('wss://a')
+        self.assertIsNone(LoginCache(self.path).get('wss://a'))
+
+    def test_bad_file_ignored(self):
+        os.makedirs(os.path.dirname(self.path))
+        with open(self.path, 'w') as f:
+            f.write('not json')
+        cache = LoginCache(self.path)
+        self.assertIsNone(cache.get('wss://a'))
+        cache.put('wss://a', 0, FACADES)
+        self.assertEqual(LoginCache(self.path).get('wss://a')['version'], 0)
+
+
+class TestConnectionLoginCache(unittest.TestCase):
+
+    def setUp(self):
+        d = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, d)
+        self.cache = LoginCache(os.path.join(d, 'cache.json'))
+
+    def login_versions(self, websocket):
+        return [r['Version'] for r in websocket.requests
+                if r['Request'] == 'Login']
+
+    def test_cached_version_tried_first(self):
+        first = FakeWebsocket(login_versions=(0,))
+        make_connection(first, login_cache=self.cache)
+        self.assertEqual(self.login_versions(first), [2, 1, 0])
+        second = FakeWebsocket(login_versions=(0,))
+        make_connection(second, login_cache=self.cache)
+        self.assertEqual(self.login_versions(second), [0])
+
+    def test_cached_version_invalidated_on_failure(self):
+        self.cache.put('wss://localhost:17070', 0, FACADES)
+        websocket = FakeWebsocket(login_versions=(2, 1))
+        make_connection(websocket, login_cache=self.cache)
+        self.assertEqual(self.login_versions(websocket), [0, 2])
+        self.assertEqual(
+            self.cache.get('wss://localhost:17070')['version'], 2)
+
+    def test_facade_mismatch_updates_cache(self):
+        self.cache.put('wss://localhost:17070', 2, FACADES[:1])
+        connection = make_connection(login_cache=self.cache)
+        self.assertEqual(
+            self.cache.get('wss://localhost:17070')['facades'], FACADES)
+        connection.get_facade('Client')
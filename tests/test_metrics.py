@@ -0,0 +1,178 @@
+import json
+import logging
+import os
+import shutil
+import tempfile
+import unittest
+
+import mock
+
+from juju.apiclient import ServerError
+from juju.metrics import LoggingExporter, Metrics, PrometheusExporter
+from juju.retry import RetryPolicy
+from tests.fakes import FakeWebsocket, make_connection
+
+
+class TestMetrics(unittest.TestCase):
+
+    def test_snapshot(self):
+        metrics = Metrics(buckets=(0.1, 1))
+        metrics.record_request('Client', 'FullStatus', 40)
+        metrics.record_response('Client', 'FullStatus', 1160, 160)
+        metrics.record_call('Client', 'FullStatus', 0.05, 1000)
+        metrics.record_call('Client', 'FullStatus', 0.5, 2000)
+        metrics.record_retry('Client', 'FullStatus')
+        metrics.record_call(
+            'Client', 'FullStatus', 5, error_code='upgrade in progress')
+        self.assertEqual(metrics.snapshot(), {
+            'Client.FullStatus': {
+                'facade': 'Client',
+                'method': 'FullStatus',
+                'count': 3,
+                'errors': 1,
+                'retries': 1,
+                'seconds': 5.55,
+                'histogram': [[0.1, 1], [1, 2], [None, 3]],
+                'request_bytes': 40,
+                'response_bytes': 3000,
+                'error_codes': {'upgrade in progress': 1},
+                'request_wire_bytes': 40,
+                'response_wire_bytes': 160,
+                'compression_ratio': 6.0,
+            },
+        })
+        metrics.reset()
+        self.assertEqual(metrics.snapshot(), {})
+
+    def test_hooks(self):
+        records = []
+
+        def broken(record):
+            raise ValueError()
+
+        metrics = Metrics(hooks=[broken, records.append])
+        metrics.record_call('Client', 'AgentVersion', 0.25, 10)
+        self.assertEqual(len(records), 1)
+        self.assertEqual(records[0].method, 'AgentVersion')
+        self.assertEqual(records[0].seconds, 0.25)
+        self.assertIsNone(records[0].error_code)
+
+    def test_export(self):
+        exporter = mock.Mock()
+        metrics = Metrics(exporters=[exporter])
+        metrics.record_call('Client', 'AgentVersion', 0.25, 10)
+        metrics.export()
+        exporter.export.assert_called_once_with(metrics.snapshot())
+
+    def test_logging_exporter(self):
+        log = mock.Mock()
+        metrics = Metrics(exporters=[LoggingExporter(log, logging.DEBUG)])
+        metrics.record_call('Client', 'AgentVersion', 0.25, 10)
+        metrics.record_call('Client', 'AgentVersion', 0.75, 10)
+        metrics.export()
+        log.log.assert_called_once_with(
+            logging.DEBUG, mock.ANY, 'Client.AgentVersion', 2, 0, 0, 0.5, 0,
+            20)
+
+
+class TestPrometheusExporter(unittest.TestCase):
+
+    def setUp(self):
+        self.metrics = Metrics(buckets=(0.5,))
+        self.metrics.record_request('Client', 'FullStatus', 40)
+        self.metrics.record_call('Client', 'FullStatus', 0.25, 1000)
+        self.metrics.record_call(
+            'Client', 'FullStatus', 2, error_code='not "found"')
+
+    def test_render(self):
+        text = PrometheusExporter().render(self.metrics.snapshot())
+        labels = 'facade="Client",method="FullStatus"'
+        for line in [
+                '# TYPE juju_rpc_calls_total counter',
+                'juju_rpc_calls_total{%s} 2' % labels,
+                'juju_rpc_retries_total{%s} 0' % labels,
+                'juju_rpc_errors_total{%s,code="not \\"found\\""} 1' % labels,
+                'juju_rpc_request_bytes_total{%s} 40' % labels,
+                'juju_rpc_response_bytes_total{%s} 1000' % labels,
+                '# TYPE juju_rpc_duration_seconds histogram',
+                'juju_rpc_duration_seconds_bucket{%s,le="0.5"} 1' % labels,
+                'juju_rpc_duration_seconds_bucket{%s,le="+Inf"} 2' % labels,
+                'juju_rpc_duration_seconds_sum{%s} 2.25' % labels,
+                'juju_rpc_duration_seconds_count{%s} 2' % labels]:
+            self.assertIn(line + '\n', text)
+
+    def test_export_to_file(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        path = os.path.join(tmpdir, 'juju.prom')
+        exporter = PrometheusExporter(path)
+        self.metrics.exporters.append(exporter)
+        self.metrics.export()
+        with open(path) as f:
+            self.assertEqual(
+                f.read(), exporter.render(self.metrics.snapshot()))
+        self.assertEqual(os.listdir(tmpdir), ['juju.prom'])
+
+
+class TestConnectionMetrics(unittest.TestCase):
+
+    def setUp(self):
+        self.failures = 0
+        self.websocket = FakeWebsocket(self.handle)
+        self.metrics = Metrics()
+        self.connection = make_connection(
+            self.websocket, metrics=self.metrics,
+            retry_policy=RetryPolicy(base_delay=0))
+
+    def handle(self, request):
+        if request['Request'] == 'Fail':
+            return {'Error': 'boom', 'ErrorCode': 'unauthorized access'}
+        if self.failures:
+            self.failures -= 1
+            return {'Error': 'upgrade in progress',
+                    'ErrorCode': 'upgrade in progress'}
+        return {'Version': '1.25.0'}
+
+    def test_records_calls(self):
+        self.connection.rpc('Client', 'AgentVersion')
+        stats = self.metrics.snapshot()['Client.AgentVersion']
+        self.assertEqual(stats['count'], 1)
+        self.assertEqual(stats['errors'], 0)
+        frame = json.dumps(
+            {'RequestId': 1, 'Response': {'Version': '1.25.0'}})
+        self.assertEqual(stats['response_bytes'], len(frame))
+        self.assertGreater(stats['request_bytes'], 0)
+        self.assertEqual(stats['request_wire_bytes'], stats['request_bytes'])
+        self.assertEqual(stats['compression_ratio'], 1.0)
+        self.assertIn('Admin.Login', self.metrics.snapshot())
+
+    def test_records_retries(self):
+        self.failures = 2
+        self.connection.rpc('Client', 'AgentVersion')
+        stats = self.metrics.snapshot()['Client.AgentVersion']
+        self.assertEqual(stats['count'], 1)
+        self.assertEqual(stats['retries'], 2)
+        self.assertEqual(stats['errors'], 0)
+
+    def test_records_errors(self):
+        self.assertRaises(ServerError, self.connection.rpc, 'Client', 'Fail')
+        self.websocket.close()
+        self.assertRaises(
+            Exception, self.connection.rpc, 'Client', 'AgentVersion')
+        snapshot = self.metrics.snapshot()
+        self.assertEqual(snapshot['Client.Fail']['error_codes'],
+                         {'unauthorized access': 1})
+        self.assertEqual(snapshot['Client.AgentVersion']['error_codes'],
+                         {'ConnectionClosed': 1})
+
+    def test_records_submitted_calls(self):
+        self.failures = 1
+        self.connection.start_pipelining()
+        self.connection.submit('Client', 'AgentVersion').result()
+        future = self.connection.submit('Client', 'Fail')
+        self.assertRaises(ServerError, future.result)
+        snapshot = self.metrics.snapshot()
+        self.assertEqual(snapshot['Client.AgentVersion']['count'], 1)
+        self.assertEqual(snapshot['Client.AgentVersion']['retries'], 1)
+        self.assertEqual(snapshot['Client.Fail']['errors'], 1)
+        self.connection.close()
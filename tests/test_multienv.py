@@ -0,0 +1,153 @@
+import threading
+import time
+import unittest
+
+import mock
+
+from juju import apiclient
+from juju.multienv import EnvironmentTimeout, for_each_environment
+from tests.fakes import FakeWebsocket, make_connection
+
+
+class TestForEachEnvironment(unittest.TestCase):
+
+    def setUp(self):
+        self.store = mock.Mock()
+        self.store.environment_names.return_value = ['a', 'b', 'c']
+        self.store.connection_info.side_effect = lambda name: {'name': name}
+        self.connections = []
+        patcher = mock.patch(
+            'juju.multienv.connection_from_info', side_effect=self.connect)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def connect(self, info, **kwargs):
+        name = info['name']
+        if name == 'broken':
+            raise IOError('connection refused')
+
+        def handler(request):
+            if name == 'dead':
+                return None
+            return {'Version': name}
+
+        connection = make_connection(FakeWebsocket(handler), **kwargs)
+        self.connections.append(connection)
+        return connection
+
+    def version(self, connection):
+        return connection.rpc('Client', 'AgentVersion')['Version']
+
+    def test_all_environments(self):
+        results = list(for_each_environment(self.version, store=self.store))
+        self.assertEqual(
+            sorted((r.name, r.result, r.error) for r in results),
+            [('a', 'a', None), ('b', 'b', None), ('c', 'c', None)])
+        self.assertTrue(all(c.closed for c in self.connections))
+
+    def test_errors_reported_per_environment(self):
+        results = dict(
+            (r.name, r) for r in for_each_environment(
+                self.version, names=['a', 'broken'], store=self.store))
+        self.assertEqual(results['a'].result, 'a')
+        self.assertIsInstance(results['broken'].error, IOError)
+
+    def test_timeout_does_not_stall(self):
+        start = time.time()
+        results = dict(
+            (r.name, r) for r in for_each_environment(
+                self.version, names=['dead', 'a', 'b'], store=self.store,
+                max_workers=1, timeout=0.1, pipelined=True))
+        self.assertLess(time.time() - start, 2)
+        self.assertIsInstance(results['dead'].error, EnvironmentTimeout)
+        self.assertEqual(results['a'].result, 'a')
+        self.assertEqual(results['b'].result, 'b')
+
+    def test_abandoned_worker_ends(self):
+        # The dead environment's call times out too, closing its connection
+        # rather than leaving its worker blocked.
+        results = list(for_each_environment(
+            self.version, names=['dead'], store=self.store, timeout=0.1,
+            pipelined=True))
+        self.assertIsInstance(results[0].error, EnvironmentTimeout)
+        connection, = self.connections
+        self.assertLessEqual(connection.timeout, 0.1)
+        for _ in range(200):
+            if connection.closed:
+                break
+            time.sleep(0.01)
+        self.assertTrue(connection.closed)
+
+    def test_duplicate_names(self):
+        self.assertRaises(
+            ValueError, list,
+            for_each_environment(self.version, names=['a', 'a'],
+                                 store=self.store))
+
+    def test_bounded_concurrency(self):
+        active = []
+        peak = []
+        lock = threading.Lock()
+
+        def call(connection):
+            with lock:
+                active.append(1)
+                peak.append(len(active))
+            time.sleep(0.02)
+            with lock:
+                active.pop()
+
+        names = [str(i) for i in range(10)]
+        list(for_each_environment(
+            call, names=names, store=self.store, max_workers=3))
+        self.assertEqual(max(peak), 3)
+
+    def test_pool(self):
+        pool = mock.Mock()
+        connection = make_connection(FakeWebsocket(lambda r: {'Version': 1}))
+        pool.connection.return_value.__enter__ = mock.Mock(
+            return_value=connection)
+        pool.connection.return_value.__exit__ = mock.Mock(return_value=None)
+        results = list(for_each_environment(
+            self.version, names=['a'], store=self.store, pool=pool))
+        self.assertEqual(results[0].result, 1)
+        pool.connection.assert_called_once_with('a')
+        self.assertFalse(connection.closed)
+
+    def test_pool_timeout(self):
+        pool = mock.Mock()
+        connection = make_connection(FakeWebsocket(lambda r: None))
+        connection.timeout = 60
+        pool.connection.return_value.__enter__ = mock.Mock(
+            return_value=connection)
+        pool.connection.return_value.__exit__ = mock.Mock(return_value=None)
+        start = time.time()
+        results = list(for_each_environment(
+            self.version, names=['a'], store=self.store, pool=pool,
+            timeout=0.05))
+        self.assertIsInstance(results[0].error, EnvironmentTimeout)
+        self.assertLess(time.time() - start, 1)
+        name, timeout = pool.connection.call_args[0]
+        self.assertEqual(name, 'a')
+        self.assertLessEqual(timeout, 0.05)
+        # Once the abandoned call times out, the pool's timeout is back.
+        for _ in range(100):
+            if pool.connection.return_value.__exit__.called:
+                break
+            time.sleep(0.01)
+        self.assertEqual(connection.timeout, 60)
+
+    def test_bad_max_workers(self):
+        self.assertRaises(
+            ValueError, list,
+            for_each_environment(self.version, store=self.store,
+                                 max_workers=0))
+
+    def test_closed_connection_error(self):
+        def call(connection):
+            connection.close()
+            return connection.rpc('Client', 'AgentVersion')
+
+        results = list(for_each_environment(
+            call, names=['a'], store=self.store))
+        self.assertIsInstance(results[0].error, apiclient.ConnectionClosed)
@@ -0,0 +1,153 @@
+import threading
+import time
+import unittest
+
+import mock
+
+from juju import apiclient
+from juju.pool import ConnectionPool, PoolTimeout
+from tests.fakes import FakeWebsocket, make_connection
+
+
+INFO = {
+    'user': 'admin',
+    'password': 'sekrit',
+    'environ-uuid': 'env-uuid',
+    'server-uuid': 'server-uuid',
+    'state-servers': ['localhost:17070'],
+    'ca-cert': 'cert',
+}
+
+
+class TestConnectionPool(unittest.TestCase):
+
+    def make_pool(self, **kwargs):
+        store = mock.Mock()
+        store.connection_info.return_value = INFO
+        pool = ConnectionPool(store=store, **kwargs)
+        self.websockets = []
+
+        def connect(info):
+            websocket = FakeWebsocket()
+            self.websockets.append(websocket)
+            return make_connection(websocket)
+
+        patcher = mock.patch.object(pool, '_connect', side_effect=connect)
+        self.connect = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(pool.close)
+        return pool
+
+    def test_reuses_released_connection(self):
+        pool = self.make_pool()
+        with pool.connection('local') as first:
+            pass
+        with pool.connection('other-name-same-env') as second:
+            pass
+        self.assertIs(first, second)
+        self.assertEqual(self.connect.call_count, 1)
+
+    def test_concurrent_acquires_get_different_connections(self):
+        pool = self.make_pool()
+        first = pool.acquire('local')
+        second = pool.acquire('local')
+        self.assertIsNot(first, second)
+        pool.release(first)
+        pool.release(second)
+
+    def test_max_size_blocks_until_release(self):
+        pool = self.make_pool(max_size=1)
+        first = pool.acquire('local')
+        self.assertRaises(PoolTimeout, pool.acquire, 'local', 0.01)
+        acquired = []
+        thread = threading.Thread(
+            target=lambda: acquired.append(pool.acquire('local')))
+        thread.start()
+        time.sleep(0.05)
+        self.assertEqual(acquired, [])
+        pool.release(first)
+        thread.join(5)
+        self.assertEqual(acquired, [first])
+
+    def test_closed_connection_not_reused(self):
+        pool = self.make_pool()
+        first = pool.acquire('local')
+        first.close()
+        pool.release(first)
+        with pool.connection('local') as second:
+            self.assertIsNot(first, second)
+
+    def test_idle_timeout(self):
+        pool = self.make_pool(idle_timeout=0)
+        with pool.connection('local') as first:
+            pass
+        time.sleep(0.01)
+        with pool.connection('local') as second:
+            self.assertIsNot(first, second)
+        self.assertTrue(first.closed)
+
+    def test_idle_timeout_other_environment(self):
+        pool = self.make_pool(idle_timeout=0.05)
+        pool.store.connection_info.side_effect = (
+            lambda name: dict(INFO, **{'environ-uuid': name}))
+        with pool.connection('a') as first:
+            pass
+        with pool.connection('b'):
+            pass
+        self.assertFalse(first.closed)
+        time.sleep(0.1)
+        with pool.connection('b') as second:
+            pass
+        # Closed without its environment being used again.
+        self.assertTrue(first.closed)
+        self.assertFalse(second.closed)
+        self.assertNotIn('a', pool._idle)
+
+    def test_health_check_pings_idle_connections(self):
+        pool = self.make_pool(check_after=0)
+        with pool.connection('local') as first:
+            pass
+        self.websockets[0].close()
+        time.sleep(0.01)
+        with pool.connection('local') as second:
+            self.assertIsNot(first, second)
+        with pool.connection('local') as third:
+            self.assertIs(second, third)
+        pings = [r for r in self.websockets[1].requests
+                 if r['Type'] == 'Pinger']
+        self.assertEqual(len(pings), 1)
+
+    def test_error_in_block_discards_connection(self):
+        pool = self.make_pool()
+        try:
+            with pool.connection('local') as first:
+                raise apiclient.ConnectionClosed('boom')
+        except apiclient.ConnectionClosed:
+            pass
+        self.assertTrue(first.closed)
+        with pool.connection('local') as second:
+            self.assertIsNot(first, second)
+
+    def test_server_error_keeps_connection(self):
+        pool = self.make_pool()
+        try:
+            with pool.connection('local') as first:
+                raise apiclient.ServerError('not found', 'missing')
+        except apiclient.ServerError:
+            pass
+        with pool.connection('local') as second:
+            self.assertIs(first, second)
+
+    def test_release_foreign_connection(self):
+        pool = self.make_pool()
+        self.assertRaises(ValueError, pool.release, make_connection())
+
+    def test_open_environment_uses_pool(self):
+        pool = self.make_pool()
+        connection = apiclient.open_environment('local', pool=pool)
+        pool.release(connection)
+        self.assertIs(apiclient.open_environment('local', pool=pool),
+                      connection)
+        self.assertRaises(
+            TypeError, apiclient.open_environment, 'local', pool=pool,
+            pipelined=True)
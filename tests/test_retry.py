@@ -0,0 +1,210 @@
+import threading
+import time
+import unittest
+
+import mock
+
+from juju import apiclient
+from juju.retry import (
+    RetryBudget,
+    RetryPolicy,
+    RetryRule,
+    Scheduler,
+)
+from tests.fakes import FakeWebsocket, make_connection
+
+
+UPGRADING = {'Error': 'upgrade in progress', 'ErrorCode': ''}
+
+
+class TestRetryRule(unittest.TestCase):
+
+    def test_matches_code_or_message(self):
+        rule = RetryRule(error_code='try again', message='busy')
+        self.assertTrue(rule.matches(
+            {'Error': 'x', 'ErrorCode': 'try again'}, 0))
+        self.assertTrue(rule.matches({'Error': 'server busy'}, 0))
+        self.assertFalse(rule.matches({'Error': 'x', 'ErrorCode': 'y'}, 0))
+        self.assertFalse(rule.matches({'Response': {}}, 0))
+
+    def test_max_attempts(self):
+        rule = RetryRule(message='busy', max_attempts=2)
+        self.assertTrue(rule.matches({'Error': 'busy'}, 1))
+        self.assertFalse(rule.matches({'Error': 'busy'}, 2))
+
+    def test_needs_code_or_message(self):
+        self.assertRaises(ValueError, RetryRule)
+
+
+class TestRetryPolicy(unittest.TestCase):
+
+    def test_backoff(self):
+        policy = RetryPolicy(
+            base_delay=1, multiplier=2, max_delay=5, jitter=0)
+        self.assertEqual(
+            [policy.backoff(i) for i in range(5)], [1, 2, 4, 5, 5])
+
+    def test_jitter(self):
+        policy = RetryPolicy(base_delay=1, jitter=0.5)
+        for _ in range(20):
+            self.assertTrue(0.5 <= policy.backoff(0) <= 1)
+
+    def test_retry_delay(self):
+        policy = RetryPolicy(base_delay=1, jitter=0, max_attempts=3)
+        self.assertEqual(policy.retry_delay(UPGRADING, 0, 0), 1)
+        self.assertIsNone(policy.retry_delay(UPGRADING, 3, 0))
+        self.assertIsNone(policy.retry_delay({'Error': 'other'}, 0, 0))
+        self.assertIsNone(policy.retry_delay({'Response': {}}, 0, 0))
+
+    def test_deadline(self):
+        policy = RetryPolicy(base_delay=1, jitter=0, deadline=10)
+        self.assertEqual(policy.retry_delay(UPGRADING, 0, 8.5), 1)
+        self.assertIsNone(policy.retry_delay(UPGRADING, 0, 9.5))
+
+    def test_budget(self):
+        policy = RetryPolicy(base_delay=0, budget=2)
+        budget = policy.new_budget()
+        self.assertEqual(policy.retry_delay(UPGRADING, 0, 0, budget), 0)
+        self.assertEqual(policy.retry_delay(UPGRADING, 0, 0, budget), 0)
+        self.assertIsNone(policy.retry_delay(UPGRADING, 0, 0, budget))
+        for _ in range(11):
+            policy.retry_delay({'Response': {}}, 0, 0, budget)
+        self.assertEqual(policy.retry_delay(UPGRADING, 0, 0, budget), 0)
+
+    def test_no_budget(self):
+        self.assertIsNone(RetryPolicy(budget=None).new_budget())
+
+
+class TestRetryBudget(unittest.TestCase):
+
+    def test_earn_capped(self):
+        budget = RetryBudget(tokens=1, earn_ratio=0.5)
+        budget.earn()
+        self.assertEqual(budget.tokens, 1)
+        self.assertTrue(budget.spend())
+        self.assertFalse(budget.spend())
+        budget.earn()
+        budget.earn()
+        self.assertTrue(budget.spend())
+
+
+class TestScheduler(unittest.TestCase):
+
+    def test_runs_in_order(self):
+        scheduler = Scheduler()
+        calls = []
+        done = threading.Event()
+        scheduler.call_later(0.05, calls.append, 'late')
+        scheduler.call_later(0, calls.append, 'early')
+        scheduler.call_later(0.06, done.set)
+        self.assertTrue(done.wait(5))
+        self.assertEqual(calls, ['early', 'late'])
+
+    def test_cancel(self):
+        scheduler = Scheduler()
+        calls = []
+        done = threading.Event()
+        timers = [scheduler.call_later(0.05, calls.append, i)
+                  for i in range(4)]
+        scheduler.call_later(0.06, done.set)
+        timers[0].cancel()
+        self.assertEqual(timers[0].args, ())
+        self.assertEqual(len(scheduler), 5)
+        for timer in timers[1:3]:
+            timer.cancel()
+        # Most of the queue is cancelled, so it's dropped straight away.
+        self.assertEqual(len(scheduler), 2)
+        self.assertTrue(done.wait(5))
+        self.assertEqual(calls, [3])
+
+    def test_spawn_later(self):
+        scheduler = Scheduler()
+        blocked = threading.Event()
+        done = threading.Event()
+        self.addCleanup(blocked.set)
+        scheduler.spawn_later(0, blocked.wait)
+        scheduler.call_later(0.01, done.set)
+        self.assertTrue(done.wait(5))
+
+
+class TestConnectionRetries(unittest.TestCase):
+
+    def test_rpc_retries_with_backoff(self):
+        responses = [UPGRADING, {'Error': 'x', 'ErrorCode': 'try again'},
+                     {'Name': 'done'}]
+        connection = make_connection(
+            FakeWebsocket(lambda r: responses.pop(0)),
+            retry_policy=RetryPolicy(base_delay=0.5, jitter=0))
+        with mock.patch('time.sleep') as sleep:
+            self.assertEqual(
+                connection.rpc('Client', 'Get'), {'Name': 'done'})
+        self.assertEqual(
+            sleep.call_args_list, [mock.call(0.5), mock.call(1.0)])
+
+    def test_rpc_gives_up(self):
+        connection = make_connection(
+            FakeWebsocket(lambda r: UPGRADING),
+            retry_policy=RetryPolicy(base_delay=0, max_attempts=2))
+        self.assertRaises(
+            apiclient.ServerError, connection.rpc, 'Client', 'Get')
+
+    def test_retry_does_not_block_other_calls(self):
+        responses = {'slow': [UPGRADING, {'Name': 'slow'}]}
+
+        def handler(request):
+            name = request['Params']['Name']
+            if name in responses:
+                return responses[name].pop(0)
+            return {'Name': name}
+
+        connection = make_connection(
+            FakeWebsocket(handler), pipelined=True,
+            retry_policy=RetryPolicy(base_delay=0.2, jitter=0))
+        self.addCleanup(connection.close)
+        start = time.time()
+        slow = connection.submit('Client', 'Get', {'Name': 'slow'})
+        fast = connection.rpc('Client', 'Get', {'Name': 'fast'})
+        self.assertEqual(fast, {'Name': 'fast'})
+        self.assertFalse(slow.done())
+        self.assertLess(time.time() - start, 0.2)
+        self.assertEqual(slow.result(5), {'Name': 'slow'})
+
+    def test_submit_retries_in_caller_when_not_pipelined(self):
+        responses = [UPGRADING, {'Name': 'done'}]
+        connection = make_connection(
+            FakeWebsocket(lambda r: responses.pop(0)),
+            retry_policy=RetryPolicy(base_delay=0.5, jitter=0))
+        with mock.patch('time.sleep') as sleep:
+            future = connection.submit('Client', 'Get')
+            self.assertTrue(future.done())
+        self.assertEqual(future.result(), {'Name': 'done'})
+        self.assertEqual(sleep.call_args_list, [mock.call(0.5)])
+
+    def test_blocked_retry_does_not_delay_timeouts(self):
+        # A retry waiting to send on one connection doesn't hold up
+        # timeouts on another.
+        responses = [UPGRADING, {}]
+        busy = make_connection(
+            FakeWebsocket(lambda r: responses.pop(0)), pipelined=True,
+            retry_policy=RetryPolicy(base_delay=0.01, jitter=0))
+        self.addCleanup(busy.close)
+        idle = make_connection(
+            FakeWebsocket(lambda r: None), pipelined=True)
+        self.addCleanup(idle.close)
+        with busy._io_lock:
+            retried = busy.submit('Client', 'Get')
+            time.sleep(0.05)
+            future = idle.submit('Client', 'Slow', timeout=0.05)
+            self.assertIsInstance(
+                future.exception(1), apiclient.RPCTimeout)
+            self.assertIn('Slow', str(future.exception()))
+        self.assertEqual(retried.result(5), {})
+
+    def test_completed_call_cancels_timeout(self):
+        connection = make_connection(
+            FakeWebsocket(lambda r: {'Name': 'done'}), pipelined=True)
+        self.addCleanup(connection.close)
+        with mock.patch('juju.apiclient.scheduler') as scheduler:
+            connection.submit('Client', 'Get', timeout=60).result(5)
+        timer = scheduler.call_later.return_value
+        timer.cancel.assert_called_once_with()
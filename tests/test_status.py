@@ -0,0 +1,131 @@
+import json
+import unittest
+
+from benchmarks.server import make_status
+from juju.status import (
+    Machine, Relation, Service, Status, Unit, iter_status, stream_status)
+from tests.fakes import FakeWebsocket, make_connection
+
+
+JUJU1_STATUS = {
+    'EnvironmentName': 'test',
+    'Machines': {
+        '0': {
+            'Id': '0', 'DNSName': '10.0.0.1', 'AgentState': 'started',
+            'Containers': {
+                '0/lxc/0': {'Id': '0/lxc/0', 'AgentState': 'pending',
+                            'Containers': {}},
+            },
+        },
+    },
+    'Services': {
+        'wordpress': {
+            'Charm': 'cs:trusty/wordpress-1',
+            'Exposed': True,
+            'Units': {
+                'wordpress/0': {
+                    'Machine': '0', 'AgentState': 'error',
+                    'AgentStateInfo': 'hook failed',
+                    'Subordinates': {
+                        'nrpe/0': {'AgentState': 'started'},
+                    },
+                },
+            },
+            'Relations': {'db': ['mysql']},
+        },
+        'mysql': {'Charm': 'cs:trusty/mysql-2', 'Units': None},
+    },
+    'Relations': [
+        {'Id': 1, 'Key': 'wordpress:db mysql:db', 'Interface': 'mysql'},
+    ],
+    'Networks': {},
+}
+
+JUJU2_STATUS = {
+    'model': {'name': 'test'},
+    'machines': {
+        '1': {'id': '1', 'dns-name': '10.0.0.2', 'containers': None},
+    },
+    'applications': {
+        'redis': {
+            'charm': 'cs:redis-3',
+            'units': {'redis/0': {'machine': '1'}},
+        },
+    },
+    'relations': None,
+}
+
+
+def frame(response):
+    return json.dumps({'RequestId': 7, 'Response': response}, indent=1)
+
+
+class TestIterStatus(unittest.TestCase):
+
+    def test_juju1(self):
+        records = list(iter_status(frame(JUJU1_STATUS)))
+        self.assertEqual(records[0], Machine(
+            id='0', dns_name='10.0.0.1', agent_state='started'))
+        self.assertEqual(records[1], Machine(
+            id='0/lxc/0', parent='0', agent_state='pending'))
+        units = [r for r in records if isinstance(r, Unit)]
+        self.assertEqual(units, [
+            Unit(name='wordpress/0', service='wordpress', machine='0',
+                 agent_state='error', agent_state_info='hook failed'),
+            Unit(name='nrpe/0', service='nrpe', principal='wordpress/0',
+                 agent_state='started'),
+        ])
+        services = [r for r in records if isinstance(r, Service)]
+        self.assertEqual(services, [
+            Service(name='wordpress', charm='cs:trusty/wordpress-1',
+                    exposed=True, relations={'db': ['mysql']}),
+            Service(name='mysql', charm='cs:trusty/mysql-2'),
+        ])
+        self.assertEqual(records[-1], Relation(
+            id=1, key='wordpress:db mysql:db', interface='mysql'))
+
+    def test_juju2(self):
+        records = list(iter_status(frame(JUJU2_STATUS).encode('utf-8')))
+        self.assertEqual(records, [
+            Machine(id='1', dns_name='10.0.0.2'),
+            Unit(name='redis/0', service='redis', machine='1'),
+            Service(name='redis', charm='cs:redis-3'),
+        ])
+
+    def test_matches_full_decode(self):
+        status = make_status(95)
+        compact = Status(iter_status(frame(status)))
+        self.assertEqual(sorted(compact.machines), sorted(status['Machines']))
+        self.assertEqual(sorted(compact.services), sorted(status['Services']))
+        for name, service in status['Services'].items():
+            self.assertEqual(
+                sorted(u.name for u in compact.units_of(name)),
+                sorted(service['Units']))
+            for unit_name, unit in service['Units'].items():
+                self.assertEqual(
+                    compact.units[unit_name].public_address,
+                    unit['PublicAddress'])
+        self.assertEqual(len(compact.units_on('0')), 4)
+
+    def test_invalid(self):
+        self.assertRaises(
+            ValueError, list, iter_status('{"Response": {"Machines": [}}'))
+        self.assertRaises(
+            ValueError, list, iter_status('{"Response": {"Machines": {} x'))
+
+    def test_records_are_slotted(self):
+        unit = Unit(name='a/0')
+        self.assertRaises(AttributeError, setattr, unit, 'extra', 1)
+        self.assertIsNone(unit.machine)
+        self.assertRaises(TypeError, Unit, extra=1)
+
+
+class TestStreamStatus(unittest.TestCase):
+
+    def test_stream_status(self):
+        websocket = FakeWebsocket(lambda r: JUJU1_STATUS)
+        connection = make_connection(websocket)
+        records = list(stream_status(connection, ['wordpress']))
+        self.assertEqual(len(records), 7)
+        self.assertEqual(
+            websocket.requests[-1]['Params'], {'Patterns': ['wordpress']})
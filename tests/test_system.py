@@ -1,6 +1,134 @@
+import unittest
+
+import mock
+
+from juju.apiclient import ServerError
+from juju.exceptions import EnvironmentNotFound
 from juju.system import System
+from tests.fakes import FakeWebsocket, make_connection
+
+
+INFO = {
+    'user': 'admin',
+    'password': 'sekrit',
+    'environ-uuid': 'uuid-0',
+    'server-uuid': 'server',
+    'state-servers': ['10.0.0.1:17070'],
+    'ca-cert': 'cert',
+}
+
+
+def environments(count):
+    return {'UserEnvironments': [
+        {'Name': 'env-{}'.format(i), 'UUID': 'uuid-{}'.format(i),
+         'OwnerTag': 'user-admin@local', 'LastConnection': None}
+        for i in range(count)]}
+
+
+class FakeSystem(object):
+    """Answers the calls of the root API, for a number of environments."""
+
+    def __init__(self, count):
+        self.count = count
+
+    def __call__(self, request):
+        method = request['Request']
+        if method in ('ListEnvironments', 'AllEnvironments'):
+            return environments(self.count)
+        if method == 'EnvironmentStatus':
+            results = []
+            for entity in request['Params']['Entities']:
+                uuid = entity['Tag'][len('environment-'):]
+                if uuid == 'uuid-bad':
+                    results.append({'Error': {
+                        'Message': 'not found', 'Code': 'not found'}})
+                else:
+                    results.append({
+                        'EnvironTag': entity['Tag'], 'Life': 'alive',
+                        'HostedMachineCount': 1, 'ServiceCount': 2})
+            return {'Results': results}
+        return {}
+
+
+class TestSystem(unittest.TestCase):
+
+    def setUp(self):
+        self.websocket = FakeWebsocket(FakeSystem(3))
+        self.connection = make_connection(self.websocket, pipelined=True)
+        self.addCleanup(self.connection.close)
+        self.system = System(INFO, connection=self.connection)
+
+    def requests(self, method):
+        return [r for r in self.websocket.requests if r['Request'] == method]
+
+    def test_system_instantiation(self):
+        system = System()
+        self.assertIsNone(system.current_user)
+        self.assertRaises(ValueError, system.connect)
+
+    def test_root_connection(self):
+        system = System(INFO, chunk_size=10)
+        with mock.patch('juju.system.connection_from_info',
+                        return_value=self.connection) as connect:
+            self.assertIs(system.connect(), self.connection)
+            self.assertIs(system.connect(), self.connection)
+        self.assertEqual(connect.call_count, 1)
+        info, = connect.call_args[0]
+        self.assertEqual(info['environ-uuid'], '')
+        self.assertEqual(connect.call_args[1], {'pipelined': True})
+
+    def test_list_environments(self):
+        envs = self.system.list_environments()
+        self.assertEqual([e.name for e in envs], ['env-0', 'env-1', 'env-2'])
+        self.assertEqual(envs[1].uuid, 'uuid-1')
+        self.assertEqual(envs[1].owner, 'admin@local')
+        self.assertEqual(
+            self.requests('ListEnvironments')[0]['Params'],
+            {'Tag': 'user-admin'})
+
+    def test_all_environments(self):
+        envs = self.system.all_environments()
+        self.assertEqual(len(envs), 3)
+        self.assertEqual(len(self.requests('AllEnvironments')), 1)
+
+    def test_get_environment(self):
+        self.assertEqual(self.system.get_environment('uuid-2').name, 'env-2')
+        self.assertRaises(
+            EnvironmentNotFound, self.system.get_environment, 'nope')
+
+    def test_fetch_summaries(self):
+        self.websocket.handler.count = 60
+        results = self.system.fetch_summaries()
+        self.assertEqual(len(results), 60)
+        self.assertEqual(results[59].item.name, 'env-59')
+        self.assertEqual(results[59].result['ServiceCount'], 2)
+        # Fetched in chunks, all sent before any response was needed.
+        self.assertEqual(len(self.requests('EnvironmentStatus')), 3)
+        # And then cached.
+        self.assertEqual(results[0].item.summary['Life'], 'alive')
+        self.system.fetch_summaries([r.item for r in results])
+        self.assertEqual(len(self.requests('EnvironmentStatus')), 3)
+
+    def test_summary_fetched_lazily(self):
+        env = self.system.list_environments()[0]
+        self.assertEqual(self.requests('EnvironmentStatus'), [])
+        self.assertEqual(env.summary['HostedMachineCount'], 1)
+        env.summary
+        self.assertEqual(len(self.requests('EnvironmentStatus')), 1)
+        env.refresh()
+        env.summary
+        self.assertEqual(len(self.requests('EnvironmentStatus')), 2)
 
-def test_system_instantiation(): 
-	s = System()
-	assert isinstance(s,System)
+    def test_summary_error(self):
+        env = self.system.list_environments()[0]
+        env.uuid = 'uuid-bad'
+        result, = self.system.fetch_summaries([env])
+        self.assertIsInstance(result.error, ServerError)
+        with self.assertRaises(ServerError):
+            env.summary
 
+    def test_environment_connection_info(self):
+        env = self.system.list_environments()[1]
+        info = env.connection_info()
+        self.assertEqual(info['environ-uuid'], 'uuid-1')
+        self.assertEqual(info['state-servers'], INFO['state-servers'])
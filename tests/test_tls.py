@@ -0,0 +1,105 @@
+import os
+import socket
+import ssl
+import threading
+import unittest
+
+from juju import tls
+
+
+DATA = os.path.join(os.path.dirname(__file__), 'data')
+
+
+def read(name):
+    with open(os.path.join(DATA, name)) as f:
+        return f.read()
+
+
+class TLSServer(object):
+    """Accepts TLS connections, sends a greeting and waits for a reply."""
+
+    def __init__(self):
+        self.context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        self.context.load_cert_chain(
+            os.path.join(DATA, 'server-cert.pem'),
+            os.path.join(DATA, 'server-key.pem'))
+        self.sock = socket.socket()
+        self.sock.bind(('127.0.0.1', 0))
+        self.sock.listen(5)
+        self.port = self.sock.getsockname()[1]
+        self.thread = threading.Thread(target=self.serve)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def serve(self):
+        while True:
+            try:
+                accepted, _ = self.sock.accept()
+            except OSError:
+                return
+            try:
+                conn = self.context.wrap_socket(accepted, server_side=True)
+                conn.sendall(b'hi')
+                conn.recv(10)
+                conn.close()
+            except (OSError, ssl.SSLError):
+                accepted.close()
+
+    def close(self):
+        self.sock.close()
+
+
+class TestSSLContext(unittest.TestCase):
+
+    def setUp(self):
+        tls.clear_cache()
+        self.addCleanup(tls.clear_cache)
+        self.cacert = read('server-cert.pem')
+
+    def test_shared_per_certificate(self):
+        context = tls.ssl_context(self.cacert)
+        self.assertIs(tls.ssl_context(self.cacert), context)
+        self.assertIs(tls.ssl_context(self.cacert.encode('ascii')), context)
+        self.assertFalse(context.check_hostname)
+        self.assertEqual(context.verify_mode, ssl.CERT_REQUIRED)
+
+    def test_fingerprint_ignores_surrounding_whitespace(self):
+        self.assertEqual(
+            tls.fingerprint(self.cacert), tls.fingerprint(
+                '\n' + self.cacert + '\n'))
+
+    def test_bad_certificate(self):
+        self.assertRaises(ssl.SSLError, tls.ssl_context, 'not a cert')
+
+
+class TestConnect(unittest.TestCase):
+
+    def setUp(self):
+        tls.clear_cache()
+        self.addCleanup(tls.clear_cache)
+        self.cacert = read('server-cert.pem')
+        self.server = TLSServer()
+        self.addCleanup(self.server.close)
+
+    def exchange(self):
+        sock = tls.connect('127.0.0.1', self.server.port, self.cacert)
+        self.assertEqual(sock.recv(2), b'hi')
+        tls.remember_session(sock, self.cacert)
+        sock.sendall(b'bye')
+        reused = sock.session_reused
+        sock.close()
+        return reused
+
+    def test_verified_connection(self):
+        self.assertFalse(self.exchange())
+
+    @unittest.skipUnless(tls._can_resume, "sessions can't be resumed")
+    def test_session_resumed(self):
+        self.assertFalse(self.exchange())
+        self.assertTrue(self.exchange())
+
+    def test_untrusted_server(self):
+        # other-cert.pem is a CA that didn't sign the server's certificate.
+        self.assertRaises(
+            ssl.SSLError, tls.connect, '127.0.0.1', self.server.port,
+            read('other-cert.pem'))
@@ -0,0 +1,212 @@
+import os
+import shutil
+import socket
+import tempfile
+import time
+import unittest
+
+from websocket import WebSocketPayloadException
+
+import juju.apiclient
+from benchmarks import run
+from benchmarks.server import FakeAPIServer, make_status
+from juju.apiclient import RPCTimeout
+from juju.metrics import Metrics
+from juju.transport import (
+    DeflateWebsocket, RecordingTransport, ReplayTransport, WebsocketTransport,
+    accepted_deflate, load_recording)
+from tests.fakes import FakeTransport
+
+
+def handler(request):
+    if request['Request'] == 'Slow':
+        time.sleep(0.1)
+    return {'Method': request['Request'], 'Params': request['Params']}
+
+
+class TestRecordReplay(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.path = os.path.join(self.tmpdir, 'session.jsonl')
+
+    def connect(self, transport, **kwargs):
+        connection = juju.apiclient.Connection(
+            'localhost:17070', 'cert', 'user-admin', 'sekrit',
+            transport=transport, **kwargs)
+        self.addCleanup(connection.close)
+        return connection
+
+    def record(self, *calls):
+        with RecordingTransport(self.path, FakeTransport(handler)) as rec:
+            connection = self.connect(rec)
+            for method, params in calls:
+                connection.rpc('Client', method, params)
+            connection.close()
+
+    def test_record(self):
+        self.record(('Get', {'A': 1}))
+        recording, = load_recording(self.path)
+        self.assertEqual(recording.endpoint, 'wss://localhost:17070')
+        response, latency = recording.take(
+            {'Type': 'Client', 'Request': 'Get', 'Params': {'A': 1}})
+        self.assertEqual(response['Response']['Params'], {'A': 1})
+        self.assertGreaterEqual(latency, 0)
+
+    def test_login_redacted(self):
+        self.record(('Get', {'A': 1}))
+        with open(self.path) as f:
+            self.assertNotIn('sekrit', f.read())
+        self.assertEqual(os.stat(self.path).st_mode & 0o777, 0o600)
+        # The login is still replayed.
+        connection = self.connect(ReplayTransport(self.path, speed=None))
+        self.assertEqual(
+            connection.rpc('Client', 'Get', {'A': 1})['Params'], {'A': 1})
+
+    def test_replay(self):
+        self.record(('Get', {'A': 1}), ('Get', {'A': 2}))
+        connection = self.connect(ReplayTransport(self.path, speed=None))
+        # Matched by params, whatever order they're asked in.
+        self.assertEqual(
+            connection.rpc('Client', 'Get', {'A': 2})['Params'], {'A': 2})
+        self.assertEqual(
+            connection.rpc('Client', 'Get', {'A': 1})['Params'], {'A': 1})
+
+    def test_replay_loose_match(self):
+        self.record(('Get', {'A': 1}))
+        connection = self.connect(ReplayTransport(self.path, speed=None))
+        self.assertEqual(
+            connection.rpc('Client', 'Get', {'A': 3})['Params'], {'A': 1})
+        with self.assertRaises(juju.apiclient.ServerError) as cm:
+            connection.rpc('Client', 'Get', {'A': 3})
+        self.assertEqual(cm.exception.error_code, 'not found')
+
+    def test_replay_pipelined(self):
+        self.record(*[('Get', {'A': i}) for i in range(10)])
+        connection = self.connect(
+            ReplayTransport(self.path, speed=None), pipelined=True)
+        futures = [connection.submit('Client', 'Get', {'A': i})
+                   for i in range(10)]
+        self.assertEqual(
+            [f.result(1)['Params']['A'] for f in futures], list(range(10)))
+
+    def test_replay_speed(self):
+        self.record(('Slow', {}))
+        connection = self.connect(ReplayTransport(self.path, speed=1))
+        start = time.time()
+        connection.rpc('Client', 'Slow')
+        self.assertGreaterEqual(time.time() - start, 0.09)
+        connection = self.connect(ReplayTransport(self.path, speed=10))
+        start = time.time()
+        connection.rpc('Client', 'Slow')
+        self.assertLess(time.time() - start, 0.09)
+
+    def test_replay_timeout(self):
+        self.record(('Slow', {}))
+        connection = self.connect(ReplayTransport(self.path))
+        self.assertRaises(
+            juju.apiclient.RPCTimeout, connection.rpc, 'Client', 'Slow',
+            timeout=0.02)
+
+    def test_gzipped(self):
+        self.path += '.gz'
+        self.record(('Get', {'A': 1}))
+        with open(self.path, 'rb') as f:
+            self.assertEqual(f.read(2), b'\x1f\x8b')
+        connection = self.connect(ReplayTransport(self.path, speed=None))
+        self.assertEqual(
+            connection.rpc('Client', 'Get', {'A': 1})['Params'], {'A': 1})
+
+    def test_no_more_connections(self):
+        self.record()
+        transport = ReplayTransport(self.path)
+        self.connect(transport)
+        self.assertRaises(IOError, self.connect, transport)
+
+
+class TestWebsocketTransport(unittest.TestCase):
+
+    def test_connect_timeout(self):
+        # A server that never answers the TLS handshake.
+        server = socket.socket()
+        self.addCleanup(server.close)
+        server.bind(('127.0.0.1', 0))
+        server.listen(5)
+        path = os.path.join(os.path.dirname(__file__), 'data',
+                            'server-cert.pem')
+        with open(path) as f:
+            cacert = f.read()
+        transport = WebsocketTransport(connect_timeout=0.05)
+        start = time.time()
+        self.assertRaises(
+            socket.timeout, transport.connect,
+            'wss://127.0.0.1:{}'.format(server.getsockname()[1]), cacert)
+        self.assertLess(time.time() - start, 1)
+
+
+class TestDeflate(unittest.TestCase):
+
+    def start(self, **kwargs):
+        server = FakeAPIServer(**kwargs)
+        server.start()
+        self.addCleanup(server.stop)
+        return server
+
+    def connect(self, server, **kwargs):
+        connection = run.connect(server, **kwargs)
+        self.addCleanup(connection.close)
+        return connection
+
+    def test_accepted_deflate(self):
+        self.assertEqual(
+            accepted_deflate({'sec-websocket-extensions':
+                              'foo, permessage-deflate; '
+                              'server_no_context_takeover; '
+                              'client_max_window_bits=10'}),
+            {'server_no_context_takeover': None,
+             'client_max_window_bits': '10'})
+        self.assertIsNone(accepted_deflate({'upgrade': 'websocket'}))
+
+    def test_compressed(self):
+        server = self.start(compression=True, status_units=200)
+        metrics = Metrics()
+        connection = self.connect(
+            server, metrics=metrics, pipelined=True,
+            transport=WebsocketTransport(compression=True, threshold=0))
+        self.assertIsInstance(connection._connection, DeflateWebsocket)
+        status = connection.rpc('Client', 'FullStatus')
+        self.assertEqual(status['Services'], make_status(200)['Services'])
+        # Again, with the compression context carried over.
+        self.assertEqual(connection.rpc('Client', 'FullStatus'), status)
+        stats = metrics.snapshot()['Client.FullStatus']
+        self.assertGreater(stats['compression_ratio'], 5)
+        self.assertLess(stats['response_wire_bytes'], stats['response_bytes'])
+
+    def test_declined(self):
+        server = self.start()
+        connection = self.connect(
+            server, transport=WebsocketTransport(compression=True))
+        self.assertNotIsInstance(connection._connection, DeflateWebsocket)
+        self.assertEqual(connection.rpc('Client', 'AgentVersion'), {})
+        # The connect timeout doesn't apply once connected.
+        self.assertIsNone(connection._connection.sock.gettimeout())
+
+    def test_timeout_keeps_framing(self):
+        server = self.start(compression=True, latency=0.1)
+        connection = self.connect(
+            server, transport=WebsocketTransport(compression=True))
+        self.assertRaises(
+            RPCTimeout, connection.rpc, 'Client', 'FullStatus', timeout=0.01)
+        self.assertEqual(
+            connection.rpc('Client', 'FullStatus', timeout=1)['Services'],
+            make_status(10)['Services'])
+
+    def test_max_size(self):
+        server = self.start(compression=True, status_units=200)
+        connection = self.connect(
+            server, transport=WebsocketTransport(
+                compression=True, max_size=10000))
+        self.assertRaises(
+            WebSocketPayloadException, connection.rpc, 'Client',
+            'FullStatus')
@@ -0,0 +1,232 @@
+import threading
+import unittest
+
+import mock
+
+from juju.apiclient import ConnectionClosed
+from juju.environment import Environment
+from juju.watcher import AllWatcher, ModelState, WaitTimeout, units_started
+from tests.fakes import FakeWebsocket, make_connection
+
+
+def unit(name, machine='0', status='pending'):
+    return {'Name': name, 'Service': name.split('/')[0], 'MachineId': machine,
+            'Status': status}
+
+
+class FakeAllWatcherServer(object):
+    """Serves AllWatcher calls from deltas pushed by the test."""
+
+    def __init__(self):
+        self.batches = []
+        self.waiting = None
+        self.lock = threading.Lock()
+        self.websocket = FakeWebsocket(self.handle)
+
+    def handle(self, request):
+        if request['Request'] == 'WatchAll':
+            return {'AllWatcherId': '7'}
+        if request['Request'] == 'Stop':
+            with self.lock:
+                if self.waiting is not None:
+                    self.websocket.reply(
+                        self.waiting, {'Error': 'watcher was stopped'})
+                    self.waiting = None
+            return {}
+        if request['Request'] == 'Next':
+            with self.lock:
+                if self.batches:
+                    return {'Deltas': self.batches.pop(0)}
+                self.waiting = request
+            return None
+        return {}
+
+    def push(self, deltas):
+        with self.lock:
+            if self.waiting is not None:
+                self.websocket.reply(self.waiting, {'Deltas': deltas})
+                self.waiting = None
+            else:
+                self.batches.append(deltas)
+
+
+class TestModelState(unittest.TestCase):
+
+    def test_apply_and_index(self):
+        state = ModelState()
+        changed = state.apply([
+            ['machine', 'change', {'Id': '0'}],
+            ['service', 'change', {'Name': 'wordpress'}],
+            ['unit', 'change', unit('wordpress/0')],
+            ['unit', 'change', unit('wordpress/1', machine='1')],
+            ['relation', 'change', {'Key': 'wordpress:db mysql:db'}],
+        ])
+        self.assertEqual(changed[:2], [('machine', '0'),
+                                       ('service', 'wordpress')])
+        self.assertEqual(list(state.machines), ['0'])
+        self.assertEqual(list(state.services), ['wordpress'])
+        self.assertEqual(list(state.relations), ['wordpress:db mysql:db'])
+        self.assertEqual(
+            sorted(state.units_of('wordpress')),
+            ['wordpress/0', 'wordpress/1'])
+        self.assertEqual(list(state.units_on('1')), ['wordpress/1'])
+        self.assertEqual(state.version, 1)
+
+    def test_change_reindexes_and_remove(self):
+        state = ModelState()
+        state.apply([['unit', 'change', unit('wordpress/0')]])
+        state.apply([['unit', 'change', unit('wordpress/0', machine='3')]])
+        self.assertEqual(state.units_on('0'), {})
+        self.assertEqual(list(state.units_on('3')), ['wordpress/0'])
+        state.apply([['unit', 'remove', unit('wordpress/0', machine='3')]])
+        self.assertEqual(state.units, {})
+        self.assertEqual(state.units_of('wordpress'), {})
+        self.assertIsNone(state.get('unit', 'wordpress/0'))
+
+    def test_lower_case_fields(self):
+        state = ModelState()
+        state.apply([
+            ['application', 'change', {'name': 'mysql'}],
+            ['unit', 'change', {'name': 'mysql/0', 'application': 'mysql',
+                                'machine-id': '2'}],
+        ])
+        self.assertEqual(list(state.services), ['mysql'])
+        self.assertEqual(list(state.units_on('2')), ['mysql/0'])
+
+
+class TestAllWatcher(unittest.TestCase):
+
+    def test_next(self):
+        server = FakeAllWatcherServer()
+        server.push([['machine', 'change', {'Id': '0'}]])
+        watcher = AllWatcher(make_connection(server.websocket))
+        self.assertEqual(watcher.next(), [['machine', 'change', {'Id': '0'}]])
+        self.assertEqual(watcher.watcher_id, '7')
+        self.assertEqual(list(watcher.state.machines), ['0'])
+        next_call = server.websocket.requests[-1]
+        self.assertEqual(next_call['Type'], 'AllWatcher')
+        self.assertEqual(next_call['Id'], '7')
+
+    def test_deltas_generator(self):
+        server = FakeAllWatcherServer()
+        server.push([['machine', 'change', {'Id': '0'}],
+                     ['machine', 'change', {'Id': '1'}]])
+        watcher = AllWatcher(make_connection(server.websocket))
+        deltas = watcher.deltas()
+        self.assertEqual(next(deltas)[2], {'Id': '0'})
+        self.assertEqual(next(deltas)[2], {'Id': '1'})
+
+    def test_run_in_background(self):
+        server = FakeAllWatcherServer()
+        connection = make_connection(server.websocket, pipelined=True)
+        self.addCleanup(connection.close)
+        watcher = AllWatcher(connection)
+        seen = []
+        done = threading.Event()
+
+        def callback(deltas, changed):
+            seen.append(changed)
+            done.set()
+
+        watcher.run_in_background(callback)
+        server.push([['unit', 'change', unit('mysql/0')]])
+        self.assertTrue(done.wait(5))
+        self.assertEqual(seen, [[('unit', 'mysql/0')]])
+        self.assertEqual(list(watcher.state.units_of('mysql')), ['mysql/0'])
+        watcher.stop(timeout=5)
+        self.assertFalse(watcher._thread.is_alive())
+
+
+class TestWaitFor(unittest.TestCase):
+
+    def setUp(self):
+        self.server = FakeAllWatcherServer()
+        self.connection = make_connection(self.server.websocket)
+        self.addCleanup(self.connection.close)
+
+    def wait_in_thread(self, wait, *args, **kwargs):
+        results = []
+
+        def run():
+            try:
+                results.append(wait(*args, **kwargs))
+            except Exception as e:
+                results.append(e)
+        thread = threading.Thread(target=run)
+        thread.start()
+        self.addCleanup(thread.join, 5)
+        return thread, results
+
+    def test_wait_for(self):
+        checked = []
+        started = units_started('mysql', 2)
+
+        def predicate(state):
+            checked.append(state.version)
+            return started(state)
+
+        self.server.push([
+            ['unit', 'change', unit('mysql/0', status='started')],
+            ['unit', 'change', unit('mysql/1')]])
+        watcher = AllWatcher(self.connection)
+        self.connection.start_pipelining()
+        thread, results = self.wait_in_thread(
+            watcher.wait_for, predicate, 5, kinds=['unit'])
+        # Checked once the first batch arrives, and not for other kinds.
+        while not checked:
+            thread.join(0.01)
+        self.server.push([['machine', 'change', {'Id': '1'}]])
+        watcher.wait_for(lambda state: state.machines, 5)
+        self.assertEqual(checked, [1])
+        self.server.push([['unit', 'change', unit('mysql/1',
+                                                  status='started')]])
+        thread.join(5)
+        self.assertEqual(results, [True])
+        self.assertEqual(checked, [1, 3])
+        watcher.stop(timeout=5)
+
+    def test_timeout(self):
+        self.server.push([['unit', 'change', unit('mysql/0')]])
+        self.assertRaises(
+            WaitTimeout, self.connection.wait_for, units_started('mysql'),
+            0.05)
+
+    def test_stopped(self):
+        watcher = self.connection.watch()
+        thread, results = self.wait_in_thread(
+            watcher.wait_for, lambda state: False)
+        watcher.stop(timeout=5)
+        thread.join(5)
+        self.assertIsInstance(results[0], ConnectionClosed)
+
+    def test_connection_wait_for(self):
+        self.server.push([['unit', 'change', unit('mysql/0')]])
+        watcher = self.connection.watch()
+        self.assertTrue(self.connection.pipelined)
+        self.assertIs(self.connection.watch(), watcher)
+        thread, results = self.wait_in_thread(
+            self.connection.wait_for, units_started('mysql'), 5)
+        self.server.push([['unit', 'change', unit('mysql/0',
+                                                  status='started')]])
+        thread.join(5)
+        self.assertEqual(results, [True])
+        # One WatchAll, and no polling.
+        requests = [r['Request'] for r in self.server.websocket.requests]
+        self.assertEqual(requests.count('WatchAll'), 1)
+        self.assertNotIn('FullStatus', requests)
+
+    def test_failed_watcher_replaced(self):
+        watcher = self.connection.watch()
+        watcher.error = ConnectionClosed("broken")
+        self.assertIsNot(self.connection.watch(), watcher)
+
+    def test_environment_wait_for(self):
+        self.server.push([['unit', 'change', unit('mysql/0',
+                                                  status='started')]])
+        env = Environment('test')
+        with mock.patch.object(env, 'connection_info', return_value={}), \
+                mock.patch('juju.apiclient.connection_from_info',
+                           return_value=self.connection) as connect:
+            self.assertTrue(env.wait_for(units_started('mysql'), 5))
+        self.assertEqual(connect.call_args[1], {'pipelined': True})
+        self.assertTrue(self.connection.closed)